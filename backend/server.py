@@ -1,20 +1,32 @@
-from fastapi import FastAPI, APIRouter, HTTPException, BackgroundTasks
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, APIRouter, HTTPException, BackgroundTasks, Request
+from fastapi.exception_handlers import http_exception_handler
+from fastapi.responses import FileResponse, RedirectResponse, Response, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 import os
 import logging
 import uuid
 import json
 import asyncio
 import base64
+import hashlib
+import html
+import math
+import random
 import re
+import socket
+import time
 import aiohttp
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import OrderedDict
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict
 from typing import List, Optional, Dict, Any
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -34,6 +46,36 @@ EXPORTS_DIR.mkdir(exist_ok=True)
 IMAGES_DIR = ROOT_DIR / "images"
 IMAGES_DIR.mkdir(exist_ok=True)
 
+# Bulk chapter generation limits: per book (default for each run) and per worker
+# process (the default JOB_WORKER_SLOTS)
+CHAPTER_CONCURRENCY_PER_BOOK = int(os.environ.get('CHAPTER_CONCURRENCY_PER_BOOK', '3'))
+CHAPTER_CONCURRENCY_GLOBAL = int(os.environ.get('CHAPTER_CONCURRENCY_GLOBAL', '6'))
+
+# Process-wide image generation limits. Nano Banana and the stock photo sites
+# are separate services, so each gets its own budget.
+AI_IMAGE_CONCURRENCY = int(os.environ.get('AI_IMAGE_CONCURRENCY', '2'))
+STOCK_IMAGE_CONCURRENCY = int(os.environ.get('STOCK_IMAGE_CONCURRENCY', '4'))
+ai_image_slots = asyncio.Semaphore(AI_IMAGE_CONCURRENCY)
+stock_image_slots = asyncio.Semaphore(STOCK_IMAGE_CONCURRENCY)
+
+# Stock photo providers, tried in order ({query} is the URL-encoded search).
+# The fallback is started once the primary has run STOCK_HEDGE_DELAY seconds
+# without an image, and the first valid image wins; a negative delay disables
+# hedging so providers are only tried after the previous one failed.
+STOCK_PRIMARY_URL = os.environ.get('STOCK_PRIMARY_URL', 'https://source.unsplash.com/800x600/?{query}')
+STOCK_FALLBACK_URL = os.environ.get('STOCK_FALLBACK_URL', 'https://picsum.photos/800/600')
+STOCK_PRIMARY_TIMEOUT = float(os.environ.get('STOCK_PRIMARY_TIMEOUT', '20'))
+STOCK_FALLBACK_TIMEOUT = float(os.environ.get('STOCK_FALLBACK_TIMEOUT', '15'))
+STOCK_HEDGE_DELAY = float(os.environ.get('STOCK_HEDGE_DELAY', '3'))
+
+# Outbound HTTP: one pooled session for the app's lifetime
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '32'))
+HTTP_DNS_CACHE_SECONDS = int(os.environ.get('HTTP_DNS_CACHE_SECONDS', '300'))
+
+# Streaming chapter generation: how often partial text is checkpointed
+STREAM_CHECKPOINT_SECONDS = float(os.environ.get('STREAM_CHECKPOINT_SECONDS', '3'))
+STREAM_CHECKPOINT_CHARS = int(os.environ.get('STREAM_CHECKPOINT_CHARS', '2000'))
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -49,10 +91,12 @@ class SettingsUpdate(BaseModel):
 class ThemeRequest(BaseModel):
     category: Optional[str] = None
     language: str = "fr"
+    fresh: bool = False  # bypass the response cache
 
 class IdeaRequest(BaseModel):
     theme: str
     language: str = "fr"
+    fresh: bool = False  # bypass the response cache
 
 class BookCreateRequest(BaseModel):
     title: str
@@ -73,6 +117,7 @@ class ChapterGenerateRequest(BaseModel):
 class ExportRequest(BaseModel):
     book_id: str
     format: str = "pdf"  # "pdf", "epub", "docx"
+    interior: str = "color"  # "color" or "bw" (grayscale images)
 
 # ====== HELPERS ======
 
@@ -80,16 +125,55 @@ def get_api_key():
     """Get the appropriate API key based on settings."""
     return os.environ.get('EMERGENT_LLM_KEY', '')
 
+# In-process settings cache. "local" trusts write-through only (single worker),
+# "version" re-reads the version stamp at most every SETTINGS_VERSION_CHECK_SECONDS,
+# "changestream" follows a Mongo change stream (requires a replica set).
+SETTINGS_SYNC_MODE = os.environ.get('SETTINGS_SYNC_MODE', 'local')
+SETTINGS_VERSION_CHECK_SECONDS = float(os.environ.get('SETTINGS_VERSION_CHECK_SECONDS', '5'))
+DEFAULT_SETTINGS = {
+    "api_key_source": "emergent",
+    "custom_api_key": None,
+    "image_source": "ai",
+    "language": "fr"
+}
+settings_cache: Dict[str, Any] = {"value": None, "version": None, "checked_at": 0.0}
+settings_watch_task = None
+
+def cache_settings(settings):
+    """Store a settings document in the in-process cache (None resets to defaults)."""
+    settings_cache["value"] = dict(settings) if settings else dict(DEFAULT_SETTINGS)
+    settings_cache["version"] = settings.get("version", 0) if settings else None
+    settings_cache["checked_at"] = time.monotonic()
+
 async def get_settings():
-    settings = await db.settings.find_one({}, {"_id": 0})
-    if not settings:
-        settings = {
-            "api_key_source": "emergent",
-            "custom_api_key": None,
-            "image_source": "ai",
-            "language": "fr"
-        }
-    return settings
+    if settings_cache["value"] is None:
+        cache_settings(await db.settings.find_one({}, {"_id": 0}))
+    elif (SETTINGS_SYNC_MODE == "version"
+          and time.monotonic() - settings_cache["checked_at"] > SETTINGS_VERSION_CHECK_SECONDS):
+        stamp = await db.settings.find_one({}, {"_id": 0, "version": 1})
+        current = stamp.get("version", 0) if stamp else None
+        if current != settings_cache["version"]:
+            cache_settings(await db.settings.find_one({}, {"_id": 0}))
+        else:
+            settings_cache["checked_at"] = time.monotonic()
+    return dict(settings_cache["value"])
+
+async def watch_settings():
+    """Keep the settings cache coherent with writes made by other workers."""
+    while True:
+        try:
+            async with db.settings.watch(full_document="updateLookup") as stream:
+                async for change in stream:
+                    full_doc = change.get("fullDocument")
+                    if full_doc:
+                        full_doc.pop("_id", None)
+                    cache_settings(full_doc)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Settings change stream interrupted: {e}")
+            settings_cache["value"] = None
+            await asyncio.sleep(5)
 
 async def get_active_api_key():
     settings = await get_settings()
@@ -97,101 +181,1356 @@ async def get_active_api_key():
         return settings["custom_api_key"], "gemini"
     return os.environ.get('EMERGENT_LLM_KEY', ''), "emergent"
 
-async def call_gemini(prompt, system_message="You are a helpful assistant.", session_id=None):
-    """Call Gemini via google.genai."""
+# Pooled google.genai clients, keyed by (api_key, api_version)
+GENAI_CLIENT_RETIRE_SECONDS = float(os.environ.get('GENAI_CLIENT_RETIRE_SECONDS', '300'))
+genai_clients: Dict[tuple, Any] = {}
+genai_clients_lock = asyncio.Lock()
+retired_genai_clients: Dict[int, Any] = {}
+
+async def close_genai_client(genai_client, delay=0):
+    """Close a genai client's HTTP connections, optionally after a grace period."""
+    if delay:
+        await asyncio.sleep(delay)
+    retired_genai_clients.pop(id(genai_client), None)
+    try:
+        await genai_client.aio.aclose()
+        genai_client.close()
+    except Exception as e:
+        logger.warning(f"Failed to close Gemini client: {e}")
+
+def retire_genai_clients(keep_api_key=None):
+    """Drop pooled clients for any other key; in-flight calls get a grace period before close."""
+    for key in [k for k in genai_clients if k[0] != keep_api_key]:
+        genai_client = genai_clients.pop(key)
+        retired_genai_clients[id(genai_client)] = (
+            genai_client,
+            asyncio.create_task(close_genai_client(genai_client, delay=GENAI_CLIENT_RETIRE_SECONDS)),
+        )
+
+async def get_genai_client(api_version=None):
+    """Return the shared genai client for the active API key, creating it on first use."""
     from google import genai
-    from google.genai import types
 
     api_key, _ = await get_active_api_key()
-    client = genai.Client(api_key=api_key)
+    genai_client = genai_clients.get((api_key, api_version))
+    if genai_client is None:
+        async with genai_clients_lock:
+            genai_client = genai_clients.get((api_key, api_version))
+            if genai_client is None:
+                http_options = {"api_version": api_version} if api_version else None
+                genai_client = genai.Client(api_key=api_key, http_options=http_options)
+                # The key changed since the pool was filled: retire the old clients
+                retire_genai_clients(keep_api_key=api_key)
+                genai_clients[(api_key, api_version)] = genai_client
+    return genai_client
+
+GEMINI_TEXT_MODEL = "gemini-2.0-flash"
+GEMINI_IMAGE_MODEL = "nano-banana-pro-preview"
+
+# ---- LLM call resilience ----
+# Every model call gets a per-attempt timeout, retries with full-jitter
+# exponential backoff on retryable errors (timeouts, connection errors, 408/429/
+# 5xx) within an optional overall deadline, and goes through a per-model circuit
+# breaker that fails fast while the provider keeps failing.
+LLM_CALL_TIMEOUT = float(os.environ.get('LLM_CALL_TIMEOUT', '180'))
+LLM_RETRY_ATTEMPTS = int(os.environ.get('LLM_RETRY_ATTEMPTS', '4'))
+LLM_RETRY_BASE_DELAY = float(os.environ.get('LLM_RETRY_BASE_DELAY', '2'))
+LLM_RETRY_MAX_DELAY = float(os.environ.get('LLM_RETRY_MAX_DELAY', '30'))
+LLM_BREAKER_THRESHOLD = int(os.environ.get('LLM_BREAKER_THRESHOLD', '5'))
+LLM_BREAKER_COOLDOWN = float(os.environ.get('LLM_BREAKER_COOLDOWN', '30'))
+LLM_RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a provider whose circuit is open."""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} is temporarily unavailable, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker.
+
+    After `threshold` retryable failures in a row the circuit opens and calls
+    fail fast for `cooldown` seconds. Then one probe call is let through: its
+    success closes the circuit, its failure opens it again.
+    """
+
+    def __init__(self, name, threshold=LLM_BREAKER_THRESHOLD, cooldown=LLM_BREAKER_COOLDOWN):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def retry_after(self):
+        """Seconds before calls are let through again (0 when closed or probing)."""
+        if self.opened_at is None:
+            return 0
+        return max(0.0, self.opened_at + self.cooldown - time.monotonic())
+
+    def before_call(self):
+        if self.opened_at is None:
+            return
+        wait = self.retry_after()
+        if wait > 0 or self.probing:
+            raise CircuitOpenError(self.name, wait or 1.0)
+        self.probing = True
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info(f"Circuit for {self.name} closed")
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.probing or (self.opened_at is None and self.failures >= self.threshold):
+            logger.warning(f"Circuit for {self.name} opened for {self.cooldown:.0f}s after {self.failures} failure(s)")
+            self.opened_at = time.monotonic()
+        self.probing = False
+
+    def release_probe(self):
+        """The probe was cancelled without an outcome: let another call probe."""
+        self.probing = False
+
+llm_breakers: Dict[str, CircuitBreaker] = {}
+
+def llm_breaker(model):
+    if model not in llm_breakers:
+        llm_breakers[model] = CircuitBreaker(model)
+    return llm_breakers[model]
+
+def llm_unavailable(e):
+    """503 for a shed call, telling the client when to try again."""
+    return HTTPException(status_code=503, detail=str(e),
+                         headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))})
+
+@app.exception_handler(CircuitOpenError)
+async def circuit_open_handler(request: Request, exc: CircuitOpenError):
+    return await http_exception_handler(request, llm_unavailable(exc))
+
+def is_retryable_llm_error(exc):
+    import httpx
+    from google.genai import errors
+    
+    if isinstance(exc, errors.APIError):
+        return exc.code in LLM_RETRYABLE_STATUS
+    return isinstance(exc, (asyncio.TimeoutError, httpx.TransportError, aiohttp.ClientError, ConnectionError))
+
+async def resilient_llm_call(call, model, deadline=None):
+    """Await call() (a coroutine function) with timeout, retries and the model's
+    circuit breaker. deadline is a time.monotonic() value bounding all attempts."""
+    breaker = llm_breaker(model)
+    for attempt in range(1, LLM_RETRY_ATTEMPTS + 1):
+        timeout = LLM_CALL_TIMEOUT
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.monotonic())
+            if timeout <= 0:
+                raise TimeoutError(f"{model} call deadline exceeded")
+        breaker.before_call()
+        try:
+            result = await asyncio.wait_for(call(), timeout)
+        except asyncio.CancelledError:
+            breaker.release_probe()
+            raise
+        except Exception as e:
+            if not is_retryable_llm_error(e):
+                # The provider answered: a bad request says nothing about its health
+                breaker.record_success()
+                raise
+            breaker.record_failure()
+            delay = random.uniform(0, min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+            if breaker.retry_after():
+                # This failure opened the circuit: shed like the calls that follow
+                raise CircuitOpenError(model, breaker.retry_after()) from e
+            if attempt == LLM_RETRY_ATTEMPTS or (deadline is not None and time.monotonic() + delay >= deadline):
+                raise
+            logger.warning(f"{model} call failed ({e!r}); retry {attempt}/{LLM_RETRY_ATTEMPTS - 1} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+        else:
+            breaker.record_success()
+            return result
+
+# ---- LLM response cache ----
+# Prompts whose answer only depends on their inputs (theme discovery, ideas) can
+# be served from a cache keyed by hash(model, system message, prompt): an LRU in
+# memory, backed by the llm_cache collection (expired by a TTL index) so that
+# all workers share it when LLM_CACHE_PERSIST is on. TTLs are per endpoint.
+LLM_CACHE_SIZE = int(os.environ.get('LLM_CACHE_SIZE', '256'))
+LLM_CACHE_PERSIST = os.environ.get('LLM_CACHE_PERSIST', '1') == '1'
+THEMES_CACHE_TTL = int(os.environ.get('THEMES_CACHE_TTL', '21600'))
+IDEAS_CACHE_TTL = int(os.environ.get('IDEAS_CACHE_TTL', '86400'))
+llm_cache: "OrderedDict[str, tuple]" = OrderedDict()
+
+def llm_cache_key(prompt, system_message, model=GEMINI_TEXT_MODEL):
+    raw = json.dumps([model, system_message, prompt], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def remember_llm_response(key, text, expires_at):
+    llm_cache[key] = (expires_at, text)
+    llm_cache.move_to_end(key)
+    while len(llm_cache) > LLM_CACHE_SIZE:
+        llm_cache.popitem(last=False)
+
+async def cached_llm_response(key):
+    """Unexpired cached response text, or None."""
+    entry = llm_cache.get(key)
+    if entry:
+        if entry[0] > time.time():
+            llm_cache.move_to_end(key)
+            return entry[1]
+        del llm_cache[key]
+    if not LLM_CACHE_PERSIST:
+        return None
+    try:
+        # The TTL monitor only runs once a minute: check expiry here too
+        doc = await db.llm_cache.find_one({"key": key, "expires_at": {"$gt": datetime.now(timezone.utc)}}, {"_id": 0})
+    except Exception as e:
+        logger.warning(f"LLM cache lookup failed: {e}")
+        return None
+    if not doc:
+        return None
+    expires_at = doc["expires_at"].replace(tzinfo=timezone.utc).timestamp()
+    remember_llm_response(key, doc["text"], expires_at)
+    return doc["text"]
+
+async def store_llm_response(key, text, ttl):
+    expires_at = time.time() + ttl
+    remember_llm_response(key, text, expires_at)
+    if LLM_CACHE_PERSIST:
+        try:
+            await db.llm_cache.replace_one(
+                {"key": key},
+                {"key": key, "text": text, "expires_at": datetime.fromtimestamp(expires_at, timezone.utc)},
+                upsert=True
+            )
+        except Exception as e:
+            logger.warning(f"LLM cache write failed: {e}")
+
+async def forget_llm_response(prompt, system_message):
+    """Drop a cached response, e.g. one the caller could not parse."""
+    key = llm_cache_key(prompt, system_message)
+    llm_cache.pop(key, None)
+    if LLM_CACHE_PERSIST:
+        try:
+            await db.llm_cache.delete_one({"key": key})
+        except Exception as e:
+            logger.warning(f"LLM cache delete failed: {e}")
+
+async def call_gemini(prompt, system_message="You are a helpful assistant.", session_id=None, cache_ttl=None, fresh=False,
+                      response_mime_type=None, deadline=None):
+    """Call Gemini via google.genai.
 
-    response = await client.aio.models.generate_content(
-        model="gemini-2.0-flash",
-        contents=prompt,
-        config=types.GenerateContentConfig(system_instruction=system_message)
+    With cache_ttl (seconds), the response is cached for that long and served
+    from the cache on later identical calls; fresh=True skips the lookup but
+    still caches the new response. response_mime_type="application/json"
+    asks for structured JSON output. deadline: see resilient_llm_call.
+    """
+    from google.genai import types
+
+    cache_key = llm_cache_key(prompt, system_message) if cache_ttl else None
+    if cache_key and not fresh:
+        cached = await cached_llm_response(cache_key)
+        if cached is not None:
+            return cached
+
+    genai_client = await get_genai_client()
+
+    response = await resilient_llm_call(
+        lambda: genai_client.aio.models.generate_content(
+            model=GEMINI_TEXT_MODEL,
+            contents=prompt,
+            config=types.GenerateContentConfig(system_instruction=system_message, response_mime_type=response_mime_type)
+        ),
+        GEMINI_TEXT_MODEL, deadline
     )
+    if cache_key and response.text:
+        await store_llm_response(cache_key, response.text, cache_ttl)
     return response.text
 
-async def generate_image_ai(prompt, book_id, image_name):
-    """Generate a photorealistic image using Nano Banana."""
-    from google import genai
+async def stream_gemini(prompt, system_message="You are a helpful assistant."):
+    """Stream Gemini output as text chunks as soon as they are produced."""
     from google.genai import types
 
-    api_key, _ = await get_active_api_key()
-    client = genai.Client(api_key=api_key, http_options={"api_version": "v1alpha"})
+    genai_client = await get_genai_client()
+
+    # Only opening the stream is retried; the caller checkpoints partial output
+    stream = await resilient_llm_call(
+        lambda: genai_client.aio.models.generate_content_stream(
+            model=GEMINI_TEXT_MODEL,
+            contents=prompt,
+            config=types.GenerateContentConfig(system_instruction=system_message)
+        ),
+        GEMINI_TEXT_MODEL
+    )
+    async for chunk in stream:
+        if chunk.text:
+            yield chunk.text
+
+async def generate_image_ai(prompt):
+    """Generate a photorealistic image using Nano Banana; returns its image store URL."""
+    from google.genai import types
+
+    genai_client = await get_genai_client(api_version="v1alpha")
 
     full_prompt = "Photorealistic professional photograph, ultra-realistic, natural lighting, NO cartoon, NO illustration. " + prompt
 
-    response = await client.aio.models.generate_content(
-        model="nano-banana-pro-preview",
-        contents=full_prompt,
-        config=types.GenerateContentConfig(response_modalities=["image", "text"])
+    response = await resilient_llm_call(
+        lambda: genai_client.aio.models.generate_content(
+            model=GEMINI_IMAGE_MODEL,
+            contents=full_prompt,
+            config=types.GenerateContentConfig(response_modalities=["image", "text"])
+        ),
+        GEMINI_IMAGE_MODEL
     )
 
     for part in response.candidates[0].content.parts:
         if part.inline_data and part.inline_data.mime_type.startswith("image/"):
-            img_data = part.inline_data.data
-            img_path = IMAGES_DIR / f"{book_id}_{image_name}.png"
-            with open(img_path, "wb") as f:
-                f.write(img_data)
-            return str(img_path), base64.b64encode(img_data).decode("utf-8")[:50]
-    return None, None
-
-async def generate_stock_search_query(chapter_title, chapter_content, book_title):
-    """Use AI to generate the best stock photo search query for a chapter."""
-    try:
-        prompt = f"""Based on this book chapter, generate a single short search query (2-4 words) to find a relevant stock photo.
+            return await store_image_bytes(part.inline_data.data)
+    return None
+
+# Stock photo search queries are generated for many chapters per LLM call and
+# memoized on the chapter as stock_query {"query", "source_hash"}; the hash of
+# what the query was derived from invalidates it when the chapter is rewritten.
+STOCK_QUERY_BATCH_SIZE = int(os.environ.get('STOCK_QUERY_BATCH_SIZE', '40'))
+
+def stock_query_source_hash(book_title, chapter):
+    raw = json.dumps([book_title, chapter.get("title", ""), (chapter.get("content") or "")[:500]], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+def clean_stock_query(query):
+    # Ensure it's short enough
+    return " ".join(str(query).strip().strip('"').strip("'").split()[:4])
+
+async def generate_stock_search_queries(book_title, chapters):
+    """Ask for every chapter's stock photo search query in one call; returns
+    {chapter_number: query} for the chapters the response covered."""
+    listing = json.dumps([
+        {"chapter": ch["chapter_number"], "title": ch.get("title", ""), "excerpt": (ch.get("content") or "")[:500]}
+        for ch in chapters
+    ], ensure_ascii=False)
+    prompt = f"""For each chapter of this book, generate a single short search query (2-4 words) to find a relevant stock photo.
 Book: {book_title}
-Chapter: {chapter_title}
-Content excerpt: {chapter_content[:500]}
-
-Return ONLY the search query, nothing else. Example: "meditation sunrise nature" or "kitchen cooking vegetables" """
-        response = await call_gemini(prompt, "Return only a short stock photo search query, no explanation.")
-        query = response.strip().strip('"').strip("'")
-        # Ensure it's short enough
-        words = query.split()[:4]
-        return " ".join(words)
-    except Exception:
-        return chapter_title
+Chapters (JSON): {listing}
+
+Return ONLY a JSON object mapping each chapter number to its query. Example: {{"1": "meditation sunrise nature", "2": "kitchen cooking vegetables"}}"""
+    response = await call_gemini(prompt, "Return only stock photo search queries as JSON, no explanation.",
+                                 response_mime_type="application/json")
+    cleaned = response.strip()
+    if cleaned.startswith("```"):
+        cleaned = cleaned.split("\n", 1)[1] if "\n" in cleaned else cleaned[3:]
+        cleaned = cleaned.rsplit("```", 1)[0]
+    queries = {}
+    for number, query in json.loads(cleaned).items():
+        if str(number).isdigit() and clean_stock_query(query):
+            queries[int(number)] = clean_stock_query(query)
+    return queries
+
+async def stock_search_queries(book, chapters):
+    """Stock photo search query per chapter number.
+
+    Memoized queries are reused; the others are generated in batched calls and
+    stored on the chapters (and on the given chapter dicts). A chapter whose
+    query cannot be generated falls back to its title, which is not stored.
+    """
+    book_title = book.get("title", "")
+    queries = {}
+    missing = []
+    for ch in chapters:
+        memo = ch.get("stock_query") or {}
+        if memo.get("query") and memo.get("source_hash") == stock_query_source_hash(book_title, ch):
+            queries[ch["chapter_number"]] = memo["query"]
+        else:
+            missing.append(ch)
+    
+    for start in range(0, len(missing), STOCK_QUERY_BATCH_SIZE):
+        batch = missing[start:start + STOCK_QUERY_BATCH_SIZE]
+        try:
+            generated = await generate_stock_search_queries(book_title, batch)
+        except Exception as e:
+            logger.error(f"Stock query generation failed for {len(batch)} chapter(s): {e}")
+            generated = {}
+        ops = []
+        for ch in batch:
+            query = generated.get(ch["chapter_number"])
+            if query:
+                ch["stock_query"] = {"query": query, "source_hash": stock_query_source_hash(book_title, ch)}
+                ops.append(UpdateOne({"book_id": book["id"], "chapter_number": ch["chapter_number"]},
+                                     {"$set": {"stock_query": ch["stock_query"]}}))
+            queries[ch["chapter_number"]] = query or ch.get("title", "")
+        if ops:
+            await db.chapters.bulk_write(ops, ordered=False)
+    return queries
+
+http_session: Optional[aiohttp.ClientSession] = None
+
+def get_http_session():
+    """The shared outbound session (connection pooling, cached DNS lookups)."""
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, ttl_dns_cache=HTTP_DNS_CACHE_SECONDS)
+        http_session = aiohttp.ClientSession(connector=connector)
+    return http_session
+
+async def hedged(attempts, delay, discard=None):
+    """Run attempts (coroutine functions) staggered by delay seconds.
+
+    Each attempt starts when the previous ones have all failed or the latest has
+    run for delay seconds (delay < 0: only on failure). The first non-None
+    result is returned and attempts still running are cancelled; discard is
+    called on any other result that completed meanwhile.
+    """
+    pending = set()
+    winner = None
+    try:
+        for i, attempt in enumerate(attempts):
+            pending.add(asyncio.ensure_future(attempt()))
+            last = i == len(attempts) - 1
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=None if last or delay < 0 else delay,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    result = None if task.cancelled() or task.exception() else task.result()
+                    if result is None:
+                        continue
+                    if winner is None:
+                        winner = result
+                    elif discard:
+                        await discard(result)
+                if winner is not None or not done:
+                    break
+            if winner is not None:
+                return winner
+        return None
+    finally:
+        for task in pending:
+            task.cancel()
+        for result in await asyncio.gather(*pending, return_exceptions=True):
+            if result is not None and not isinstance(result, BaseException) and discard:
+                await discard(result)
+
+async def fetch_stock_candidate(name, url, timeout):
+    """Download one provider's image to a staging file; returns its writer or None."""
+    try:
+        async with get_http_session().get(url, timeout=aiohttp.ClientTimeout(total=timeout), allow_redirects=True) as resp:
+            if resp.status == 200 and 'image' in resp.content_type:
+                return await stage_image_download(resp)
+            logger.error(f"{name} stock image: HTTP {resp.status} ({resp.content_type})")
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"{name} stock image error: {e!r}")
+    return None
 
-async def fetch_stock_image(query, book_id, image_name):
-    """Fetch image from free stock sources and save locally."""
+async def discard_staged_image(writer):
+    await run_asset_io(writer.path.unlink, True)
+
+async def fetch_stock_image(query):
+    """Fetch image from free stock sources into the image store; returns its URL."""
     import urllib.parse
     
-    encoded_query = urllib.parse.quote(query)
-    
-    # Use Unsplash Source (no API key needed) - downloads directly
-    unsplash_url = f"https://source.unsplash.com/800x600/?{encoded_query}"
-    
-    async with aiohttp.ClientSession() as session:
+    primary_url = STOCK_PRIMARY_URL.format(query=urllib.parse.quote(query))
+    fallback_url = STOCK_FALLBACK_URL.format(query=urllib.parse.quote(query))
+    writer = await hedged(
+        [lambda: fetch_stock_candidate("Primary", primary_url, STOCK_PRIMARY_TIMEOUT),
+         lambda: fetch_stock_candidate("Fallback", fallback_url, STOCK_FALLBACK_TIMEOUT)],
+        STOCK_HEDGE_DELAY,
+        discard=discard_staged_image
+    )
+    return await store_staged_image(writer) if writer else None
+
+# ====== ASSET WRITES ======
+# Image and export files are written on a dedicated thread pool, never on the
+# event loop. Writes go to a temp file next to the target, renamed into place
+# only when complete, so readers never see a partial file.
+ASSET_IO_WORKERS = int(os.environ.get('ASSET_IO_WORKERS', '4'))
+ASSET_CHUNK_SIZE = 256 * 1024
+asset_io_pool = ThreadPoolExecutor(max_workers=ASSET_IO_WORKERS, thread_name_prefix="asset-io")
+
+async def run_asset_io(func, *args):
+    """Run blocking file-system work on the asset I/O pool."""
+    return await asyncio.get_running_loop().run_in_executor(asset_io_pool, func, *args)
+
+class AssetWriter:
+    """Streaming atomic writer, used as `async with AssetWriter(path) as w: await w.write(chunk)`.
+
+    Leaving the block normally renames the temp file onto `path`; an exception or
+    discard() removes it. `size` and `sha256` describe the bytes written.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.tmp_path = self.path.with_name(f".{self.path.name}.{uuid.uuid4().hex}.part")
+        self.size = 0
+        self.hasher = hashlib.sha256()
+        self.file = None
+        self.discarded = False
+
+    async def __aenter__(self):
+        opening = asyncio.ensure_future(run_asset_io(open, self.tmp_path, "wb"))
         try:
-            # Unsplash Source redirects to an actual image
-            async with session.get(unsplash_url, timeout=aiohttp.ClientTimeout(total=20), allow_redirects=True) as resp:
-                if resp.status == 200 and 'image' in resp.content_type:
-                    img_data = await resp.read()
-                    if len(img_data) > 1000:  # Ensure we got a real image
-                        img_path = IMAGES_DIR / f"{book_id}_{image_name}.png"
-                        with open(img_path, "wb") as f:
-                            f.write(img_data)
-                        return f"/api/images/{book_id}_{image_name}.png"
-        except Exception as e:
-            logger.error(f"Unsplash fetch error: {e}")
+            self.file = await asyncio.shield(opening)
+        except asyncio.CancelledError:
+            # __aexit__ will not run: remove the file once the open completes
+            self.file = await opening
+            await run_asset_io(self._finish, False)
+            raise
+        return self
+
+    async def write(self, data):
+        self.hasher.update(data)
+        self.size += len(data)
+        await run_asset_io(self.file.write, data)
+
+    def discard(self):
+        self.discarded = True
+
+    @property
+    def sha256(self):
+        return self.hasher.hexdigest()
+
+    def _finish(self, commit):
+        try:
+            self.file.close()
+            if commit:
+                os.replace(self.tmp_path, self.path)
+        finally:
+            self.tmp_path.unlink(missing_ok=True)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await run_asset_io(self._finish, exc_type is None and not self.discarded)
+        return False
+
+async def write_asset(path, data):
+    """Atomically write a complete blob; returns its SHA-256."""
+    async with AssetWriter(path) as writer:
+        await writer.write(data)
+    return writer.sha256
+
+async def download_asset(resp, path, min_size=1000):
+    """Stream an aiohttp response body to path; anything under min_size bytes
+    (an error page rather than an image) is discarded. Returns the writer, or
+    None if nothing was saved."""
+    async with AssetWriter(path) as writer:
+        async for chunk in resp.content.iter_chunked(ASSET_CHUNK_SIZE):
+            await writer.write(chunk)
+        if writer.size <= min_size:
+            writer.discard()
+    return None if writer.discarded else writer
+
+# ====== ASSET STORAGE ======
+# Images and exports are persisted through a storage backend. Every node works
+# on local copies under IMAGES_DIR and EXPORTS_DIR (renderers read plain files).
+# With STORAGE_BACKEND=s3 those folders are only a cache of the bucket, so several
+# replicas share assets, and downloads are redirected to presigned URLs instead of
+# streaming through this process. The bucket needs a CORS rule allowing GET from
+# the frontend origin for image redirects.
+# The local cache grows with every asset a node touches; STORAGE_CACHE_MAX_MB
+# bounds it by evicting the least recently used copies already in the bucket
+# (0 keeps everything). When switching an existing deployment to S3, upload the
+# local assets first with `python storage_backfill.py`.
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'local')
+S3_BUCKET = os.environ.get('S3_BUCKET', '')
+S3_PREFIX = os.environ.get('S3_PREFIX', '')
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL') or None
+S3_REGION = os.environ.get('S3_REGION') or None
+S3_PRESIGN_SECONDS = int(os.environ.get('S3_PRESIGN_SECONDS', '900'))
+S3_REDIRECTS = os.environ.get('S3_REDIRECTS', '1') == '1'
+STORAGE_KNOWN_KEYS = 10000
+STORAGE_CACHE_MAX_MB = int(os.environ.get('STORAGE_CACHE_MAX_MB', '0'))
+# Recently written or read copies are kept whatever the size, so a renderer never
+# loses a file it has just fetched
+STORAGE_CACHE_MIN_AGE = int(os.environ.get('STORAGE_CACHE_MIN_AGE', '900'))
+STORAGE_CACHE_TRIM_SECONDS = int(os.environ.get('STORAGE_CACHE_TRIM_SECONDS', '300'))
+storage_cache_task = None
+
+def storage_key(path):
+    """Backend-neutral key of a local asset path, e.g. images/derived/x.web.jpg."""
+    return Path(path).relative_to(ROOT_DIR).as_posix()
+
+class LocalStorage:
+    """Assets live in the local folders only."""
+    redirects = False
+
+    async def publish(self, path, media_type=None, immutable=False):
+        pass
+
+    async def fetch(self, path):
+        """Make sure the asset has a local copy; returns False if it does not exist."""
+        return await run_asset_io(Path(path).is_file)
+
+    async def exists(self, path):
+        return await run_asset_io(Path(path).is_file)
+
+    async def delete(self, path):
+        await run_asset_io(Path(path).unlink, True)
+
+    async def list(self, directory, prefix):
+        return await run_asset_io(lambda: sorted(Path(directory).glob(f"{glob_escape(prefix)}*")))
+
+    def presigned_url(self, path, filename=None, media_type=None):
+        return None
+
+class S3Storage:
+    """S3-compatible bucket behind a local write-through cache.
+
+    Transfers go through boto3's managed (multipart, streamed) upload_file and
+    download_file on the asset I/O pool. Keys seen in the bucket are remembered,
+    so repeated existence checks of immutable assets skip the round trip.
+    """
+    redirects = S3_REDIRECTS
+
+    def __init__(self, bucket, prefix="", endpoint_url=None, region=None):
+        import boto3
+        from botocore.config import Config
+        
+        if not bucket:
+            raise RuntimeError("STORAGE_BACKEND=s3 requires S3_BUCKET")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client("s3", endpoint_url=endpoint_url, region_name=region,
+                                   config=Config(max_pool_connections=max(10, ASSET_IO_WORKERS * 2)))
+        self.known = OrderedDict()
+
+    def key(self, path):
+        return f"{self.prefix}{storage_key(path)}"
+
+    def remember(self, key):
+        self.known[key] = True
+        self.known.move_to_end(key)
+        while len(self.known) > STORAGE_KNOWN_KEYS:
+            self.known.popitem(last=False)
+
+    async def publish(self, path, media_type=None, immutable=False):
+        """Upload a local asset to the bucket."""
+        extra = {"ContentType": media_type or "application/octet-stream"}
+        if immutable:
+            extra["CacheControl"] = IMAGE_CACHE_IMMUTABLE
+        key = self.key(path)
+        await run_asset_io(lambda: self.client.upload_file(str(path), self.bucket, key, ExtraArgs=extra))
+        self.remember(key)
+
+    async def fetch(self, path):
+        path = Path(path)
+        if await run_asset_io(path.is_file):
+            return True
+        key = self.key(path)
+        tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.part")
+        
+        def download():
+            from botocore.exceptions import ClientError
+            try:
+                self.client.download_file(self.bucket, key, str(tmp_path))
+                os.replace(tmp_path, path)
+            except ClientError as e:
+                if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey"):
+                    return False
+                raise
+            finally:
+                tmp_path.unlink(missing_ok=True)
+            return True
+        found = await run_asset_io(download)
+        if found:
+            self.remember(key)
+        return found
+
+    async def exists(self, path):
+        key = self.key(path)
+        if key in self.known:
+            return True
+        
+        def head():
+            from botocore.exceptions import ClientError
+            try:
+                self.client.head_object(Bucket=self.bucket, Key=key)
+            except ClientError as e:
+                if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                    return False
+                raise
+            return True
+        found = await run_asset_io(head)
+        if found:
+            self.remember(key)
+        return found
+
+    async def delete(self, path):
+        """Delete the object and the local copy."""
+        key = self.key(path)
+        self.known.pop(key, None)
+        await run_asset_io(lambda: self.client.delete_object(Bucket=self.bucket, Key=key))
+        await run_asset_io(Path(path).unlink, True)
+
+    async def list(self, directory, prefix):
+        """Local paths of the assets in directory whose name starts with prefix,
+        whether stored in the bucket or only cached locally."""
+        key_prefix = f"{self.key(directory)}/{prefix}"
+        
+        def scan():
+            names = {p.name for p in Path(directory).glob(f"{glob_escape(prefix)}*")}
+            for page in self.client.get_paginator("list_objects_v2").paginate(Bucket=self.bucket, Prefix=key_prefix):
+                for obj in page.get("Contents", []):
+                    name = obj["Key"][len(key_prefix) - len(prefix):]
+                    if "/" not in name:
+                        names.add(name)
+            return [Path(directory) / name for name in sorted(names)]
+        return await run_asset_io(scan)
+
+    async def stored_names(self, directory):
+        """Names of the objects stored directly under directory."""
+        key_prefix = f"{self.key(directory)}/"
         
-        # Fallback: Use Lorem Picsum (always works)
+        def scan():
+            names = set()
+            for page in self.client.get_paginator("list_objects_v2").paginate(Bucket=self.bucket, Prefix=key_prefix):
+                for obj in page.get("Contents", []):
+                    name = obj["Key"][len(key_prefix):]
+                    if "/" not in name:
+                        names.add(name)
+            return names
+        return await run_asset_io(scan)
+
+    async def trim_cache(self, directories, max_bytes, min_age=STORAGE_CACHE_MIN_AGE):
+        """Evict the least recently used local copies until the cache fits in
+        max_bytes; only copies of objects stored in the bucket are evicted.
+        Returns the number of files evicted."""
+        def scan():
+            files = []
+            for directory in directories:
+                for path in Path(directory).iterdir():
+                    if path.is_file() and not path.name.startswith("."):
+                        st = path.stat()
+                        files.append((max(st.st_atime, st.st_mtime), st.st_size, path))
+            return sorted(files, key=lambda f: f[0])
+        files = await run_asset_io(scan)
+        total = sum(size for _, size, _ in files)
+        cutoff = time.time() - min_age
+        evicted = 0
+        for used_at, size, path in files:
+            if total <= max_bytes or used_at > cutoff:
+                break
+            if await self.exists(path):
+                await run_asset_io(path.unlink, True)
+                total -= size
+                evicted += 1
+        return evicted
+
+    def presigned_url(self, path, filename=None, media_type=None):
+        params = {"Bucket": self.bucket, "Key": self.key(path)}
+        if filename:
+            params["ResponseContentDisposition"] = f'attachment; filename="{filename}"'
+        if media_type:
+            params["ResponseContentType"] = media_type
+        return self.client.generate_presigned_url("get_object", Params=params, ExpiresIn=S3_PRESIGN_SECONDS)
+
+def glob_escape(name):
+    return re.sub(r'([*?\[])', r'[\1]', name)
+
+def make_storage():
+    if STORAGE_BACKEND == "s3":
+        return S3Storage(S3_BUCKET, S3_PREFIX, S3_ENDPOINT_URL, S3_REGION)
+    if STORAGE_BACKEND != "local":
+        raise RuntimeError(f"Unknown STORAGE_BACKEND: {STORAGE_BACKEND}")
+    return LocalStorage()
+
+storage = make_storage()
+
+def redirect_to_storage(url):
+    """Temporary redirect to a presigned URL, cacheable for half its lifetime."""
+    return RedirectResponse(url, status_code=307,
+                            headers={"Cache-Control": f"private, max-age={S3_PRESIGN_SECONDS // 2}"})
+
+async def backfill_storage(dry_run=False):
+    """Upload the local images, variants and exports missing from the bucket,
+    e.g. after switching an existing deployment to STORAGE_BACKEND=s3."""
+    stats = {"uploaded": 0, "present": 0, "bytes": 0}
+    if isinstance(storage, LocalStorage):
+        return stats
+    for directory in (IMAGES_DIR, DERIVED_IMAGES_DIR, EXPORTS_DIR):
+        stored = await storage.stored_names(directory)
+        files = await run_asset_io(lambda: sorted(
+            p for p in directory.iterdir()
+            if p.is_file() and not p.name.startswith(".") and p.suffix != ".part"
+        ))
+        for path in files:
+            if path.name in stored:
+                stats["present"] += 1
+                continue
+            if directory == EXPORTS_DIR:
+                media_type, immutable = EXPORT_MEDIA_TYPES.get(path.suffix[1:]), False
+            elif directory == DERIVED_IMAGES_DIR:
+                media_type, immutable = "image/jpeg", True
+            else:
+                media_type = await run_asset_io(sniff_image_type, path)
+                immutable = bool(IMAGE_BLOB_RE.match(path.name))
+            if not dry_run:
+                await storage.publish(path, media_type, immutable=immutable)
+            stats["uploaded"] += 1
+            stats["bytes"] += path.stat().st_size
+    logger.info(f"Storage backfill: {stats}")
+    return stats
+
+async def trim_storage_cache():
+    """Keep the local cache of the bucket under STORAGE_CACHE_MAX_MB, until cancelled."""
+    while True:
         try:
-            picsum_url = f"https://picsum.photos/800/600"
-            async with session.get(picsum_url, timeout=aiohttp.ClientTimeout(total=15), allow_redirects=True) as resp:
-                if resp.status == 200:
-                    img_data = await resp.read()
-                    if len(img_data) > 1000:
-                        img_path = IMAGES_DIR / f"{book_id}_{image_name}.png"
-                        with open(img_path, "wb") as f:
-                            f.write(img_data)
-                        return f"/api/images/{book_id}_{image_name}.png"
+            evicted = await storage.trim_cache((IMAGES_DIR, DERIVED_IMAGES_DIR, EXPORTS_DIR),
+                                               STORAGE_CACHE_MAX_MB * 1024 * 1024)
+            if evicted:
+                logger.info(f"Evicted {evicted} cached asset(s)")
         except Exception as e:
-            logger.error(f"Picsum fetch error: {e}")
+            logger.error(f"Storage cache trim failed: {e}")
+        await asyncio.sleep(STORAGE_CACHE_TRIM_SECONDS)
+
+# ====== IMAGE STORE ======
+# Images are stored once per content as IMAGES_DIR/{sha256}{ext}, so their URLs
+# never change meaning. The image_blobs collection counts the chapters referencing
+# each blob; released blobs are deleted by the GC once unreferenced for
+# IMAGE_GC_GRACE_SECONDS. Legacy {book_id}_ch{n}.png files belong to a single
+# chapter and are still deleted as soon as it lets go of them.
+IMAGE_GC_GRACE_SECONDS = int(os.environ.get('IMAGE_GC_GRACE_SECONDS', '3600'))
+IMAGE_BLOB_RE = re.compile(r'^([0-9a-f]{64})\.(png|jpg|gif|webp)$')
+IMAGE_EXTENSIONS = {"image/png": ".png", "image/jpeg": ".jpg", "image/gif": ".gif", "image/webp": ".webp"}
+# refs value marking a blob being deleted by the GC
+IMAGE_BLOB_COLLECTING = -(1 << 30)
+
+def image_blob_digest(url):
+    """Digest of an image store URL, or None for legacy and external URLs."""
+    path = local_image_path(url)
+    match = IMAGE_BLOB_RE.match(path.name) if path else None
+    return match.group(1) if match else None
+
+async def acquire_image_blob(digest, filename, size, media_type):
+    """Take a reference on a blob, registering it if needed; returns True when
+    the blob was not registered yet (its file must then be written)."""
+    for _ in range(100):
+        try:
+            before = await db.image_blobs.find_one_and_update(
+                {"digest": digest},
+                {"$inc": {"refs": 1}, "$unset": {"released_at": ""},
+                 "$setOnInsert": {"filename": filename, "size": size, "media_type": media_type,
+                                  "created_at": datetime.now(timezone.utc).isoformat()}},
+                projection={"_id": 0, "refs": 1},
+                upsert=True,
+                return_document=ReturnDocument.BEFORE
+            )
+        except DuplicateKeyError:
+            continue  # registered concurrently; take the reference on the next round
+        if before is None:
+            return True
+        if before["refs"] >= 0:
+            return False
+        # The GC is deleting this blob: hand the reference back and register it again afterwards
+        await db.image_blobs.update_one({"digest": digest}, {"$inc": {"refs": -1}})
+        await asyncio.sleep(0.05)
+    raise RuntimeError(f"Image blob {digest} stayed locked by the GC")
+
+async def store_image_bytes(data):
+    """Store an image and take a reference on it; returns its URL."""
+    digest = await run_asset_io(lambda: hashlib.sha256(data).hexdigest())
+    media_type = sniff_image_bytes(data[:16])
+    filename = f"{digest}{IMAGE_EXTENSIONS.get(media_type, '.png')}"
+    path = IMAGES_DIR / filename
+    url = f"/api/images/{filename}"
+    created = await acquire_image_blob(digest, filename, len(data), media_type)
+    try:
+        if created or not await storage.exists(path):
+            await write_asset(path, data)
+            await storage.publish(path, media_type, immutable=True)
+    except BaseException:
+        # Hand the reference back so the GC can clear whatever was written
+        await asyncio.shield(release_image(url))
+        raise
+    return url
+
+async def stage_image_download(resp):
+    """Stream an image download to a staging file; returns its writer, or None
+    if the body was too small to be an image."""
+    return await download_asset(resp, IMAGES_DIR / f".staging-{uuid.uuid4().hex}")
+
+async def store_staged_image(writer):
+    """Move a staged download into the store and take a reference; returns its URL."""
+    staging = writer.path
+    try:
+        media_type = await run_asset_io(sniff_image_type, staging)
+        filename = f"{writer.sha256}{IMAGE_EXTENSIONS.get(media_type, '.png')}"
+        path = IMAGES_DIR / filename
+        url = f"/api/images/{filename}"
+        created = await acquire_image_blob(writer.sha256, filename, writer.size, media_type)
+        try:
+            if created or not await storage.exists(path):
+                await run_asset_io(os.replace, staging, path)
+                await storage.publish(path, media_type, immutable=True)
+        except BaseException:
+            await asyncio.shield(release_image(url))
+            raise
+        return url
+    finally:
+        staging.unlink(missing_ok=True)
+
+async def delete_image(path):
+    """Delete an image and its variants from storage."""
+    for variant in await storage.list(DERIVED_IMAGES_DIR, f"{path.stem}."):
+        await storage.delete(variant)
+    await storage.delete(path)
+
+async def release_image(url):
+    """Drop one chapter's reference to an image."""
+    path = local_image_path(url)
+    if not path:
+        return
+    digest = image_blob_digest(url)
+    if digest:
+        await db.image_blobs.update_one(
+            {"digest": digest, "refs": {"$gt": 0}},
+            {"$inc": {"refs": -1}, "$set": {"released_at": datetime.now(timezone.utc).isoformat()}}
+        )
+    else:
+        await delete_image(path)
+
+async def collect_image_blobs(grace_seconds=IMAGE_GC_GRACE_SECONDS, dry_run=False):
+    """Delete blobs unreferenced for longer than grace_seconds.
+
+    A blob is only deleted after checking that no chapter still points at it
+    (its count is repaired otherwise), and it is locked while its file is removed
+    so that a concurrent upload of the same image waits and re-creates it.
+    """
+    cutoff = datetime.fromtimestamp(time.time() - grace_seconds, timezone.utc).isoformat()
+    stats = {"candidates": 0, "deleted": 0, "freed_bytes": 0, "repaired": 0}
+    candidates = await db.image_blobs.find(
+        {"refs": {"$lte": 0, "$gt": IMAGE_BLOB_COLLECTING}, "released_at": {"$lt": cutoff}},
+        {"_id": 0}
+    ).to_list(None)
+    for blob in candidates:
+        stats["candidates"] += 1
+        url = f"/api/images/{blob['filename']}"
+        in_use = await db.chapters.count_documents({"image_url": url})
+        if in_use:
+            if not dry_run:
+                await db.image_blobs.update_one({"digest": blob["digest"], "refs": blob["refs"]}, {"$set": {"refs": in_use}})
+            stats["repaired"] += 1
+            continue
+        if dry_run:
+            stats["freed_bytes"] += blob.get("size", 0)
+            continue
+        locked = await db.image_blobs.find_one_and_update(
+            {"digest": blob["digest"], "refs": {"$lte": 0, "$gt": IMAGE_BLOB_COLLECTING}},
+            {"$inc": {"refs": IMAGE_BLOB_COLLECTING}}
+        )
+        if not locked:
+            continue  # referenced again meanwhile
+        await delete_image(IMAGES_DIR / blob["filename"])
+        await db.image_blobs.delete_one({"digest": blob["digest"]})
+        stats["deleted"] += 1
+        stats["freed_bytes"] += blob.get("size", 0)
+    
+    # Staging files left behind by interrupted downloads
+    def sweep_staging():
+        for leftover in list(IMAGES_DIR.glob(".staging-*")) + list(IMAGES_DIR.glob(".*.part")):
+            if leftover.stat().st_mtime < time.time() - grace_seconds:
+                leftover.unlink(missing_ok=True)
+    if not dry_run:
+        await run_asset_io(sweep_staging)
+    if stats["deleted"] or stats["repaired"]:
+        logger.info(f"Image GC: {stats}")
+    return stats
+
+@api_router.post("/images/gc")
+async def image_gc(dry_run: bool = False, grace_seconds: Optional[int] = None):
+    """Reclaim unreferenced image blobs (see collect_image_blobs)."""
+    grace = IMAGE_GC_GRACE_SECONDS if grace_seconds is None else max(0, grace_seconds)
+    return await collect_image_blobs(grace, dry_run)
+
+# ====== IMAGE DERIVATIVES ======
+# Originals are stored full size. Exports and the image route use variants
+# downscaled and recompressed per output profile, generated on first use and
+# cached under IMAGES_DIR/derived. Variant names embed the original's digest,
+# so a replaced image never serves a stale variant.
+DERIVED_IMAGES_DIR = IMAGES_DIR / "derived"
+DERIVED_IMAGES_DIR.mkdir(exist_ok=True)
+
+# Print variants cover the largest placement at 300 DPI (3.5in wide in DOCX,
+# 3.2x2.2in in PDF); images are never upscaled.
+IMAGE_PROFILES = {
+    "print": {"box": (1050, 1050), "mode": "RGB", "quality": 90, "dpi": 300},
+    "print_gray": {"box": (1050, 1050), "mode": "L", "quality": 90, "dpi": 300},
+    "web": {"box": (640, 640), "mode": "RGB", "quality": 80, "dpi": 72},
+}
+INTERIOR_IMAGE_PROFILES = {"color": "print", "bw": "print_gray"}
+
+def image_variant_path(original, profile):
+    return DERIVED_IMAGES_DIR / f"{original.stem}.{profile}.{file_digest(original)[:16]}.jpg"
+
+def build_image_variant(original, profile):
+    """Generate (once) the profile's variant of an original image and return its path."""
+    from PIL import Image as PILImage, ImageOps
+    
+    target = image_variant_path(original, profile)
+    if target.exists():
+        return target
+    spec = IMAGE_PROFILES[profile]
+    with PILImage.open(original) as img:
+        img = ImageOps.exif_transpose(img)
+        if img.mode in ("RGBA", "LA", "P"):
+            # JPEG has no alpha: flatten onto white paper
+            img = img.convert("RGBA")
+            flat = PILImage.new("RGB", img.size, "white")
+            flat.paste(img, mask=img.getchannel("A"))
+            img = flat
+        img = img.convert(spec["mode"])
+        img.thumbnail(spec["box"], PILImage.LANCZOS)
+        tmp_path = target.with_name(f"{target.name}.{uuid.uuid4().hex}.part")
+        try:
+            img.save(tmp_path, "JPEG", quality=spec["quality"], optimize=True, dpi=(spec["dpi"], spec["dpi"]))
+            os.replace(tmp_path, target)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+    # Drop variants of earlier versions of this image
+    for stale in DERIVED_IMAGES_DIR.glob(f"{original.stem}.{profile}.*.jpg"):
+        if stale != target:
+            stale.unlink(missing_ok=True)
+    return target
+
+def image_variant(original, profile):
+    """Variant path, falling back to the original if it cannot be generated."""
+    try:
+        return build_image_variant(original, profile)
+    except Exception as e:
+        logger.error(f"Image variant {profile} of {original.name} failed: {e}")
+        return original
+
+def local_image_path(url):
+    """IMAGES_DIR path behind an /api/images/ URL (query string ignored), or None."""
+    if not url or not url.startswith('/api/images/'):
+        return None
+    return IMAGES_DIR / url[len('/api/images/'):].split('?', 1)[0]
+
+def chapter_image_path(chapter, profile=None):
+    """Local file of a chapter's image (or of its profile variant), or None."""
+    img_path = local_image_path(chapter.get('image_url'))
+    if not img_path or not img_path.is_file():
+        return None
+    return image_variant(img_path, profile) if profile else img_path
+
+# ====== IMAGE DELIVERY ======
+# Legacy stock images were saved under a .png name whatever their format, so the
+# type is sniffed from the file. ETags are content hashes; image store URLs and
+# legacy URLs carrying ?v=<digest prefix> are content-addressed and cached as
+# immutable.
+IMAGE_CACHE_IMMUTABLE = "public, max-age=31536000, immutable"
+IMAGE_CACHE_REVALIDATE = "no-cache"
+IMAGE_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+]
+
+def sniff_image_type(path):
+    with open(path, "rb") as f:
+        return sniff_image_bytes(f.read(16))
+
+def sniff_image_bytes(head):
+    for signature, media_type in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return media_type
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return "application/octet-stream"
+
+def etag_matches(header, etag):
+    """If-None-Match / If-Range comparison (weak, as RFC 9110 requires for If-None-Match)."""
+    if header.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+BYTE_RANGE_RE = re.compile(r'\s*([0-9]*)\s*-\s*([0-9]*)\s*')
+
+def parse_byte_range(header, size):
+    """(start, end) inclusive for a single "bytes=" range; None to serve the whole
+    file; raises ValueError when the range cannot be satisfied.
+
+    Malformed ranges (including a last byte before the first one) are ignored,
+    as RFC 9110 requires, rather than answered with a 416.
+    """
+    unit, _, spec = header.partition("=")
+    m = BYTE_RANGE_RE.fullmatch(spec)
+    if unit.strip().lower() != "bytes" or not m or not any(m.groups()):
+        return None
+    first, last = m.groups()
+    if first:
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        end = min(int(last), size - 1) if last else size - 1
+    else:
+        if int(last) == 0:
+            raise ValueError(header)
+        start, end = max(size - int(last), 0), size - 1
+    if start >= size:
+        raise ValueError(header)
+    return start, end
+
+def read_byte_range(path, start, end):
+    with open(path, "rb") as f:
+        f.seek(start)
+        return f.read(end - start + 1)
+
+# ====== PROGRESS EVENTS ======
+# PROGRESS_EVENTS_SOURCE: "local" publishes events from this process's generation
+# tasks; "changestream" derives them from Mongo change streams so that every
+# worker sees progress for books generated by any other worker.
+PROGRESS_EVENTS_SOURCE = os.environ.get('PROGRESS_EVENTS_SOURCE', 'local')
+PROGRESS_KEEPALIVE_SECONDS = float(os.environ.get('PROGRESS_KEEPALIVE_SECONDS', '15'))
+progress_watch_task = None
+
+class ProgressBus:
+    """In-process fan-out of book progress events to subscriber queues."""
+
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self.subscribers: Dict[str, set] = {}
+
+    def subscribe(self, book_id):
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.subscribers.setdefault(book_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, book_id, queue):
+        queues = self.subscribers.get(book_id)
+        if queues:
+            queues.discard(queue)
+            if not queues:
+                del self.subscribers[book_id]
+
+    def publish(self, book_id, event):
+        for queue in self.subscribers.get(book_id, ()):
+            if queue.full():
+                # Slow consumer: drop its oldest event rather than block the publisher
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+progress_bus = ProgressBus()
+
+def publish_progress(book_id, event_type, **data):
+    """Publish a progress event from a generation task (local mode only)."""
+    if PROGRESS_EVENTS_SOURCE == "local":
+        progress_bus.publish(book_id, {"type": event_type, **data})
+
+async def watch_progress_changes():
+    """Translate Mongo change events on books and chapters into progress events."""
+    status_changes = [{"$match": {
+        "operationType": "update",
+        "$or": [
+            {"updateDescription.updatedFields.status": {"$exists": True}},
+            {"updateDescription.updatedFields.image_job": {"$exists": True}},
+        ],
+    }}]
+    chapter_changes = [{"$match": {"operationType": {"$in": ["insert", "replace", "update"]}}}]
+    
+    async def follow(collection, pipeline, handle):
+        while True:
+            try:
+                async with collection.watch(pipeline, full_document="updateLookup") as stream:
+                    async for change in stream:
+                        handle(change)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Progress change stream on {collection.name} interrupted: {e}")
+                await asyncio.sleep(5)
     
-    return None
+    def on_book(change):
+        book = change.get("fullDocument") or {}
+        if not book.get("id"):
+            return
+        updated = change.get("updateDescription", {}).get("updatedFields", {})
+        if "status" in updated:
+            progress_bus.publish(book["id"], {"type": "status", "status": book.get("status"), "error": book.get("error")})
+        if "image_job" in updated:
+            progress_bus.publish(book["id"], {"type": "image_job", **(book.get("image_job") or {})})
+    
+    def on_chapter(change):
+        chapter = change.get("fullDocument") or {}
+        book_id = chapter.get("book_id")
+        if not book_id:
+            return
+        if change["operationType"] in ("insert", "replace"):
+            progress_bus.publish(book_id, {"type": "chapter_completed",
+                                           "chapter_number": chapter.get("chapter_number"),
+                                           "title": chapter.get("title")})
+        elif "image_url" in change.get("updateDescription", {}).get("updatedFields", {}):
+            progress_bus.publish(book_id, {"type": "image_completed" if chapter.get("image_url") else "image_removed",
+                                           "chapter_number": chapter.get("chapter_number"),
+                                           "image_url": chapter.get("image_url")})
+    
+    await asyncio.gather(
+        follow(db.books, status_changes, on_book),
+        follow(db.chapters, chapter_changes, on_chapter),
+    )
+
+def format_sse(event):
+    return f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+# ====== CHAPTER STORE ======
+# Chapters live in their own collection, one document per (book_id, chapter_number),
+# so single-chapter writes never rewrite the whole book.
+
+# The cached document model (see DOCUMENT MODEL) is only loaded on request
+CHAPTER_DEFAULT_PROJECTION = {"book_id": 0, "document": 0}
+
+async def load_chapters(book_id, projection=None):
+    """Return a book's chapters sorted by number."""
+    projection = dict(projection) if projection else dict(CHAPTER_DEFAULT_PROJECTION)
+    projection["_id"] = 0
+    return await db.chapters.find({"book_id": book_id}, projection).sort("chapter_number", 1).to_list(None)
+
+async def attach_chapters(book, projection=None):
+    """Fill book["chapters"] from the chapters collection."""
+    book["chapters"] = await load_chapters(book["id"], projection)
+    return book
+
+async def count_chapters(book_id):
+    return await db.chapters.count_documents({"book_id": book_id})
+
+async def save_chapter(book_id, chapter_data):
+    """Insert or replace one chapter; returns the replaced chapter, if any."""
+    return await db.chapters.find_one_and_replace(
+        {"book_id": book_id, "chapter_number": chapter_data["chapter_number"]},
+        {"book_id": book_id, **chapter_data},
+        projection={"_id": 0},
+        upsert=True
+    )
+
+async def update_chapter(book_id, chapter_num, fields):
+    """Set fields on one chapter; returns the chapter as it was before the update."""
+    return await db.chapters.find_one_and_update(
+        {"book_id": book_id, "chapter_number": chapter_num},
+        {"$set": fields},
+        projection={"_id": 0}
+    )
+
+async def touch_book(book_id, **fields):
+    fields["updated_at"] = datetime.now(timezone.utc).isoformat()
+    await db.books.update_one({"id": book_id}, {"$set": fields})
+    if "status" in fields:
+        publish_progress(book_id, "status", status=fields["status"], error=fields.get("error"))
+
+async def migrate_embedded_chapters():
+    """Move chapters still embedded in book documents into the chapters collection.
+
+    Idempotent: existing chapter documents win, so it is safe to re-run after a
+    crash or from several workers at once.
+    """
+    migrated = 0
+    async for book in db.books.find({"chapters": {"$exists": True}}, {"_id": 0, "id": 1, "chapters": 1}):
+        ops = [
+            UpdateOne(
+                {"book_id": book["id"], "chapter_number": ch.get("chapter_number")},
+                {"$setOnInsert": {"book_id": book["id"], **ch}},
+                upsert=True
+            )
+            for ch in book.get("chapters") or []
+        ]
+        if ops:
+            try:
+                await db.chapters.bulk_write(ops, ordered=False)
+            except BulkWriteError as e:
+                # Another worker migrated the same chapters concurrently
+                if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+                    raise
+        await db.books.update_one({"id": book["id"]}, {"$unset": {"chapters": ""}})
+        migrated += 1
+    if migrated:
+        logger.info(f"Migrated embedded chapters of {migrated} book(s) to the chapters collection")
+
+# ====== DATABASE INDEXES ======
+# QUERY_PLAN_CHECK: "warn" logs hot queries that would scan a whole collection,
+# "strict" refuses to start, "off" skips the check.
+QUERY_PLAN_CHECK = os.environ.get('QUERY_PLAN_CHECK', 'warn')
+
+# (collection, keys, options)
+INDEXES = [
+    ("books", [("id", 1)], {"unique": True}),
+    ("books", [("created_at", -1), ("id", -1)], {}),
+    ("books", [("status", 1)], {}),
+    ("chapters", [("book_id", 1), ("chapter_number", 1)], {"unique": True}),
+    ("chapter_drafts", [("book_id", 1), ("chapter_number", 1)], {"unique": True}),
+    ("page_maps", [("book_id", 1)], {"unique": True}),
+    ("image_blobs", [("digest", 1)], {"unique": True}),
+    ("image_blobs", [("refs", 1), ("released_at", 1)], {}),
+    ("chapters", [("image_url", 1)], {"sparse": True}),
+    ("llm_cache", [("key", 1)], {"unique": True}),
+    ("llm_cache", [("expires_at", 1)], {"expireAfterSeconds": 0}),
+    ("jobs", [("id", 1)], {"unique": True}),
+    # At most one running job of each kind per book
+    ("jobs", [("book_id", 1), ("kind", 1)], {"unique": True, "partialFilterExpression": {"status": "running"}}),
+    ("jobs", [("book_id", 1), ("kind", 1), ("created_at", -1)], {}),
+    ("job_items", [("job_id", 1), ("chapter_number", 1)], {"unique": True}),
+    ("job_items", [("status", 1), ("queued_at", 1), ("chapter_number", 1)], {}),
+    ("job_items", [("book_id", 1)], {}),
+]
+
+# Hot queries issued by the routes: (collection, filter, sort)
+HOT_QUERIES = [
+    ("books", {"id": "probe"}, None),
+    ("books", {}, [("created_at", -1), ("id", -1)]),
+    ("books", {"status": "writing"}, None),
+    ("chapters", {"book_id": "probe"}, [("chapter_number", 1)]),
+    ("chapters", {"book_id": "probe", "chapter_number": 1}, None),
+    ("page_maps", {"book_id": "probe"}, None),
+    ("image_blobs", {"digest": "probe"}, None),
+    ("llm_cache", {"key": "probe"}, None),
+    ("job_items", {"status": "queued"}, [("queued_at", 1), ("chapter_number", 1)]),
+    ("job_items", {"job_id": "probe", "status": "running"}, None),
+]
+
+async def ensure_indexes():
+    for coll, keys, options in INDEXES:
+        try:
+            await db[coll].create_index(keys, **options)
+        except Exception as e:
+            if QUERY_PLAN_CHECK == "strict":
+                raise
+            logger.error(f"Could not create index {keys} on {coll}: {e}")
+
+def plan_stages(plan):
+    """Collect every stage name in an explain() plan tree."""
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for key in ("inputStage", "queryPlan"):
+            stages.extend(plan_stages(plan.get(key)))
+        for child in plan.get("inputStages", []):
+            stages.extend(plan_stages(child))
+    return stages
+
+async def verify_query_plans():
+    """Warn (or fail in strict mode) when a hot query would fall back to COLLSCAN."""
+    if QUERY_PLAN_CHECK == "off":
+        return
+    problems = []
+    for coll, query, sort in HOT_QUERIES:
+        cursor = db[coll].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        try:
+            explain = await cursor.explain()
+        except Exception as e:
+            logger.warning(f"Could not explain {coll} query {query}: {e}")
+            continue
+        winning_plan = explain.get("queryPlanner", {}).get("winningPlan", {})
+        if "COLLSCAN" in plan_stages(winning_plan):
+            problems.append(f"{coll}.find({query}){f'.sort({sort})' if sort else ''}")
+    if problems:
+        message = "Queries falling back to COLLSCAN: " + "; ".join(problems)
+        if QUERY_PLAN_CHECK == "strict":
+            raise RuntimeError(message)
+        logger.warning(message)
 
 # ====== SETTINGS ROUTES ======
 
@@ -205,13 +1544,21 @@ async def get_settings_route():
 @api_router.put("/settings")
 async def update_settings(data: SettingsUpdate):
     update_data = data.model_dump()
-    existing = await db.settings.find_one({})
-    if existing:
-        if update_data.get("custom_api_key") and update_data["custom_api_key"].startswith("****"):
-            update_data.pop("custom_api_key")
-        await db.settings.update_one({}, {"$set": update_data})
-    else:
-        await db.settings.insert_one(update_data)
+    if update_data.get("custom_api_key") and update_data["custom_api_key"].startswith("****"):
+        update_data.pop("custom_api_key")
+    # Write-through: bump the version stamp and cache what was stored
+    settings = await db.settings.find_one_and_update(
+        {},
+        {"$set": update_data, "$inc": {"version": 1}},
+        projection={"_id": 0},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    cache_settings(settings)
+    
+    # Stop handing out pooled Gemini clients bound to a key that is no longer active
+    api_key, _ = await get_active_api_key()
+    retire_genai_clients(keep_api_key=api_key)
     return {"status": "ok"}
 
 # ====== THEMES ROUTES ======
@@ -248,8 +1595,9 @@ Focus on timeless books: practical guides, recipes, tutorials, self-help, childr
 
 Respond ONLY with JSON, no markdown or backticks. Format: [{{"title": "...", ...}}]"""
 
+    system_message = "You are an Amazon KDP market expert. Always respond with valid JSON only."
     try:
-        response = await call_gemini(prompt, "You are an Amazon KDP market expert. Always respond with valid JSON only.")
+        response = await call_gemini(prompt, system_message, cache_ttl=THEMES_CACHE_TTL, fresh=req.fresh)
         # Try to parse JSON from the response
         cleaned = response.strip()
         if cleaned.startswith("```"):
@@ -259,7 +1607,10 @@ Respond ONLY with JSON, no markdown or backticks. Format: [{{"title": "...", ...
         return {"themes": themes}
     except json.JSONDecodeError:
         logger.error(f"Failed to parse themes JSON: {response[:200]}")
+        await forget_llm_response(prompt, system_message)
         return {"themes": [], "error": "Failed to parse AI response"}
+    except CircuitOpenError as e:
+        raise llm_unavailable(e)
     except Exception as e:
         logger.error(f"Theme discovery error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -297,8 +1648,9 @@ For each idea, provide:
 
 Respond ONLY with JSON. Format: [{{"title": "...", ...}}]"""
 
+    system_message = "You are a book creation expert. Always respond with valid JSON only."
     try:
-        response = await call_gemini(prompt, "You are a book creation expert. Always respond with valid JSON only.")
+        response = await call_gemini(prompt, system_message, cache_ttl=IDEAS_CACHE_TTL, fresh=req.fresh)
         cleaned = response.strip()
         if cleaned.startswith("```"):
             cleaned = cleaned.split("\n", 1)[1] if "\n" in cleaned else cleaned[3:]
@@ -307,7 +1659,10 @@ Respond ONLY with JSON. Format: [{{"title": "...", ...}}]"""
         return {"ideas": ideas}
     except json.JSONDecodeError:
         logger.error(f"Failed to parse ideas JSON: {response[:200]}")
+        await forget_llm_response(prompt, system_message)
         return {"ideas": [], "error": "Failed to parse AI response"}
+    except CircuitOpenError as e:
+        raise llm_unavailable(e)
     except Exception as e:
         logger.error(f"Ideas generation error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -328,13 +1683,13 @@ async def create_book(req: BookCreateRequest):
         "image_source": req.image_source,
         "status": "outline_pending",
         "outline": [],
-        "chapters": [],
         "cover_image": None,
         "created_at": datetime.now(timezone.utc).isoformat(),
         "updated_at": datetime.now(timezone.utc).isoformat()
     }
     await db.books.insert_one(book)
     book.pop("_id", None)
+    book["chapters"] = []
     return book
 
 @api_router.post("/books/{book_id}/generate-outline")
@@ -398,10 +1753,13 @@ Respond ONLY with JSON. Format: [{{"chapter_number": 1, "title": "...", ...}}]""
             {"id": book_id},
             {"$set": {"outline": outline, "status": "outline_ready", "updated_at": datetime.now(timezone.utc).isoformat()}}
         )
+        publish_progress(book_id, "status", status="outline_ready")
         return {"outline": outline}
     except json.JSONDecodeError:
         logger.error(f"Failed to parse outline JSON: {response[:200]}")
         raise HTTPException(status_code=500, detail="Failed to parse AI response for outline")
+    except CircuitOpenError as e:
+        raise llm_unavailable(e)
     except Exception as e:
         logger.error(f"Outline generation error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -412,30 +1770,23 @@ async def update_outline(book_id: str, req: OutlineApproveRequest):
         {"id": book_id},
         {"$set": {"outline": req.outline, "status": "outline_approved", "updated_at": datetime.now(timezone.utc).isoformat()}}
     )
+    publish_progress(book_id, "status", status="outline_approved")
     return {"status": "ok"}
 
-@api_router.post("/books/{book_id}/generate-chapter/{chapter_num}")
-async def generate_chapter(book_id: str, chapter_num: int):
-    book = await db.books.find_one({"id": book_id}, {"_id": 0})
-    if not book:
-        raise HTTPException(status_code=404, detail="Book not found")
-    
-    outline = book.get("outline", [])
-    chapter_outline = None
-    for ch in outline:
+def find_outline_chapter(book, chapter_num):
+    for ch in book.get("outline", []):
         if ch.get("chapter_number") == chapter_num:
-            chapter_outline = ch
-            break
-    
-    if not chapter_outline:
-        raise HTTPException(status_code=404, detail="Chapter not found in outline")
-    
+            return ch
+    return None
+
+def build_chapter_prompt(book, chapter_outline, chapter_num):
+    """Build the detailed prompt used for single-chapter generation."""
     lang = book.get("language", "fr")
     est_pages = chapter_outline.get("estimated_pages", 8)
     word_count = est_pages * 250
     
     if lang == "fr":
-        prompt = f"""Tu es un auteur professionnel qui écrit le chapitre {chapter_num} du livre "{book['title']}".
+        return f"""Tu es un auteur professionnel qui écrit le chapitre {chapter_num} du livre "{book['title']}".
 
 Informations du chapitre:
 - Titre: {chapter_outline['title']}
@@ -454,8 +1805,7 @@ Informations du chapitre:
 - Ne PAS commencer les paragraphes par des astérisques
 
 Écris UNIQUEMENT le contenu du chapitre, sans meta-commentaires."""
-    else:
-        prompt = f"""You are a professional author writing chapter {chapter_num} of the book "{book['title']}".
+    return f"""You are a professional author writing chapter {chapter_num} of the book "{book['title']}".
 
 Chapter information:
 - Title: {chapter_outline['title']}
@@ -475,81 +1825,180 @@ Write the complete content for this chapter. The text must:
 
 Write ONLY the chapter content, no meta-commentary."""
 
+def chapter_system_message(book):
+    return f"You are writing a professional {book['category']} book. Write detailed, high-quality content."
+
+async def store_generated_chapter(book, chapter_outline, content):
+    """Save a freshly written chapter and update the book status; returns (chapter, progress)."""
+    chapter_data = {
+        "chapter_number": chapter_outline["chapter_number"],
+        "title": chapter_outline["title"],
+        "content": content,
+        "image_suggestion": chapter_outline.get("image_suggestion", ""),
+        "image_url": None,
+        "generated_at": datetime.now(timezone.utc).isoformat()
+    }
+    
+    previous = await save_chapter(book["id"], chapter_data)
+    # A rewritten chapter starts without an image
+    await release_image((previous or {}).get("image_url"))
+    publish_progress(book["id"], "chapter_completed", chapter_number=chapter_data["chapter_number"], title=chapter_data["title"])
+    
+    total_chapters = len(book.get("outline", []))
+    generated_count = await count_chapters(book["id"])
+    new_status = "writing" if generated_count < total_chapters else "chapters_complete"
+    
+    await touch_book(book["id"], status=new_status)
+    return chapter_data, {"generated": generated_count, "total": total_chapters}
+
+@api_router.post("/books/{book_id}/generate-chapter/{chapter_num}")
+async def generate_chapter(book_id: str, chapter_num: int):
+    book = await db.books.find_one({"id": book_id}, {"_id": 0})
+    if not book:
+        raise HTTPException(status_code=404, detail="Book not found")
+    
+    chapter_outline = find_outline_chapter(book, chapter_num)
+    if not chapter_outline:
+        raise HTTPException(status_code=404, detail="Chapter not found in outline")
+    
     try:
-        response = await call_gemini(prompt, f"You are writing a professional {book['category']} book. Write detailed, high-quality content.")
-        
-        chapter_data = {
-            "chapter_number": chapter_num,
-            "title": chapter_outline["title"],
-            "content": response,
-            "image_suggestion": chapter_outline.get("image_suggestion", ""),
-            "image_url": None,
-            "generated_at": datetime.now(timezone.utc).isoformat()
-        }
-        
-        existing_chapters = book.get("chapters", [])
-        existing_chapters = [c for c in existing_chapters if c.get("chapter_number") != chapter_num]
-        existing_chapters.append(chapter_data)
-        existing_chapters.sort(key=lambda x: x.get("chapter_number", 0))
-        
-        total_chapters = len(outline)
-        generated_count = len(existing_chapters)
-        new_status = "writing" if generated_count < total_chapters else "chapters_complete"
-        
-        await db.books.update_one(
-            {"id": book_id},
-            {"$set": {
-                "chapters": existing_chapters,
-                "status": new_status,
-                "updated_at": datetime.now(timezone.utc).isoformat()
-            }}
-        )
-        
-        return {
-            "chapter": chapter_data,
-            "progress": {"generated": generated_count, "total": total_chapters}
-        }
+        response = await call_gemini(build_chapter_prompt(book, chapter_outline, chapter_num), chapter_system_message(book))
+        chapter_data, progress = await store_generated_chapter(book, chapter_outline, response)
+        await db.chapter_drafts.delete_one({"book_id": book_id, "chapter_number": chapter_num})
+        return {"chapter": chapter_data, "progress": progress}
+    except CircuitOpenError as e:
+        raise llm_unavailable(e)
     except Exception as e:
         logger.error(f"Chapter generation error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@api_router.post("/books/{book_id}/generate-all-chapters")
-async def generate_all_chapters_endpoint(book_id: str, background_tasks: BackgroundTasks):
+def build_resume_prompt(book, prompt, partial):
+    """Ask the model to continue a chapter from a checkpointed draft."""
+    if book.get("language", "fr") == "fr":
+        return f"""{prompt}
+
+Le début de ce chapitre a déjà été écrit. Voici le texte existant:
+---
+{partial}
+---
+Continue le chapitre exactement là où ce texte s'arrête, sans répéter le texte existant."""
+    return f"""{prompt}
+
+The beginning of this chapter has already been written. Here is the existing text:
+---
+{partial}
+---
+Continue the chapter exactly where this text stops, without repeating the existing text."""
+
+async def save_chapter_draft(book_id, chapter_num, content):
+    await db.chapter_drafts.update_one(
+        {"book_id": book_id, "chapter_number": chapter_num},
+        {"$set": {"content": content, "updated_at": datetime.now(timezone.utc).isoformat()}},
+        upsert=True
+    )
+
+@api_router.post("/books/{book_id}/generate-chapter/{chapter_num}/stream")
+async def generate_chapter_stream(book_id: str, chapter_num: int, restart: bool = False):
+    """Stream a chapter as NDJSON events while it is being written.
+
+    Partial text is checkpointed to `chapter_drafts` every few seconds; calling
+    the endpoint again after a dropped connection replays the checkpoint and
+    only asks the model for the rest (pass `restart=true` to start over).
+    """
     book = await db.books.find_one({"id": book_id}, {"_id": 0})
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
     
+    chapter_outline = find_outline_chapter(book, chapter_num)
+    if not chapter_outline:
+        raise HTTPException(status_code=404, detail="Chapter not found in outline")
+    
+    # Refuse up front while the model is shed: once streaming, errors can only be events
+    paused = llm_breaker(GEMINI_TEXT_MODEL).retry_after()
+    if paused:
+        raise llm_unavailable(CircuitOpenError(GEMINI_TEXT_MODEL, paused))
+    
+    draft_key = {"book_id": book_id, "chapter_number": chapter_num}
+    if restart:
+        await db.chapter_drafts.delete_one(draft_key)
+        draft = None
+    else:
+        draft = await db.chapter_drafts.find_one(draft_key, {"_id": 0})
+    
+    async def events():
+        partial = draft["content"] if draft else ""
+        prompt = build_chapter_prompt(book, chapter_outline, chapter_num)
+        if partial:
+            prompt = build_resume_prompt(book, prompt, partial)
+            yield json.dumps({"type": "resume", "content": partial}, ensure_ascii=False) + "\n"
+        
+        content = partial
+        saved_len = len(content)
+        last_checkpoint = time.monotonic()
+        try:
+            async for text in stream_gemini(prompt, chapter_system_message(book)):
+                content += text
+                yield json.dumps({"type": "delta", "text": text}, ensure_ascii=False) + "\n"
+                if (time.monotonic() - last_checkpoint >= STREAM_CHECKPOINT_SECONDS
+                        or len(content) - saved_len >= STREAM_CHECKPOINT_CHARS):
+                    await save_chapter_draft(book_id, chapter_num, content)
+                    saved_len = len(content)
+                    last_checkpoint = time.monotonic()
+            
+            chapter_data, progress = await store_generated_chapter(book, chapter_outline, content)
+            await db.chapter_drafts.delete_one(draft_key)
+            yield json.dumps({"type": "done", "chapter": chapter_data, "progress": progress}, ensure_ascii=False) + "\n"
+        except asyncio.CancelledError:
+            # Client went away: keep what we have so the next call resumes from here
+            if len(content) > saved_len:
+                await asyncio.shield(save_chapter_draft(book_id, chapter_num, content))
+            raise
+        except Exception as e:
+            logger.error(f"Chapter stream error: {e}")
+            if len(content) > saved_len:
+                await save_chapter_draft(book_id, chapter_num, content)
+            error = {"type": "error", "detail": str(e)}
+            if isinstance(e, CircuitOpenError):
+                error["retry_after"] = math.ceil(e.retry_after)
+            yield json.dumps(error) + "\n"
+    
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+@api_router.post("/books/{book_id}/generate-all-chapters")
+async def generate_all_chapters_endpoint(book_id: str, concurrency: Optional[int] = None):
+    """Queue a durable job writing every missing chapter (see JOB QUEUE)."""
+    book = await db.books.find_one({"id": book_id}, {"_id": 0, "id": 1, "outline": 1})
+    if not book:
+        raise HTTPException(status_code=404, detail="Book not found")
+    
+    # Per-book worker count, capped by the process-wide limit
+    workers = concurrency or CHAPTER_CONCURRENCY_PER_BOOK
+    workers = max(1, min(workers, CHAPTER_CONCURRENCY_GLOBAL))
+    
+    # Mark the book first: once queued, a worker may finish (or fail) the job and
+    # set the final status before this request gets to run again
     await db.books.update_one(
         {"id": book_id},
-        {"$set": {"status": "writing", "updated_at": datetime.now(timezone.utc).isoformat()}}
+        {"$set": {"status": "writing", "updated_at": datetime.now(timezone.utc).isoformat()},
+         "$unset": {"error": ""}}
     )
+    publish_progress(book_id, "status", status="writing")
     
-    background_tasks.add_task(generate_all_chapters_task, book_id)
-    return {"status": "writing", "message": "Chapter generation started"}
+    job = await enqueue_chapter_job(book, workers)
+    if not job:
+        await touch_book(book_id, status="chapters_complete")
+        return {"status": "chapters_complete", "message": "All chapters are already written"}
+    return {"status": "writing", "message": "Chapter generation started", "concurrency": job["concurrency"], "job_id": job["id"]}
 
-async def generate_all_chapters_task(book_id: str):
-    """Background task to generate all chapters one by one."""
-    try:
-        book = await db.books.find_one({"id": book_id}, {"_id": 0})
-        if not book:
-            return
-        
-        outline = book.get("outline", [])
-        existing_chapters = book.get("chapters", [])
-        generated_nums = {c.get("chapter_number") for c in existing_chapters}
-        
-        for ch in outline:
-            ch_num = ch.get("chapter_number")
-            if ch_num in generated_nums:
-                continue
-            
-            try:
-                lang = book.get("language", "fr")
-                est_pages = ch.get("estimated_pages", 8)
-                word_count = est_pages * 250
-                
-                if lang == "fr":
-                    prompt = f"""Tu es un auteur professionnel qui écrit le chapitre {ch_num} du livre "{book['title']}".
+def build_bulk_chapter_prompt(book, ch):
+    """Build the chapter prompt used by bulk generation."""
+    ch_num = ch.get("chapter_number")
+    lang = book.get("language", "fr")
+    est_pages = ch.get("estimated_pages", 8)
+    word_count = est_pages * 250
+    
+    if lang == "fr":
+        return f"""Tu es un auteur professionnel qui écrit le chapitre {ch_num} du livre "{book['title']}".
 
 Informations du chapitre:
 - Titre: {ch['title']}
@@ -562,8 +2011,7 @@ Utilise ## pour les sous-titres, **texte** pour le gras, - pour les listes.
 Ne PAS utiliser ### ou *** comme séparateurs.
 
 Écris UNIQUEMENT le contenu du chapitre."""
-                else:
-                    prompt = f"""You are a professional author writing chapter {ch_num} of "{book['title']}".
+    return f"""You are a professional author writing chapter {ch_num} of "{book['title']}".
 
 Chapter info:
 - Title: {ch['title']}
@@ -577,60 +2025,40 @@ Do NOT use ### or *** as separators.
 
 Write ONLY the chapter content."""
 
-                response = await call_gemini(prompt, f"You are writing a professional {book['category']} book.")
-                
-                chapter_data = {
-                    "chapter_number": ch_num,
-                    "title": ch["title"],
-                    "content": response,
-                    "image_suggestion": ch.get("image_suggestion", ""),
-                    "image_url": None,
-                    "generated_at": datetime.now(timezone.utc).isoformat()
-                }
-                
-                await db.books.update_one(
-                    {"id": book_id},
-                    {"$push": {"chapters": chapter_data},
-                     "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}}
-                )
-                
-            except Exception as e:
-                logger.error(f"Error generating chapter {ch_num}: {e}")
-                await db.books.update_one(
-                    {"id": book_id},
-                    {"$set": {"status": "error", "error": f"Chapter {ch_num} failed: {str(e)}"}}
-                )
-                return
-        
-        await db.books.update_one(
-            {"id": book_id},
-            {"$set": {"status": "chapters_complete", "updated_at": datetime.now(timezone.utc).isoformat()}}
-        )
-    except Exception as e:
-        logger.error(f"Background generation error: {e}")
-        await db.books.update_one(
-            {"id": book_id},
-            {"$set": {"status": "error", "error": str(e)}}
-        )
-
-@api_router.post("/books/{book_id}/generate-image/{chapter_num}")
-async def generate_chapter_image(book_id: str, chapter_num: int):
-    book = await db.books.find_one({"id": book_id}, {"_id": 0})
-    if not book:
-        raise HTTPException(status_code=404, detail="Book not found")
-    
-    chapters = book.get("chapters", [])
-    chapter = None
-    for c in chapters:
-        if c.get("chapter_number") == chapter_num:
-            chapter = c
-            break
-    
-    if not chapter:
-        raise HTTPException(status_code=404, detail="Chapter not found")
+async def write_bulk_chapter(book, ch, deadline=None):
+    """Write one outline chapter for bulk generation and store it."""
+    book_id = book["id"]
+    ch_num = ch.get("chapter_number")
+    response = await call_gemini(
+        build_bulk_chapter_prompt(book, ch),
+        f"You are writing a professional {book['category']} book.",
+        deadline=deadline)
+    
+    chapter_data = {
+        "chapter_number": ch_num,
+        "title": ch["title"],
+        "content": response,
+        "image_suggestion": ch.get("image_suggestion", ""),
+        "image_url": None,
+        "generated_at": datetime.now(timezone.utc).isoformat()
+    }
     
-    settings = await get_settings()
-    image_source = settings.get("image_source", "ai")
+    # Never overwrite a chapter written meanwhile by generate_chapter
+    await db.chapters.update_one(
+        {"book_id": book_id, "chapter_number": ch_num},
+        {"$setOnInsert": {"book_id": book_id, **chapter_data}},
+        upsert=True
+    )
+    await touch_book(book_id)
+    publish_progress(book_id, "chapter_completed", chapter_number=ch_num, title=ch["title"])
+
+async def create_chapter_image(book, chapter, image_source):
+    """Produce an image for one chapter with the configured source and store it.
+
+    Returns the image URL, or None when no source produced an image.
+    """
+    book_id = book["id"]
+    chapter_num = chapter["chapter_number"]
     ch_title = chapter.get("title", "")
     ch_content = chapter.get("content", "")
     book_title = book.get("title", "")
@@ -647,178 +2075,874 @@ Content: {content_excerpt}
 
 The image must look like a real professional photograph, NOT a cartoon, NOT an illustration, NOT a drawing.
 High resolution, natural lighting, professional photography style. No text or watermarks in the image."""
-            img_path, _ = await generate_image_ai(prompt, book_id, f"ch{chapter_num}")
-            if img_path:
-                image_url = f"/api/images/{book_id}_ch{chapter_num}.png"
+            async with ai_image_slots:
+                image_url = await generate_image_ai(prompt)
         except Exception as e:
             logger.error(f"AI image generation failed: {e}")
     
     if not image_url and image_source in ("stock", "both"):
-        # Use AI to generate a relevant search query from chapter content
-        smart_query = await generate_stock_search_query(ch_title, ch_content, book_title)
+        # AI-chosen search query for the chapter content, memoized on the chapter;
+        # resolved before taking a slot, which only bounds the downloads
+        smart_query = (await stock_search_queries(book, [chapter]))[chapter_num]
         logger.info(f"Stock image search query for ch{chapter_num}: '{smart_query}'")
-        stock_url = await fetch_stock_image(smart_query, book_id, f"ch{chapter_num}")
-        if stock_url:
-            image_url = stock_url
+        async with stock_image_slots:
+            image_url = await fetch_stock_image(smart_query)
     
     if image_url:
-        for i, c in enumerate(chapters):
-            if c.get("chapter_number") == chapter_num:
-                chapters[i]["image_url"] = image_url
-                break
-        
-        await db.books.update_one(
-            {"id": book_id},
-            {"$set": {"chapters": chapters, "updated_at": datetime.now(timezone.utc).isoformat()}}
-        )
+        previous = await update_chapter(book_id, chapter_num, {"image_url": image_url})
+        if previous is None:
+            # The chapter (or its book) was deleted meanwhile: nothing holds the new image
+            await release_image(image_url)
+            return None
+        # Also drops the extra reference when the same image came back
+        await release_image(previous.get("image_url"))
+        await touch_book(book_id)
+        publish_progress(book_id, "image_completed", chapter_number=chapter_num, image_url=image_url)
+    
+    return image_url
+
+@api_router.post("/books/{book_id}/generate-image/{chapter_num}")
+async def generate_chapter_image(book_id: str, chapter_num: int):
+    book = await db.books.find_one({"id": book_id}, {"_id": 0, "outline": 0})
+    if not book:
+        raise HTTPException(status_code=404, detail="Book not found")
     
+    chapter = await db.chapters.find_one({"book_id": book_id, "chapter_number": chapter_num}, {"_id": 0})
+    if not chapter:
+        raise HTTPException(status_code=404, detail="Chapter not found")
+    
+    settings = await get_settings()
+    image_url = await create_chapter_image(book, chapter, settings.get("image_source", "ai"))
     return {"image_url": image_url}
 
+# ---- Image jobs ----
+# A book runs one image job at a time, across every API process: starting one
+# takes a lease on the book (image_job_lease: owner + expiry), which the job keeps
+# renewing while it runs. A job whose process died stops renewing it; once the
+# lease has expired the job is reported as "interrupted" and can be started again.
+IMAGE_JOB_LEASE_SECONDS = float(os.environ.get('IMAGE_JOB_LEASE_SECONDS', '60'))
+
+def image_job_lease(owner):
+    return {"owner": owner, "expires_at": datetime.now(timezone.utc) + timedelta(seconds=IMAGE_JOB_LEASE_SECONDS)}
+
+def image_job_view(book):
+    """The book's image job as clients see it: a running job whose lease has
+    expired is reported as interrupted."""
+    job = book.get("image_job")
+    if not job or job.get("status") != "running":
+        return job
+    expires_at = (book.get("image_job_lease") or {}).get("expires_at")
+    if expires_at and expires_at.tzinfo is None:
+        expires_at = expires_at.replace(tzinfo=timezone.utc)
+    if expires_at and expires_at > datetime.now(timezone.utc):
+        return job
+    return {**job, "status": "interrupted"}
+
+async def claim_image_job(book_id, owner, job):
+    """Store a new image job on the book unless a live one is running there;
+    returns False when the book already has one."""
+    now = datetime.now(timezone.utc)
+    claimed = await db.books.find_one_and_update(
+        {"id": book_id,
+         "$or": [{"image_job.status": {"$ne": "running"}},
+                 {"image_job_lease.expires_at": {"$not": {"$gt": now}}}]},
+        {"$set": {"image_job": job, "image_job_lease": image_job_lease(owner), "updated_at": now.isoformat()}},
+        projection={"_id": 0, "id": 1}
+    )
+    return claimed is not None
+
+async def save_image_job(book_id, job, owner, final=False):
+    """Store the job's progress on the book (renewing its lease, or releasing it
+    when final) and publish it; returns False when the lease was lost."""
+    snapshot = {**job, "pending": list(job["pending"]), "failed_chapters": list(job["failed_chapters"])}
+    result = await db.books.update_one(
+        {"id": book_id, "image_job_lease.owner": owner},
+        {"$set": {"image_job": snapshot, "image_job_lease": None if final else image_job_lease(owner),
+                  "updated_at": datetime.now(timezone.utc).isoformat()}}
+    )
+    if not result.matched_count:
+        return False
+    publish_progress(book_id, "image_job", **snapshot)
+    return True
+
+async def hold_image_job_lease(book_id, owner, work):
+    """Renew the image job's lease until cancelled; cancel the work if the lease
+    is lost (book deleted or the job restarted elsewhere after expiry)."""
+    while True:
+        await asyncio.sleep(IMAGE_JOB_LEASE_SECONDS / 3)
+        try:
+            result = await db.books.update_one(
+                {"id": book_id, "image_job_lease.owner": owner},
+                {"$set": {"image_job_lease": image_job_lease(owner)}}
+            )
+        except Exception as e:
+            logger.warning(f"Image job lease renewal failed: {e}")
+            continue
+        if result.matched_count == 0:
+            logger.warning(f"Lost image job lease on book {book_id}")
+            work.cancel()
+            return
+
+@api_router.post("/books/{book_id}/generate-all-images")
+async def generate_all_images_endpoint(book_id: str, background_tasks: BackgroundTasks):
+    """Start a background job that adds an image to every chapter lacking one.
+
+    Progress is stored as book.image_job and pushed as `image_job` events, next
+    to the usual per-chapter `image_completed` events. An interrupted job is
+    restarted with the chapters still missing an image.
+    """
+    book = await db.books.find_one({"id": book_id}, {"_id": 0, "id": 1})
+    if not book:
+        raise HTTPException(status_code=404, detail="Book not found")
+    
+    missing = await db.chapters.find(
+        {"book_id": book_id, "image_url": None}, {"_id": 0, "chapter_number": 1}
+    ).sort("chapter_number", 1).to_list(None)
+    job = {
+        "id": str(uuid.uuid4()),
+        "status": "running" if missing else "done",
+        "total": len(missing),
+        "completed": 0,
+        "failed": 0,
+        "pending": [ch["chapter_number"] for ch in missing],
+        "failed_chapters": [],
+        "started_at": datetime.now(timezone.utc).isoformat(),
+    }
+    owner = job_worker_id()
+    if not await claim_image_job(book_id, owner, job):
+        raise HTTPException(status_code=409, detail="Image generation already running for this book")
+    
+    if missing:
+        publish_progress(book_id, "image_job", **job)
+        background_tasks.add_task(generate_all_images_task, book_id, job, owner)
+    else:
+        await save_image_job(book_id, job, owner, final=True)
+    return job
+
+async def generate_all_images_task(book_id: str, job: dict, owner: str):
+    """Generate the job's pending images concurrently, within the AI and stock limits.
+
+    A chapter whose image cannot be produced is recorded in failed_chapters and
+    does not stop the others.
+    """
+    heartbeat = asyncio.create_task(hold_image_job_lease(book_id, owner, asyncio.current_task()))
+    try:
+        book = await db.books.find_one({"id": book_id}, {"_id": 0, "id": 1, "title": 1})
+        if not book:
+            return
+        settings = await get_settings()
+        image_source = settings.get("image_source", "ai")
+        chapters = await db.chapters.find(
+            {"book_id": book_id, "chapter_number": {"$in": list(job["pending"])}},
+            {"_id": 0, "chapter_number": 1, "title": 1, "content": 1, "stock_query": 1}
+        ).to_list(None)
+        if image_source in ("stock", "both"):
+            # One LLM call for every chapter's search query instead of one each
+            # (with "both", for the chapters whose AI image fails)
+            try:
+                await stock_search_queries(book, chapters)
+            except Exception as e:
+                # Each chapter resolves its own query again when it needs one
+                logger.error(f"Stock query prefetch failed: {e}")
+        
+        async def fill(chapter):
+            ch_num = chapter["chapter_number"]
+            try:
+                image_url = await create_chapter_image(book, chapter, image_source)
+            except Exception as e:
+                logger.error(f"Image generation failed for chapter {ch_num}: {e}")
+                image_url = None
+            job["pending"].remove(ch_num)
+            if image_url:
+                job["completed"] += 1
+            else:
+                job["failed"] += 1
+                job["failed_chapters"].append(ch_num)
+            await save_image_job(book_id, job, owner)
+        
+        await asyncio.gather(*(fill(ch) for ch in chapters))
+        job["status"] = "done"
+    except asyncio.CancelledError:
+        # Lease lost or shutting down: the job shows as interrupted once the lease expires
+        raise
+    except Exception as e:
+        logger.error(f"Background image generation error: {e}")
+        job["status"] = "error"
+        job["error"] = str(e)
+    finally:
+        heartbeat.cancel()
+    job["finished_at"] = datetime.now(timezone.utc).isoformat()
+    await save_image_job(book_id, job, owner, final=True)
+
 @api_router.delete("/books/{book_id}/image/{chapter_num}")
 async def delete_chapter_image(book_id: str, chapter_num: int):
-    book = await db.books.find_one({"id": book_id}, {"_id": 0})
+    book = await db.books.find_one({"id": book_id}, {"_id": 0, "id": 1})
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
     
-    chapters = book.get("chapters", [])
-    for i, c in enumerate(chapters):
-        if c.get("chapter_number") == chapter_num:
-            old_url = c.get("image_url", "")
-            chapters[i]["image_url"] = None
-            # Delete local file if it exists
-            if old_url and old_url.startswith("/api/images/"):
-                img_filename = old_url.replace("/api/images/", "")
-                img_path = IMAGES_DIR / img_filename
-                if img_path.exists():
-                    img_path.unlink()
-            break
+    previous = await update_chapter(book_id, chapter_num, {"image_url": None})
+    await release_image((previous or {}).get("image_url"))
     
-    await db.books.update_one(
-        {"id": book_id},
-        {"$set": {"chapters": chapters, "updated_at": datetime.now(timezone.utc).isoformat()}}
-    )
+    await touch_book(book_id)
+    publish_progress(book_id, "image_removed", chapter_number=chapter_num, image_url=None)
     return {"status": "deleted"}
 
 @api_router.get("/images/{filename}")
-async def serve_image(filename: str):
-    file_path = IMAGES_DIR / filename
-    if not file_path.exists():
+async def serve_image(filename: str, request: Request, variant: Optional[str] = None, v: Optional[str] = None):
+    if variant and variant not in IMAGE_PROFILES:
+        raise HTTPException(status_code=400, detail=f"Unknown image variant: {variant}")
+    original = IMAGES_DIR / filename
+    # Dot files are staging and partial downloads, never published images
+    if original.parent != IMAGES_DIR or filename.startswith("."):
+        raise HTTPException(status_code=404, detail="Image not found")
+    if storage.redirects:
+        url = await stored_image_url(original, variant)
+        if url:
+            return redirect_to_storage(url)
+    if not await storage.fetch(original):
         raise HTTPException(status_code=404, detail="Image not found")
-    return FileResponse(str(file_path), media_type="image/png")
+    file_path = original
+    if variant:
+        file_path = await asyncio.to_thread(image_variant, original, variant)
+    
+    def inspect():
+        return file_digest(original), file_digest(file_path), sniff_image_type(file_path), file_path.stat().st_size
+    original_digest, digest, media_type, size = await asyncio.to_thread(inspect)
+    
+    etag = f'"{digest[:32]}"'
+    # Variants derive from the original, so the original's digest versions them too
+    immutable = bool(IMAGE_BLOB_RE.match(filename)) or (bool(v) and len(v) >= 8 and original_digest.startswith(v))
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        "Cache-Control": IMAGE_CACHE_IMMUTABLE if immutable else IMAGE_CACHE_REVALIDATE,
+    }
+    
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (not if_range or if_range.strip() == etag):
+        try:
+            byte_range = parse_byte_range(range_header, size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+        if byte_range:
+            start, end = byte_range
+            body = await asyncio.to_thread(read_byte_range, file_path, start, end)
+            return Response(body, status_code=206, media_type=media_type,
+                            headers={**headers, "Content-Range": f"bytes {start}-{end}/{size}"})
+    
+    return FileResponse(str(file_path), media_type=media_type, headers=headers)
+
+async def stored_image_url(original, variant=None):
+    """Presigned URL of an image (or of its variant, stored on first use), or
+    None if the image is not in storage."""
+    if not variant:
+        return storage.presigned_url(original) if await storage.exists(original) else None
+    if not await storage.fetch(original):
+        return None
+    file_path = await asyncio.to_thread(image_variant, original, variant)
+    if file_path != original and not await storage.exists(file_path):
+        await storage.publish(file_path, "image/jpeg", immutable=True)
+    return storage.presigned_url(file_path)
+
+# Library listing: stored fields that can be selected with ?fields=, the summary
+# returned by default, and the per-book counts computed from the chapters collection
+BOOK_LIST_STORED_FIELDS = {
+    "id", "title", "subtitle", "description", "category", "language", "target_pages",
+    "image_source", "status", "error", "cover_image", "created_at", "updated_at",
+    "outline", "kdp_metadata"
+}
+BOOK_LIST_COMPUTED_FIELDS = {"total_chapters", "generated_chapters", "images_count", "first_image"}
+BOOK_LIST_DEFAULT_FIELDS = [
+    "id", "title", "subtitle", "category", "language", "status", "cover_image",
+    "created_at", "updated_at", "total_chapters", "generated_chapters", "images_count", "first_image"
+]
+BOOK_LIST_MAX_LIMIT = 100
+
+def encode_books_cursor(book):
+    raw = json.dumps([book.get("created_at"), book.get("id")]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+def decode_books_cursor(cursor):
+    try:
+        created_at, book_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return created_at, book_id
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+async def chapter_stats(book_ids):
+    """Generated/illustrated chapter counts and first image URL per book."""
+    stats = await db.chapters.aggregate([
+        {"$match": {"book_id": {"$in": book_ids}}},
+        {"$sort": {"book_id": 1, "chapter_number": 1}},
+        {"$group": {
+            "_id": "$book_id",
+            "generated_chapters": {"$sum": 1},
+            "image_urls": {"$push": "$image_url"},
+        }},
+    ]).to_list(None)
+    result = {}
+    for st in stats:
+        image_urls = [url for url in st["image_urls"] if url]
+        result[st["_id"]] = {
+            "generated_chapters": st["generated_chapters"],
+            "images_count": len(image_urls),
+            "first_image": image_urls[0] if image_urls else None,
+        }
+    return result
 
 @api_router.get("/books")
-async def list_books():
-    books = await db.books.find({}, {"_id": 0}).sort("created_at", -1).to_list(100)
-    return {"books": books}
+async def list_books(limit: int = 50, cursor: Optional[str] = None, fields: Optional[str] = None):
+    """List books newest first as lightweight summaries, paginated by (created_at, id)."""
+    selected = [f.strip() for f in fields.split(",") if f.strip()] if fields else BOOK_LIST_DEFAULT_FIELDS
+    unknown = set(selected) - BOOK_LIST_STORED_FIELDS - BOOK_LIST_COMPUTED_FIELDS
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+    limit = max(1, min(limit, BOOK_LIST_MAX_LIMIT))
+    
+    match = {}
+    if cursor:
+        created_at, last_id = decode_books_cursor(cursor)
+        match = {"$or": [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "id": {"$lt": last_id}},
+        ]}
+    
+    projection = {"_id": 0, "id": 1, "created_at": 1}
+    for field in selected:
+        if field in BOOK_LIST_STORED_FIELDS:
+            projection[field] = 1
+    if "total_chapters" in selected:
+        projection["total_chapters"] = {"$size": {"$ifNull": ["$outline", []]}}
+    
+    books = await db.books.aggregate([
+        {"$match": match},
+        {"$sort": {"created_at": -1, "id": -1}},
+        {"$limit": limit + 1},
+        {"$project": projection},
+    ]).to_list(None)
+    has_more = len(books) > limit
+    books = books[:limit]
+    next_cursor = encode_books_cursor(books[-1]) if has_more else None
+    
+    if BOOK_LIST_COMPUTED_FIELDS.intersection(selected):
+        stats = await chapter_stats([b["id"] for b in books])
+        for book in books:
+            book_stats = stats.get(book["id"], {})
+            if "generated_chapters" in selected:
+                book["generated_chapters"] = book_stats.get("generated_chapters", 0)
+            if "images_count" in selected:
+                book["images_count"] = book_stats.get("images_count", 0)
+            if "first_image" in selected:
+                book["first_image"] = book_stats.get("first_image")
+    
+    # Only return what was asked for (id is always kept for navigation)
+    keep = set(selected) | {"id"}
+    books = [{k: v for k, v in book.items() if k in keep} for book in books]
+    return {"books": books, "next_cursor": next_cursor}
 
 @api_router.get("/books/{book_id}")
 async def get_book(book_id: str):
     book = await db.books.find_one({"id": book_id}, {"_id": 0})
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
-    return book
+    book["image_job"] = image_job_view(book)
+    book.pop("image_job_lease", None)
+    return await attach_chapters(book)
 
 @api_router.delete("/books/{book_id}")
 async def delete_book(book_id: str):
-    book = await db.books.find_one({"id": book_id}, {"_id": 0})
+    book = await db.books.find_one({"id": book_id}, {"_id": 0, "id": 1})
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
     
-    # Delete associated images
-    for ch in book.get("chapters", []):
-        img_url = ch.get("image_url", "")
-        if img_url and img_url.startswith("/api/images/"):
-            img_filename = img_url.replace("/api/images/", "")
-            img_path = IMAGES_DIR / img_filename
-            if img_path.exists():
-                try:
-                    img_path.unlink()
-                except Exception:
-                    pass
+    # Release associated images
+    for ch in await load_chapters(book_id, {"image_url": 1}):
+        await release_image(ch.get("image_url"))
     
-    # Delete export files
-    for ext in ["pdf", "docx", "epub"]:
-        export_path = EXPORTS_DIR / f"{book_id}.{ext}"
-        if export_path.exists():
-            try:
-                export_path.unlink()
-            except Exception:
-                pass
+    # Delete export files (legacy {id}.{ext} and cached {id}.{hash}.{ext})
+    for export_path in await storage.list(EXPORTS_DIR, f"{book_id}."):
+        try:
+            await storage.delete(export_path)
+        except Exception as e:
+            logger.error(f"Failed to delete export {export_path.name}: {e}")
     
     result = await db.books.delete_one({"id": book_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Book not found")
+    await db.chapters.delete_many({"book_id": book_id})
+    await db.chapter_drafts.delete_many({"book_id": book_id})
+    await db.page_maps.delete_many({"book_id": book_id})
+    # Workers notice the missing items at their next heartbeat and stop
+    await db.jobs.delete_many({"book_id": book_id})
+    await db.job_items.delete_many({"book_id": book_id})
     return {"status": "deleted"}
 
 @api_router.get("/books/{book_id}/progress")
 async def get_book_progress(book_id: str):
-    book = await db.books.find_one({"id": book_id}, {"_id": 0, "chapters.content": 0})
+    book = await db.books.find_one(
+        {"id": book_id}, {"_id": 0, "status": 1, "outline": 1, "error": 1, "image_job": 1, "image_job_lease": 1}
+    )
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
     
     outline = book.get("outline", [])
-    chapters = book.get("chapters", [])
+    chapters = await load_chapters(book_id, {"chapter_number": 1, "title": 1, "image_url": 1})
+    chapter_job = await db.jobs.find_one(
+        {"book_id": book_id, "kind": "chapters"}, {"_id": 0}, sort=[("created_at", -1)]
+    )
     
     return {
         "status": book.get("status"),
         "total_chapters": len(outline),
         "generated_chapters": len(chapters),
         "chapter_titles": [{"number": c.get("chapter_number"), "title": c.get("title"), "has_image": bool(c.get("image_url"))} for c in chapters],
-        "error": book.get("error")
+        "error": book.get("error"),
+        "image_job": image_job_view(book),
+        "chapter_job": chapter_job,
+        # Writing with no job behind it (interrupted legacy run, or chapters written
+        # one by one): generating all chapters again picks up the missing ones
+        "restartable": book.get("status") == "writing" and (chapter_job or {}).get("status") != "running"
+    }
+
+@api_router.get("/books/{book_id}/events")
+async def book_events(book_id: str, request: Request):
+    """Server-Sent Events stream of a book's progress.
+
+    Starts with a `snapshot` event (same payload as /progress), then pushes
+    `status`, `chapter_completed`, `chapter_failed`, `image_completed`,
+    `image_removed` and `image_job` events.
+    """
+    queue = progress_bus.subscribe(book_id)
+    try:
+        snapshot = await get_book_progress(book_id)
+    except HTTPException:
+        progress_bus.unsubscribe(book_id, queue)
+        raise
+    
+    async def stream():
+        try:
+            yield format_sse({"type": "snapshot", **snapshot})
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), PROGRESS_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield format_sse(event)
+        finally:
+            progress_bus.unsubscribe(book_id, queue)
+    
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# ====== JOB QUEUE ======
+# Bulk chapter generation runs as a durable job: one `jobs` document per run and
+# one `job_items` document per chapter. Workers (JOB_WORKER_SLOTS in each API
+# process, and/or `python worker.py` processes on any machine) claim items
+# atomically under a lease that a heartbeat keeps renewing. When a worker dies,
+# its lease expires and another worker claims the item again, so a job survives
+# restarts and deploys and resumes with the chapters still missing.
+# A job's `concurrency` caps how many of its items are leased at once across all
+# workers. Events published by external workers reach SSE clients only with
+# PROGRESS_EVENTS_SOURCE=changestream.
+# A chapter that fails (after the LLM call retries, or past CHAPTER_TASK_DEADLINE)
+# is recorded in the job's failed_chapters and the others carry on; while the
+# model's circuit is open, items are put back with a delay instead of failing.
+# Once an item's lease has been lost JOB_MAX_ATTEMPTS times (its worker crashed or
+# hung on it each time), its next claim fails it the same way rather than handing
+# it to yet another worker.
+JOB_WORKER_SLOTS = int(os.environ.get('JOB_WORKER_SLOTS', str(CHAPTER_CONCURRENCY_GLOBAL)))
+CHAPTER_TASK_DEADLINE = float(os.environ.get('CHAPTER_TASK_DEADLINE', '900'))
+JOB_LEASE_SECONDS = float(os.environ.get('JOB_LEASE_SECONDS', '60'))
+JOB_POLL_SECONDS = float(os.environ.get('JOB_POLL_SECONDS', '2'))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '3'))
+JOB_ACTIVE_ITEM_STATUSES = ["queued", "running"]
+# Set when this process queues work, so its worker does not wait for the next poll
+job_wakeup = asyncio.Event()
+job_worker_task = None
+
+def job_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+def lease_deadline():
+    return datetime.now(timezone.utc) + timedelta(seconds=JOB_LEASE_SECONDS)
+
+async def enqueue_chapter_job(book, concurrency):
+    """Queue the book's missing chapters; returns the job (the running one if
+    the book already has one), or None when nothing is missing."""
+    existing = await db.jobs.find_one({"book_id": book["id"], "kind": "chapters", "status": "running"}, {"_id": 0})
+    if existing:
+        return existing
+    
+    written = {c["chapter_number"] for c in await load_chapters(book["id"], {"chapter_number": 1})}
+    pending = [ch["chapter_number"] for ch in book.get("outline", []) if ch.get("chapter_number") not in written]
+    if not pending:
+        return None
+    
+    now = datetime.now(timezone.utc).isoformat()
+    job = {
+        "id": str(uuid.uuid4()),
+        "kind": "chapters",
+        "book_id": book["id"],
+        "status": "running",
+        "concurrency": concurrency,
+        "total": len(pending),
+        "completed": 0,
+        "failed": 0,
+        "failed_chapters": [],
+        "created_at": now,
+        "updated_at": now,
     }
+    try:
+        await db.jobs.insert_one(dict(job))
+    except DuplicateKeyError:
+        # Queued concurrently by another request
+        return await db.jobs.find_one({"book_id": book["id"], "kind": "chapters", "status": "running"}, {"_id": 0})
+    await db.job_items.insert_many([
+        {"job_id": job["id"], "book_id": book["id"], "chapter_number": num, "status": "queued",
+         "attempts": 0, "queued_at": now, "available_at": datetime.now(timezone.utc)}
+        for num in pending
+    ])
+    job_wakeup.set()
+    return job
+
+async def claim_job_item(owner, skip_jobs):
+    """Atomically lease the oldest available queued (or abandoned) item, or return None."""
+    now = datetime.now(timezone.utc)
+    return await db.job_items.find_one_and_update(
+        {"job_id": {"$nin": list(skip_jobs)},
+         "$or": [{"status": "queued", "available_at": {"$not": {"$gt": now}}},
+                 {"status": "running", "lease_expires_at": {"$lt": now}}]},
+        {"$set": {"status": "running", "lease_owner": owner, "lease_expires_at": lease_deadline(),
+                  "started_at": now.isoformat()},
+         "$inc": {"attempts": 1}},
+        sort=[("queued_at", 1), ("chapter_number", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+async def release_job_item(item, owner, delay=0):
+    """Hand a leased item back to the queue, claimable again after delay seconds."""
+    await db.job_items.update_one(
+        {"_id": item["_id"], "lease_owner": owner, "status": "running"},
+        {"$set": {"status": "queued", "available_at": datetime.now(timezone.utc) + timedelta(seconds=delay)},
+         "$unset": {"lease_owner": "", "lease_expires_at": ""}, "$inc": {"attempts": -1}}
+    )
+
+async def claim_next_job_item(owner):
+    """Lease the next item whose job is running and below its concurrency;
+    returns (item, job) or None."""
+    skip_jobs = set()
+    while True:
+        item = await claim_job_item(owner, skip_jobs)
+        if not item:
+            return None
+        job = await db.jobs.find_one({"id": item["job_id"]}, {"_id": 0})
+        if not job or job["status"] != "running":
+            await db.job_items.update_one({"_id": item["_id"]}, {"$set": {"status": "cancelled"}})
+            continue
+        if item["attempts"] > JOB_MAX_ATTEMPTS:
+            await fail_job_item(item, job, owner, f"Abandoned by its worker {JOB_MAX_ATTEMPTS} times")
+            continue
+        # Claim first, then check: concurrent claimers all see each other's leases,
+        # so a job never runs more than its concurrency
+        active = await db.job_items.count_documents({
+            "job_id": job["id"], "status": "running", "lease_expires_at": {"$gte": datetime.now(timezone.utc)}
+        })
+        if active > job["concurrency"]:
+            await release_job_item(item, owner)
+            skip_jobs.add(job["id"])
+            continue
+        return item, job
+
+async def hold_job_lease(item, owner, work):
+    """Renew an item's lease until cancelled; cancel the work if the lease is lost
+    (item cancelled, deleted or reclaimed)."""
+    while True:
+        await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+        try:
+            result = await db.job_items.update_one(
+                {"_id": item["_id"], "lease_owner": owner, "status": "running"},
+                {"$set": {"lease_expires_at": lease_deadline()}}
+            )
+        except Exception as e:
+            logger.warning(f"Job lease renewal failed: {e}")
+            continue
+        if result.matched_count == 0:
+            logger.warning(f"Lost lease on chapter {item['chapter_number']} of job {item['job_id']}")
+            work.cancel()
+            return
+
+async def fail_job_item(item, job, owner, error):
+    """Record a leased item as failed in its job, and finish the job if it was the last."""
+    ch_num = item["chapter_number"]
+    result = await db.job_items.update_one(
+        {"_id": item["_id"], "lease_owner": owner, "status": "running"},
+        {"$set": {"status": "failed", "error": error}, "$unset": {"lease_expires_at": ""}}
+    )
+    if not result.modified_count:
+        return
+    await db.jobs.update_one(
+        {"id": job["id"]},
+        {"$inc": {"failed": 1}, "$addToSet": {"failed_chapters": ch_num},
+         "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}}
+    )
+    publish_progress(job["book_id"], "chapter_failed", chapter_number=ch_num, error=error)
+    await finish_job_if_complete(job)
+
+async def finish_job_if_complete(job):
+    if await db.job_items.count_documents({"job_id": job["id"], "status": {"$in": JOB_ACTIVE_ITEM_STATUSES}}):
+        return
+    now = datetime.now(timezone.utc).isoformat()
+    finished = await db.jobs.find_one_and_update(
+        {"id": job["id"], "status": "running"},
+        {"$set": {"status": "done", "updated_at": now, "finished_at": now}},
+        projection={"_id": 0, "failed_chapters": 1}
+    )
+    if not finished:
+        return
+    failed = sorted(finished.get("failed_chapters") or [])
+    if failed:
+        # Generating again only queues the chapters still missing
+        await touch_book(job["book_id"], status="error",
+                         error=f"Chapter(s) {', '.join(map(str, failed))} failed; generate again to retry them")
+    else:
+        await touch_book(job["book_id"], status="chapters_complete")
+
+async def process_job_item(item, job, owner):
+    """Write one chapter of a job while holding its lease."""
+    ch_num = item["chapter_number"]
+    deadline = time.monotonic() + CHAPTER_TASK_DEADLINE
+    heartbeat = asyncio.create_task(hold_job_lease(item, owner, asyncio.current_task()))
+    try:
+        book = await db.books.find_one({"id": job["book_id"]}, {"_id": 0})
+        ch = find_outline_chapter(book, ch_num) if book else None
+        written = await db.chapters.find_one({"book_id": job["book_id"], "chapter_number": ch_num}, {"_id": 1})
+        if ch and not written:
+            await write_bulk_chapter(book, ch, deadline)
+        now = datetime.now(timezone.utc).isoformat()
+        result = await db.job_items.update_one(
+            {"_id": item["_id"], "lease_owner": owner, "status": "running"},
+            {"$set": {"status": "done", "finished_at": now}, "$unset": {"lease_expires_at": ""}}
+        )
+        if result.modified_count:
+            await db.jobs.update_one({"id": job["id"]}, {"$inc": {"completed": 1}, "$set": {"updated_at": now}})
+            await finish_job_if_complete(job)
+    except asyncio.CancelledError:
+        # Shutting down (or the lease is gone): let another worker take the chapter
+        await asyncio.shield(release_job_item(item, owner))
+        raise
+    except CircuitOpenError as e:
+        # The provider is degraded: retry the chapter once the circuit may close
+        await release_job_item(item, owner, delay=e.retry_after)
+    except Exception as e:
+        logger.error(f"Error generating chapter {ch_num}: {e}")
+        await fail_job_item(item, job, owner, str(e))
+    finally:
+        heartbeat.cancel()
+
+async def run_job_worker(slots=JOB_WORKER_SLOTS):
+    """Claim and process job items, at most `slots` at a time, until cancelled."""
+    owner = job_worker_id()
+    free_slots = asyncio.Semaphore(max(1, slots))
+    running = set()
+    logger.info(f"Job worker {owner} started with {slots} slot(s)")
+    
+    def item_finished(task):
+        running.discard(task)
+        free_slots.release()
+    
+    try:
+        while True:
+            await free_slots.acquire()
+            # Do not claim chapters this process would only shed
+            paused = llm_breaker(GEMINI_TEXT_MODEL).retry_after()
+            if paused:
+                free_slots.release()
+                await asyncio.sleep(min(paused, JOB_POLL_SECONDS))
+                continue
+            job_wakeup.clear()
+            try:
+                claimed = await claim_next_job_item(owner)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Job claim failed: {e}")
+                claimed = None
+            if not claimed:
+                free_slots.release()
+                try:
+                    await asyncio.wait_for(job_wakeup.wait(), JOB_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            task = asyncio.create_task(process_job_item(*claimed, owner))
+            running.add(task)
+            task.add_done_callback(item_finished)
+    finally:
+        for task in list(running):
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+
+@api_router.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await db.jobs.find_one({"id": job_id}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    items = await db.job_items.find(
+        {"job_id": job_id}, {"_id": 0, "chapter_number": 1, "status": 1, "attempts": 1, "error": 1}
+    ).sort("chapter_number", 1).to_list(None)
+    return {**job, "items": items}
 
 # ====== MARKDOWN HELPERS ======
 
+HEADING_RE = re.compile(r'^(#{1,4})\s+(.+)$')
+LIST_ITEM_RE = re.compile(r'^[-*]\s+(.+)$')
+NUM_LIST_ITEM_RE = re.compile(r'^\d+[.)]\s+(.+)$')
+HR_RE = re.compile(r'^[-*_]{3,}$')
+
 def parse_markdown_line(line):
     """Parse a markdown line and return (type, content, level)."""
     stripped = line.strip()
     if not stripped:
         return ("blank", "", 0)
-    header_match = re.match(r'^(#{1,4})\s+(.+)$', stripped)
+    header_match = HEADING_RE.match(stripped)
     if header_match:
         return ("heading", header_match.group(2).strip(), len(header_match.group(1)))
-    list_match = re.match(r'^[-*]\s+(.+)$', stripped)
+    list_match = LIST_ITEM_RE.match(stripped)
     if list_match:
         return ("list_item", list_match.group(1).strip(), 0)
-    num_match = re.match(r'^\d+[.)]\s+(.+)$', stripped)
+    num_match = NUM_LIST_ITEM_RE.match(stripped)
     if num_match:
         return ("num_list_item", num_match.group(1).strip(), 0)
-    if re.match(r'^[-*_]{3,}$', stripped):
+    if HR_RE.match(stripped):
         return ("hr", "", 0)
     return ("paragraph", stripped, 0)
 
+# ---- Inline markdown ----
+# Inline markdown is scanned once into spans [text, bold, italic, code, link]
+# (link is the URL or None); each output format is an emitter over the spans.
+# Alternatives are tried left to right at each position, so code and links win
+# over emphasis markers inside them. Single-underscore emphasis only opens and
+# closes at word boundaries, so identifiers like snake_case are left alone.
+INLINE_TOKEN_RE = re.compile(
+    r'`(?P<code>.+?)`'
+    r'|\[(?P<link_text>.+?)\]\((?P<link_url>.+?)\)'
+    r'|\*{3}(?P<bold_italic>.+?)\*{3}|_{3}(?P<bold_italic_u>.+?)_{3}'
+    r'|\*{2}(?P<bold>.+?)\*{2}|_{2}(?P<bold_u>.+?)_{2}'
+    r'|(?<!\*)\*(?!\*)(?P<italic>.+?)(?<!\*)\*(?!\*)'
+    r'|(?<!\w)_(?![_\s])(?P<italic_u>.+?)(?<![_\s])_(?!\w)'
+)
+INLINE_MARKERS_RE = re.compile(r'[*_`\[]')
+INLINE_STYLES = {
+    "bold_italic": (True, True), "bold_italic_u": (True, True),
+    "bold": (True, False), "bold_u": (True, False),
+    "italic": (False, True), "italic_u": (False, True),
+}
+
+def _append_span(spans, span):
+    if not span[0]:
+        return
+    if spans and spans[-1][1:] == span[1:]:
+        spans[-1][0] += span[0]
+    else:
+        spans.append(span)
+
+def tokenize_inline(text, bold=False, italic=False, link=None):
+    """Split inline markdown into [text, bold, italic, code, link] spans."""
+    if not INLINE_MARKERS_RE.search(text):
+        return [[text, bold, italic, False, link]] if text else []
+    spans = []
+    pos = 0
+    for m in INLINE_TOKEN_RE.finditer(text):
+        _append_span(spans, [text[pos:m.start()], bold, italic, False, link])
+        kind = m.lastgroup
+        if kind == "code":
+            _append_span(spans, [m.group("code"), bold, italic, True, link])
+        elif kind == "link_url":
+            for span in tokenize_inline(m.group("link_text"), bold, italic, m.group("link_url")):
+                _append_span(spans, span)
+        else:
+            b, i = INLINE_STYLES[kind]
+            for span in tokenize_inline(m.group(kind), bold or b, italic or i, link):
+                _append_span(spans, span)
+        pos = m.end()
+    _append_span(spans, [text[pos:], bold, italic, False, link])
+    return spans
+
+def _emit_markup(spans, escape, open_tag, close_tags):
+    """Render spans with properly nested tags.
+
+    Formatting nests as link > bold > italic > code; only the tags whose state
+    changes between two spans are closed and reopened.
+    """
+    out = []
+    open_state = [None, False, False, False]
+    for text, bold, italic, code, link in spans:
+        state = [link, bold, italic, code]
+        depth = 0
+        while depth < 4 and state[depth] == open_state[depth]:
+            depth += 1
+        for level in range(3, depth - 1, -1):
+            if open_state[level]:
+                out.append(close_tags[level])
+        for level in range(depth, 4):
+            if state[level]:
+                out.append(open_tag(level, state[level]))
+        open_state = state
+        out.append(escape(text))
+    for level in range(3, -1, -1):
+        if open_state[level]:
+            out.append(close_tags[level])
+    return ''.join(out)
+
+XML_OPEN_TAGS = ('<u>', '<b>', '<i>', '<font face="Courier" size="9">')
+XML_CLOSE_TAGS = ('</u>', '</b>', '</i>', '</font>')
+HTML_OPEN_TAGS = (None, '<strong>', '<em>', '<code>')
+HTML_CLOSE_TAGS = ('</a>', '</strong>', '</em>', '</code>')
+
+def _xml_escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+def spans_to_xml(spans):
+    """ReportLab paragraph markup."""
+    return _emit_markup(spans, _xml_escape, lambda level, value: XML_OPEN_TAGS[level], XML_CLOSE_TAGS)
+
+def spans_to_html(spans):
+    def open_tag(level, value):
+        return f'<a href="{html.escape(value)}">' if level == 0 else HTML_OPEN_TAGS[level]
+    return _emit_markup(spans, html.escape, open_tag, HTML_CLOSE_TAGS)
+
+def spans_to_plain(spans):
+    return ''.join(span[0] for span in spans)
+
+def spans_to_runs(spans):
+    """[text, bold, italic] runs for DOCX paragraphs."""
+    runs = []
+    for text, bold, italic, _code, _link in spans:
+        if runs and runs[-1][1:] == [bold, italic]:
+            runs[-1][0] += text
+        else:
+            runs.append([text, bold, italic])
+    return runs
+
+INLINE_EMITTERS = {"xml": spans_to_xml, "html": spans_to_html, "plain": spans_to_plain, "runs": spans_to_runs}
+
 def md_to_xml(text):
     """Convert inline markdown to ReportLab XML (bold, italic)."""
-    text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
-    text = re.sub(r'\*{3}(.+?)\*{3}', r'<b><i>\1</i></b>', text)
-    text = re.sub(r'_{3}(.+?)_{3}', r'<b><i>\1</i></b>', text)
-    text = re.sub(r'\*{2}(.+?)\*{2}', r'<b>\1</b>', text)
-    text = re.sub(r'_{2}(.+?)_{2}', r'<b>\1</b>', text)
-    text = re.sub(r'(?<![*])\*(?!\*)(.+?)(?<!\*)\*(?!\*)', r'<i>\1</i>', text)
-    text = re.sub(r'`(.+?)`', r'<font face="Courier" size="9">\1</font>', text)
-    text = re.sub(r'\[(.+?)\]\(.+?\)', r'<u>\1</u>', text)
-    return text
+    return spans_to_xml(tokenize_inline(text))
 
 def md_to_html(text):
     """Convert inline markdown to HTML (bold, italic, links)."""
-    import html as html_mod
-    text = html_mod.escape(text)
-    text = re.sub(r'\*{3}(.+?)\*{3}', r'<strong><em>\1</em></strong>', text)
-    text = re.sub(r'_{3}(.+?)_{3}', r'<strong><em>\1</em></strong>', text)
-    text = re.sub(r'\*{2}(.+?)\*{2}', r'<strong>\1</strong>', text)
-    text = re.sub(r'_{2}(.+?)_{2}', r'<strong>\1</strong>', text)
-    text = re.sub(r'(?<![*])\*(?!\*)(.+?)(?<!\*)\*(?!\*)', r'<em>\1</em>', text)
-    text = re.sub(r'`(.+?)`', r'<code>\1</code>', text)
-    text = re.sub(r'\[(.+?)\]\((.+?)\)', r'<a href="\2">\1</a>', text)
-    return text
+    return spans_to_html(tokenize_inline(text))
 
 def md_clean(text):
     """Strip all markdown to plain text."""
-    text = re.sub(r'\*{1,3}(.+?)\*{1,3}', r'\1', text)
-    text = re.sub(r'_{1,3}(.+?)_{1,3}', r'\1', text)
-    text = re.sub(r'`(.+?)`', r'\1', text)
-    text = re.sub(r'\[(.+?)\]\(.+?\)', r'\1', text)
-    return text
+    return spans_to_plain(tokenize_inline(text))
 
 def strip_chapter_title_from_content(content, chapter_title):
     """Remove the first heading if it matches or is similar to the chapter title."""
@@ -833,9 +2957,9 @@ def strip_chapter_title_from_content(content, chapter_title):
             start_idx = i + 1
             continue
         # Check if it's a heading matching the chapter title
-        header_match = re.match(r'^#{1,4}\s+(.+)$', stripped)
+        header_match = HEADING_RE.match(stripped)
         if header_match:
-            heading_text = md_clean(header_match.group(1)).strip().lower()
+            heading_text = md_clean(header_match.group(2)).strip().lower()
             # Check similarity (contains or is very similar)
             if heading_text == clean_title or clean_title in heading_text or heading_text in clean_title:
                 start_idx = i + 1
@@ -846,6 +2970,84 @@ def strip_chapter_title_from_content(content, chapter_title):
     
     return '\n'.join(lines[start_idx:])
 
+# ====== DOCUMENT MODEL ======
+# Exporters render chapters from a parsed document model: the title-stripped
+# content split into blocks, with inline markdown already rendered for every
+# output format. Models are keyed by a hash of the chapter title and content,
+# kept in an in-memory LRU and, with DOC_MODEL_PERSIST, stored on the chapter
+# document so that only changed chapters are ever re-parsed.
+DOC_MODEL_VERSION = 3
+DOC_MODEL_CACHE_SIZE = int(os.environ.get('DOC_MODEL_CACHE_SIZE', '512'))
+DOC_MODEL_PERSIST = os.environ.get('DOC_MODEL_PERSIST', 'false').lower() in ('1', 'true', 'yes')
+doc_model_cache: "OrderedDict[str, dict]" = OrderedDict()
+
+def chapter_content_hash(chapter):
+    raw = json.dumps([DOC_MODEL_VERSION, chapter.get("title") or "", chapter.get("content") or ""], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def render_inline(text):
+    """Inline spans of a line, plus their rendering by every inline emitter."""
+    spans = tokenize_inline(text)
+    return {"spans": spans, **{name: emit(spans) for name, emit in INLINE_EMITTERS.items()}}
+
+def parse_chapter_document(chapter):
+    """Parse a chapter into {hash, title, blocks}."""
+    content = strip_chapter_title_from_content(chapter.get("content") or "", chapter.get("title") or "")
+    blocks = []
+    for line in content.split("\n"):
+        line_type, line_content, level = parse_markdown_line(line)
+        block = {"type": line_type, "level": level, "text": line_content}
+        if line_content:
+            block.update(render_inline(line_content))
+        blocks.append(block)
+    return {"hash": chapter_content_hash(chapter), "title": render_inline(chapter.get("title") or ""), "blocks": blocks}
+
+def remember_chapter_document(doc):
+    doc_model_cache[doc["hash"]] = doc
+    doc_model_cache.move_to_end(doc["hash"])
+    while len(doc_model_cache) > DOC_MODEL_CACHE_SIZE:
+        doc_model_cache.popitem(last=False)
+    return doc
+
+def cached_chapter_document(chapter, key=None):
+    """The chapter's model if already attached or cached, else None."""
+    key = key or chapter_content_hash(chapter)
+    attached = chapter.get("document")
+    if attached and attached.get("hash") == key:
+        return attached
+    return doc_model_cache.get(key)
+
+def chapter_document(chapter):
+    """Document model of a chapter, parsing it only on a cache miss."""
+    doc = cached_chapter_document(chapter)
+    return remember_chapter_document(doc or parse_chapter_document(chapter))
+
+async def attach_chapter_documents(book):
+    """Set chapter["document"] on every chapter of the book, parsing only changed chapters."""
+    stale = []
+    for ch in book.get("chapters", []):
+        doc = cached_chapter_document(ch)
+        if doc is None:
+            stale.append(ch)
+        else:
+            ch["document"] = remember_chapter_document(doc)
+    if not stale:
+        return book
+    docs = await asyncio.to_thread(lambda: [parse_chapter_document(ch) for ch in stale])
+    for ch, doc in zip(stale, docs):
+        ch["document"] = remember_chapter_document(doc)
+    if DOC_MODEL_PERSIST:
+        try:
+            await db.chapters.bulk_write([
+                UpdateOne({"book_id": book["id"], "chapter_number": ch["chapter_number"]},
+                          {"$set": {"document": ch["document"]}})
+                for ch in stale
+            ], ordered=False)
+        except Exception as e:
+            logger.error(f"Failed to persist document models for {book['id']}: {e}")
+    logger.info(f"Parsed {len(stale)} of {len(book.get('chapters', []))} chapter(s) of {book['id']}")
+    return book
+
 
 # ====== KDP METADATA ROUTES ======
 
@@ -856,7 +3058,7 @@ async def generate_kdp_metadata(book_id: str):
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
     
-    chapters = book.get("chapters", [])
+    chapters = await load_chapters(book_id, {"chapter_number": 1, "title": 1, "content": 1})
     if not chapters:
         raise HTTPException(status_code=400, detail="Book has no chapters yet")
     
@@ -941,6 +3143,8 @@ Format: {{"title": "...", "subtitle": "...", "description": "...", "keywords": [
     except json.JSONDecodeError:
         logger.error(f"Failed to parse KDP metadata JSON: {response[:300]}")
         raise HTTPException(status_code=500, detail="Failed to parse AI response")
+    except CircuitOpenError as e:
+        raise llm_unavailable(e)
     except Exception as e:
         logger.error(f"KDP metadata generation error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -956,27 +3160,64 @@ async def get_kdp_metadata(book_id: str):
 # ====== EXPORT ROUTES ======
 
 @api_router.post("/books/{book_id}/export")
-async def export_book(book_id: str, req: ExportRequest):
+async def export_book(book_id: str, req: ExportRequest, request: Request):
     book = await db.books.find_one({"id": book_id}, {"_id": 0})
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
     
+    await attach_chapters(book, {"book_id": 0})
     if not book.get("chapters"):
         raise HTTPException(status_code=400, detail="Book has no chapters")
     
     fmt = req.format.lower()
+    renderers = {"pdf": render_pdf, "docx": render_docx, "epub": render_epub}
+    if fmt not in renderers:
+        raise HTTPException(status_code=400, detail=f"Unsupported format: {fmt}")
+    if req.interior not in INTERIOR_IMAGE_PROFILES:
+        raise HTTPException(status_code=400, detail=f"Unsupported interior: {req.interior}")
+    book["image_profile"] = INTERIOR_IMAGE_PROFILES[req.interior]
     
     try:
-        if fmt == "pdf":
-            filepath = await export_pdf(book)
-        elif fmt == "docx":
-            filepath = await export_docx(book)
-        elif fmt == "epub":
-            filepath = await export_epub(book)
+        # Renderers read images from disk: bring missing ones into the local cache
+        for ch in book["chapters"]:
+            img_path = local_image_path(ch.get("image_url"))
+            if img_path:
+                await storage.fetch(img_path)
+        image_digests = await asyncio.to_thread(chapter_image_digests, book["chapters"])
+        cache_key = export_cache_key(book, image_digests, fmt, req.model_dump(exclude={"book_id", "format"}))
+        filepath = EXPORTS_DIR / f"{book['id']}.{req.interior}.{cache_key}.{fmt}"
+        
+        if await storage.exists(filepath):
+            logger.info(f"Export cache hit for {book['id']} ({fmt})")
         else:
-            raise HTTPException(status_code=400, detail=f"Unsupported format: {fmt}")
+            # Render next to the final name and rename, so a concurrent request
+            # never serves a half-written artifact
+            tmp_path = filepath.with_name(f"{filepath.name}.{uuid.uuid4().hex}.part")
+            await attach_chapter_documents(book)
+            layout_key = page_map_key(book, image_digests)
+            try:
+                if fmt == "pdf":
+                    # Laying out the PDF measures the page map; keep it for DOCX/EPUB
+                    pages = await run_render_job(layout_pdf, book, str(tmp_path))
+                    await store_page_map(book["id"], layout_key, pages)
+                else:
+                    book["page_map"] = await get_page_map(book, layout_key)
+                    await run_renderer(renderers[fmt], book, tmp_path)
+                await run_asset_io(os.replace, tmp_path, filepath)
+            finally:
+                tmp_path.unlink(missing_ok=True)
+            await storage.publish(filepath, EXPORT_MEDIA_TYPES[fmt])
+            await prune_export_cache(book["id"], req.interior, fmt, filepath)
         
         filename = f"{book['title'].replace(' ', '_')}_{book['id'][:8]}.{fmt}"
+        if storage.redirects:
+            url = storage.presigned_url(filepath, filename=filename, media_type="application/octet-stream")
+            # Scripts follow the redirect (as a GET); the app asks for JSON and
+            # downloads the link itself, which needs no CORS on the bucket
+            if "application/json" in request.headers.get("accept", ""):
+                return {"download_url": url, "filename": filename}
+            return RedirectResponse(url, status_code=303)
+        await storage.fetch(filepath)
         return FileResponse(
             str(filepath),
             media_type="application/octet-stream",
@@ -986,8 +3227,156 @@ async def export_book(book_id: str, req: ExportRequest):
         logger.error(f"Export error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-async def export_pdf(book):
-    """Generate KDP-compliant PDF with accurate page numbers and TOC."""
+# ---- Render pool ----
+# Renderers are plain synchronous functions taking a JSON-serializable book and
+# an output path, so they can run in worker processes without blocking the
+# event loop. EXPORT_WORKERS=0 runs them in a thread instead.
+EXPORT_WORKERS = int(os.environ.get('EXPORT_WORKERS', str(min(4, os.cpu_count() or 1))))
+render_pool = None
+
+def get_render_pool():
+    global render_pool
+    if render_pool is None:
+        # spawn, not fork: the parent runs an event loop and driver threads
+        render_pool = ProcessPoolExecutor(max_workers=EXPORT_WORKERS,
+                                          mp_context=multiprocessing.get_context("spawn"))
+    return render_pool
+
+async def run_render_job(func, *args):
+    """Run a module-level render/layout function off the event loop."""
+    if EXPORT_WORKERS <= 0:
+        return await asyncio.to_thread(func, *args)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_render_pool(), func, *args)
+
+async def run_renderer(renderer, book, filepath):
+    """Render a book with one of the render_* functions."""
+    return Path(await run_render_job(renderer, book, str(filepath)))
+
+# ---- Export cache ----
+# Artifacts are stored as {book_id}.{interior}.{cache_key}.{fmt}, where cache_key
+# hashes everything that affects rendering; the color and bw interiors of a format
+# are cached side by side. Bump EXPORT_RENDERER_VERSION whenever an
+# exporter change alters its output.
+EXPORT_RENDERER_VERSION = 6
+file_digest_cache: Dict[str, tuple] = {}
+
+def file_digest(path):
+    """SHA-256 of a file, memoized on (mtime, size)."""
+    st = path.stat()
+    cached = file_digest_cache.get(str(path))
+    if cached and cached[0] == (st.st_mtime_ns, st.st_size):
+        return cached[1]
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    digest = sha.hexdigest()
+    file_digest_cache[str(path)] = ((st.st_mtime_ns, st.st_size), digest)
+    return digest
+
+def chapter_image_digests(chapters):
+    """Map chapter number -> digest of its local image file (None when absent)."""
+    digests = {}
+    for ch in chapters:
+        img_path = local_image_path(ch.get("image_url"))
+        digests[ch["chapter_number"]] = file_digest(img_path) if img_path and img_path.exists() else None
+    return digests
+
+def book_content_hash(book, image_digests):
+    """Deterministic hash of the book content that exporters render."""
+    payload = {
+        "title": book.get("title"),
+        "subtitle": book.get("subtitle"),
+        "language": book.get("language"),
+        "chapters": [
+            {
+                "number": ch.get("chapter_number"),
+                "title": ch.get("title"),
+                "content": ch.get("content"),
+                "image": image_digests.get(ch.get("chapter_number")),
+            }
+            for ch in sorted(book.get("chapters", []), key=lambda x: x.get("chapter_number", 0))
+        ],
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def export_cache_key(book, image_digests, fmt, options):
+    raw = json.dumps([EXPORT_RENDERER_VERSION, book_content_hash(book, image_digests), fmt, options], sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+
+EXPORT_MEDIA_TYPES = {
+    "pdf": "application/pdf",
+    "docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "epub": "application/epub+zip",
+}
+
+async def prune_export_cache(book_id, interior, fmt, keep):
+    """Remove older cached artifacts of this book, interior and format."""
+    for old_path in await storage.list(EXPORTS_DIR, f"{book_id}.{interior}."):
+        if old_path != keep and old_path.suffix == f".{fmt}":
+            try:
+                await storage.delete(old_path)
+            except Exception as e:
+                logger.error(f"Failed to prune export {old_path.name}: {e}")
+
+# ---- Page map ----
+# Chapter start pages are measured by the PDF layout (the KDP 5.5x8.5 trim) and
+# shared by the DOCX and EPUB tables of contents. Maps are keyed by everything
+# the layout depends on, cached in memory and in the page_maps collection, so a
+# layout runs at most once per content change whatever formats are exported.
+PAGE_MAP_CACHE_SIZE = int(os.environ.get('PAGE_MAP_CACHE_SIZE', '256'))
+page_map_cache: "OrderedDict[str, dict]" = OrderedDict()
+
+def page_map_key(book, image_digests):
+    chapters = sorted(book.get("chapters", []), key=lambda x: x.get("chapter_number", 0))
+    payload = [
+        EXPORT_RENDERER_VERSION, book.get("language"), book.get("title"), book.get("subtitle"),
+        # Images are laid out at a fixed size, so only their presence matters
+        [[ch.get("chapter_number"), chapter_content_hash(ch), image_digests.get(ch.get("chapter_number")) is not None]
+         for ch in chapters],
+    ]
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def remember_page_map(key, pages):
+    page_map_cache[key] = pages
+    page_map_cache.move_to_end(key)
+    while len(page_map_cache) > PAGE_MAP_CACHE_SIZE:
+        page_map_cache.popitem(last=False)
+    return pages
+
+async def store_page_map(book_id, key, pages):
+    remember_page_map(key, pages)
+    await db.page_maps.replace_one(
+        {"book_id": book_id},
+        {"book_id": book_id, "key": key, "pages": pages, "created_at": datetime.now(timezone.utc).isoformat()},
+        upsert=True
+    )
+
+async def get_page_map(book, key):
+    """Chapter number (as a string) -> start page, laying the book out only on a cache miss."""
+    pages = page_map_cache.get(key)
+    if pages is not None:
+        return remember_page_map(key, pages)
+    stored = await db.page_maps.find_one({"book_id": book["id"], "key": key}, {"_id": 0, "pages": 1})
+    if stored:
+        return remember_page_map(key, stored["pages"])
+    pages = await run_render_job(layout_pdf, book, None)
+    await store_page_map(book["id"], key, pages)
+    logger.info(f"Computed page map for {book['id']}: {pages}")
+    return pages
+
+def book_page_map(book):
+    """The page map attached by the export route, or a fresh layout."""
+    return book.get("page_map") or layout_pdf(book)
+
+def render_pdf(book, filepath):
+    """Generate KDP-compliant PDF with accurate page numbers and TOC in a single layout pass."""
+    layout_pdf(book, str(filepath))
+    return filepath
+
+def layout_pdf(book, output=None):
+    """Lay out the PDF into output (a path, or discarded when None) and return its page map."""
     from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
     from reportlab.platypus import (
         BaseDocTemplate, PageTemplate, Frame, Paragraph, Spacer, 
@@ -999,7 +3388,6 @@ async def export_pdf(book):
     from reportlab.platypus.flowables import HRFlowable
     from io import BytesIO
     
-    filepath = EXPORTS_DIR / f"{book['id']}.pdf"
     page_w = 5.5 * inch
     page_h = 8.5 * inch
     left_m = 0.75 * inch
@@ -1010,6 +3398,7 @@ async def export_pdf(book):
     
     is_fr = book.get('language') != 'en'
     chapters = sorted(book.get('chapters', []), key=lambda x: x.get('chapter_number', 0))
+    image_profile = book.get('image_profile', 'print')
     
     # ---- Styles ----
     def make_styles():
@@ -1039,57 +3428,83 @@ async def export_pdf(book):
             leading=20, alignment=TA_RIGHT))
         return s
     
+    # ---- TOC page numbers (forward references) ----
+    # Each TOC entry draws a PDF form named after its chapter; the form itself
+    # is only defined when the chapter's marker is laid out, so the document
+    # is built in a single pass. The number column has a fixed width, so the
+    # TOC occupies the same space whatever the final numbers are.
+    def toc_form_name(ch_num):
+        return f"tocPage{ch_num}"
+
+    class TOCPageNumber(Flowable):
+        """Right-aligned TOC page number, resolved when the chapter is placed."""
+        def __init__(self, ch_num, style):
+            Flowable.__init__(self)
+            self.ch_num = ch_num
+            self.style = style
+        def wrap(self, aW, aH):
+            self.width = aW
+            self.height = self.style.leading
+            return (self.width, self.height)
+        def draw(self):
+            self.canv.saveState()
+            self.canv.translate(self.width, self.height - self.style.fontSize)
+            self.canv.doForm(toc_form_name(self.ch_num))
+            self.canv.restoreState()
+
     # ---- Chapter marker flowable ----
     class ChapterMark(Flowable):
         """Invisible flowable that records which page a chapter starts on."""
         width = 0
         height = 0
-        def __init__(self, ch_num, tracker_dict):
+        def __init__(self, ch_num, tracker_dict, style):
             Flowable.__init__(self)
             self.ch_num = ch_num
             self.tracker_dict = tracker_dict
+            self.style = style
         def draw(self):
-            self.tracker_dict[self.ch_num] = self.canv.getPageNumber()
+            page = self.canv.getPageNumber()
+            self.tracker_dict[self.ch_num] = page
+            # Define the form the TOC entry already references
+            self.canv.beginForm(toc_form_name(self.ch_num), lowerx=-72, lowery=-12, upperx=0, uppery=24)
+            self.canv.setFont('Times-Bold', self.style.fontSize)
+            self.canv.drawRightString(0, 0, str(page))
+            self.canv.endForm()
         def wrap(self, aW, aH):
             return (0, 0)
     
     # ---- Build chapter content flowables ----
     def build_chapter_body(chapter, styles):
         flowables = []
-        content = strip_chapter_title_from_content(
-            chapter.get('content', ''), chapter.get('title', ''))
-        if chapter.get('image_url') and chapter['image_url'].startswith('/api/images/'):
-            img_filename = chapter['image_url'].replace('/api/images/', '')
-            img_path = IMAGES_DIR / img_filename
-            if img_path.exists():
-                try:
-                    img = Image(str(img_path), width=3.2 * inch, height=2.2 * inch)
-                    img.hAlign = 'CENTER'
-                    flowables.append(img)
-                    flowables.append(Spacer(1, 14))
-                except Exception:
-                    pass
-        for line in content.split('\n'):
-            lt, lc, lv = parse_markdown_line(line)
+        img_path = chapter_image_path(chapter, image_profile)
+        if img_path:
+            try:
+                img = Image(str(img_path), width=3.2 * inch, height=2.2 * inch)
+                img.hAlign = 'CENTER'
+                flowables.append(img)
+                flowables.append(Spacer(1, 14))
+            except Exception:
+                pass
+        for block in chapter_document(chapter)["blocks"]:
+            lt, lv = block["type"], block["level"]
             if lt == "blank":
                 flowables.append(Spacer(1, 4))
             elif lt == "heading":
-                xml = md_to_xml(lc)
-                flowables.append(Paragraph(xml, styles[{1:'H2',2:'H2',3:'H3'}.get(lv,'H4')]))
+                flowables.append(Paragraph(block["xml"], styles[{1:'H2',2:'H2',3:'H3'}.get(lv,'H4')]))
             elif lt == "list_item":
-                flowables.append(Paragraph(f"\u2022  {md_to_xml(lc)}", styles['ListItem']))
+                flowables.append(Paragraph(f"\u2022  {block['xml']}", styles['ListItem']))
             elif lt == "num_list_item":
-                flowables.append(Paragraph(f"\u2013  {md_to_xml(lc)}", styles['ListItem']))
+                flowables.append(Paragraph(f"\u2013  {block['xml']}", styles['ListItem']))
             elif lt == "hr":
                 flowables.append(Spacer(1, 6))
                 flowables.append(HRFlowable(width="60%", thickness=0.5, color=colors.Color(.7,.7,.7)))
                 flowables.append(Spacer(1, 6))
             elif lt == "paragraph":
-                flowables.append(Paragraph(md_to_xml(lc), styles['Body']))
+                flowables.append(Paragraph(block["xml"], styles['Body']))
         return flowables
     
-    # ---- Build full story (without real TOC page numbers) ----
-    def build_story(styles, toc_page_map=None):
+    # ---- Build full story ----
+    def build_story(styles):
         story = []
         # Title page
         story.append(Spacer(1, 2.5 * inch))
@@ -1106,11 +3521,10 @@ async def export_pdf(book):
         for ch in chapters:
             ch_num = ch['chapter_number']
             ch_lbl = f"Chapitre {ch_num}" if is_fr else f"Chapter {ch_num}"
-            title_text = f"{ch_lbl}  -  {md_to_xml(ch['title'])}"
-            page_str = str(toc_page_map.get(ch_num, "")) if toc_page_map else ""
+            title_text = f"{ch_lbl}  -  {chapter_document(ch)['title']['xml']}"
             toc_rows.append([
                 Paragraph(title_text, styles['TOCLeft']),
-                Paragraph(f"<b>{page_str}</b>", styles['TOCRight']),
+                TOCPageNumber(ch_num, styles['TOCRight']),
             ])
         if toc_rows:
             t = Table(toc_rows, colWidths=[content_w - 0.6*inch, 0.6*inch])
@@ -1127,13 +3541,13 @@ async def export_pdf(book):
         for ch in chapters:
             cn = ch['chapter_number']
             # Marker (invisible, records page number)
-            story.append(ChapterMark(cn, page_tracker))
+            story.append(ChapterMark(cn, page_tracker, styles['TOCRight']))
             # Chapter title page
             story.append(Spacer(1, 2.5 * inch))
             lbl = f"CHAPITRE {cn}" if is_fr else f"CHAPTER {cn}"
             story.append(Paragraph(lbl, styles['ChapLabel']))
             story.append(Spacer(1, 12))
-            story.append(Paragraph(md_to_xml(ch['title']), styles['ChapTitlePage']))
+            story.append(Paragraph(chapter_document(ch)['title']['xml'], styles['ChapTitlePage']))
             story.append(PageBreak())
             # Chapter body
             story.extend(build_chapter_body(ch, styles))
@@ -1150,53 +3564,22 @@ async def export_pdf(book):
             canvas.drawCentredString(page_w / 2, 0.4 * inch, str(pn))
             canvas.restoreState()
     
-    # ===== PASS 1: Build to get real page numbers =====
     page_tracker = {}
-    styles1 = make_styles()
-    story1 = build_story(styles1, toc_page_map=None)
-    
-    buf1 = BytesIO()
-    doc1 = BaseDocTemplate(buf1, pagesize=(page_w, page_h),
-        leftMargin=left_m, rightMargin=right_m, topMargin=top_m, bottomMargin=bottom_m)
-    frame1 = Frame(left_m, bottom_m, content_w, page_h - top_m - bottom_m, id='main')
-    doc1.addPageTemplates([
-        PageTemplate(id='first', frames=[frame1], onPage=lambda c,d: None),
-        PageTemplate(id='later', frames=[frame1], onPage=draw_page_number),
-    ])
-    # Switch to 'later' template after first page
-    story1.insert(1, Spacer(0, 0))  # ensure the template switch happens
-    
-    try:
-        doc1.build(story1)
-    except Exception as e:
-        logger.error(f"PDF pass 1 error: {e}")
+    styles = make_styles()
+    story = build_story(styles)
     
-    logger.info(f"PDF Pass 1 - Chapter page map: {page_tracker}")
-    
-    # ===== PASS 2: Rebuild with correct TOC page numbers =====
-    page_tracker_pass2 = {}
-    # Re-point ChapterMark to new dict so pass2 markers don't overwrite
-    # We'll use the pass1 results
-    final_page_map = dict(page_tracker)
-    
-    # Build a new tracker for pass 2 (won't be used for TOC but keeps markers happy)
-    page_tracker.clear()
-    
-    styles2 = make_styles()
-    story2 = build_story(styles2, toc_page_map=final_page_map)
-    
-    doc2 = BaseDocTemplate(str(filepath), pagesize=(page_w, page_h),
+    doc = BaseDocTemplate(output if output is not None else BytesIO(), pagesize=(page_w, page_h),
         leftMargin=left_m, rightMargin=right_m, topMargin=top_m, bottomMargin=bottom_m)
-    frame2 = Frame(left_m, bottom_m, content_w, page_h - top_m - bottom_m, id='main')
-    doc2.addPageTemplates([
-        PageTemplate(id='first', frames=[frame2], onPage=lambda c,d: None),
-        PageTemplate(id='later', frames=[frame2], onPage=draw_page_number),
+    frame = Frame(left_m, bottom_m, content_w, page_h - top_m - bottom_m, id='main')
+    doc.addPageTemplates([
+        PageTemplate(id='first', frames=[frame], onPage=lambda c,d: None),
+        PageTemplate(id='later', frames=[frame], onPage=draw_page_number),
     ])
     
-    doc2.build(story2)
-    return filepath
+    doc.build(story)
+    return {str(ch_num): page for ch_num, page in page_tracker.items()}
 
-async def export_docx(book):
+def render_docx(book, filepath):
     """Generate KDP-compliant DOCX with proper formatting, chapter title pages, TOC with page numbers."""
     from docx import Document
     from docx.shared import Inches, Pt, RGBColor
@@ -1204,7 +3587,6 @@ async def export_docx(book):
     from docx.oxml.ns import qn
     from docx.oxml import OxmlElement
     
-    filepath = EXPORTS_DIR / f"{book['id']}.docx"
     doc = Document()
     is_fr = book.get('language') != 'en'
     
@@ -1231,48 +3613,8 @@ async def export_docx(book):
     
     chapters = sorted(book.get('chapters', []), key=lambda x: x.get('chapter_number', 0))
     
-    # ---- PRE-CALCULATE real page numbers ----
-    # KDP 5.5x8.5 with margins => usable area ~4.25 x 7 inches
-    # At 11pt Times Roman ~16pt leading, about 31 lines per page, ~10 words/line => ~310 words/page
-    # A heading takes ~2 lines, a list item ~1.5 lines, image ~12 lines
-    WORDS_PER_PAGE = 280  # conservative for formatted text
-    LINES_PER_PAGE = 31
-    
-    chapter_page_starts = {}
-    current_page = 3  # page 1 = title, page 2 = TOC (at least), page 3+ = chapters
-    
-    # Estimate TOC pages: ~1.5 lines per entry
-    toc_lines = len(chapters) * 1.5 + 4  # header + spacing
-    toc_pages = max(1, int(toc_lines / LINES_PER_PAGE) + 1)
-    current_page = 1 + toc_pages + 1  # title page + toc pages + 1
-    
-    for ch in chapters:
-        chapter_page_starts[ch['chapter_number']] = current_page
-        current_page += 1  # chapter title page
-        
-        content = strip_chapter_title_from_content(ch.get('content', ''), ch.get('title', ''))
-        lines = content.split('\n')
-        
-        # Count estimated lines
-        total_lines = 0
-        if ch.get('image_url'):
-            total_lines += 14  # image takes ~14 lines
-        for line in lines:
-            lt, lc, lv = parse_markdown_line(line)
-            if lt == "blank":
-                total_lines += 0.5
-            elif lt == "heading":
-                total_lines += 3
-            elif lt in ("list_item", "num_list_item"):
-                total_lines += 1.2
-            elif lt == "paragraph":
-                word_count = len(lc.split())
-                total_lines += max(1, word_count / 10)
-            elif lt == "hr":
-                total_lines += 2
-        
-        content_pages = max(1, int(total_lines / LINES_PER_PAGE) + 1)
-        current_page += content_pages
+    # Chapter start pages, as measured by the PDF layout
+    chapter_page_starts = book_page_map(book)
     
     # ---- TITLE PAGE ----
     for _ in range(8):
@@ -1298,12 +3640,12 @@ async def export_docx(book):
     
     for row_idx, ch in enumerate(chapters):
         ch_lbl = f"Chapitre {ch['chapter_number']}" if is_fr else f"Chapter {ch['chapter_number']}"
-        page_num = chapter_page_starts.get(ch['chapter_number'], "")
+        page_num = chapter_page_starts.get(str(ch['chapter_number']), "")
         
         left_cell = toc_table.cell(row_idx, 0)
         left_cell.text = ""
         lp = left_cell.paragraphs[0]
-        run = lp.add_run(f"{ch_lbl}  -  {md_clean(ch['title'])}")
+        run = lp.add_run(f"{ch_lbl}  -  {chapter_document(ch)['title']['plain']}")
         run.font.name = 'Georgia'; run.font.size = Pt(11)
         
         right_cell = toc_table.cell(row_idx, 1)
@@ -1337,88 +3679,58 @@ async def export_docx(book):
         lr.font.size = Pt(10); lr.font.color.rgb = RGBColor(128,128,128); lr.font.name = 'Arial'
         tp = doc.add_paragraph()
         tp.alignment = WD_ALIGN_PARAGRAPH.CENTER
-        tr = tp.add_run(md_clean(chapter['title']))
+        tr = tp.add_run(chapter_document(chapter)['title']['plain'])
         tr.font.size = Pt(22); tr.bold = True; tr.font.name = 'Georgia'
         doc.add_page_break()
         
         # Chapter image
-        if chapter.get('image_url') and chapter['image_url'].startswith('/api/images/'):
-            img_filename = chapter['image_url'].replace('/api/images/', '')
-            img_path = IMAGES_DIR / img_filename
-            if img_path.exists():
-                try:
-                    doc.add_picture(str(img_path), width=Inches(3.5))
-                    doc.paragraphs[-1].alignment = WD_ALIGN_PARAGRAPH.CENTER
-                    doc.add_paragraph()
-                except Exception: pass
+        img_path = chapter_image_path(chapter, book.get('image_profile', 'print'))
+        if img_path:
+            try:
+                doc.add_picture(str(img_path), width=Inches(3.5))
+                doc.paragraphs[-1].alignment = WD_ALIGN_PARAGRAPH.CENTER
+                doc.add_paragraph()
+            except Exception: pass
         
         # Chapter content (stripped)
-        content = strip_chapter_title_from_content(chapter.get('content', ''), chapter.get('title', ''))
-        for line in content.split('\n'):
-            lt, lc, lv = parse_markdown_line(line)
-            cleaned = md_clean(lc)
+        for block in chapter_document(chapter)["blocks"]:
+            lt, lv = block["type"], block["level"]
             if lt == "blank": continue
             elif lt == "heading":
-                h = doc.add_heading(cleaned, level=min(lv+1, 4))
+                h = doc.add_heading(block["plain"], level=min(lv+1, 4))
                 for r in h.runs: r.font.name = 'Georgia'
             elif lt in ("list_item", "num_list_item"):
                 p = doc.add_paragraph(style='List Bullet' if lt == "list_item" else 'List Number')
-                _add_formatted_runs(p, lc); p.paragraph_format.space_after = Pt(3)
+                _add_formatted_runs(p, block["runs"]); p.paragraph_format.space_after = Pt(3)
             elif lt == "hr":
                 p = doc.add_paragraph(); p.alignment = WD_ALIGN_PARAGRAPH.CENTER
                 r = p.add_run("_" * 30); r.font.color.rgb = RGBColor(180,180,180)
             elif lt == "paragraph":
                 p = doc.add_paragraph()
-                _add_formatted_runs(p, lc); p.paragraph_format.space_after = Pt(6)
+                _add_formatted_runs(p, block["runs"]); p.paragraph_format.space_after = Pt(6)
                 p.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
         doc.add_page_break()
     
     doc.save(str(filepath))
     return filepath
 
-def _add_formatted_runs(paragraph, text):
-    """Add runs with bold/italic formatting from markdown to a DOCX paragraph."""
+def _add_formatted_runs(paragraph, segments):
+    """Add [text, bold, italic] runs (see spans_to_runs) to a DOCX paragraph."""
     from docx.shared import Pt
     
-    # Process bold+italic, bold, italic patterns
-    parts = re.split(r'(\*{2,3}.+?\*{2,3}|_{2,3}.+?_{2,3})', text)
-    for part in parts:
-        if re.match(r'^\*{3}(.+?)\*{3}$', part) or re.match(r'^_{3}(.+?)_{3}$', part):
-            clean = re.sub(r'^[*_]{3}|[*_]{3}$', '', part)
-            run = paragraph.add_run(clean)
+    for text, bold, italic in segments:
+        run = paragraph.add_run(text)
+        if bold:
             run.bold = True
+        if italic:
             run.italic = True
-            run.font.name = 'Georgia'
-            run.font.size = Pt(11)
-        elif re.match(r'^\*{2}(.+?)\*{2}$', part) or re.match(r'^_{2}(.+?)_{2}$', part):
-            clean = re.sub(r'^[*_]{2}|[*_]{2}$', '', part)
-            run = paragraph.add_run(clean)
-            run.bold = True
-            run.font.name = 'Georgia'
-            run.font.size = Pt(11)
-        else:
-            # Could still contain single * italic
-            sub_parts = re.split(r'(\*[^*]+?\*)', part)
-            for sp in sub_parts:
-                if re.match(r'^\*([^*]+?)\*$', sp):
-                    clean = sp.strip('*')
-                    run = paragraph.add_run(clean)
-                    run.italic = True
-                    run.font.name = 'Georgia'
-                    run.font.size = Pt(11)
-                else:
-                    # Strip remaining markdown
-                    cleaned = md_clean(sp)
-                    if cleaned:
-                        run = paragraph.add_run(cleaned)
-                        run.font.name = 'Georgia'
-                        run.font.size = Pt(11)
-
-async def export_epub(book):
+        run.font.name = 'Georgia'
+        run.font.size = Pt(11)
+
+def render_epub(book, filepath):
     """Generate EPUB with proper formatting, chapter title pages, TOC."""
     from ebooklib import epub
     
-    filepath = EXPORTS_DIR / f"{book['id']}.epub"
     is_fr = book.get('language') != 'en'
     
     ebook = epub.EpubBook()
@@ -1458,9 +3770,10 @@ async def export_epub(book):
                            file_name="toc.xhtml", lang=book.get('language', 'fr'))
     toc_label = "Table des matieres" if is_fr else "Table of Contents"
     toc_html = f"<h1>{toc_label}</h1><table class='toc-table'>"
-    for idx, ch_data in enumerate(chapters):
+    chapter_page_starts = book_page_map(book)
+    for ch_data in chapters:
         ch_lbl = f"Chapitre {ch_data['chapter_number']}" if is_fr else f"Chapter {ch_data['chapter_number']}"
-        toc_html += f'<tr><td><a href="chapter_{ch_data["chapter_number"]}.xhtml">{ch_lbl}  -  {md_to_html(ch_data["title"])}</a></td><td>{idx + 3}</td></tr>'
+        toc_html += f'<tr><td><a href="chapter_{ch_data["chapter_number"]}.xhtml">{ch_lbl}  -  {chapter_document(ch_data)["title"]["html"]}</a></td><td>{chapter_page_starts.get(str(ch_data["chapter_number"]), "")}</td></tr>'
     toc_html += "</table>"
     toc_ch.content = toc_html
     toc_ch.add_item(style)
@@ -1478,18 +3791,15 @@ async def export_epub(book):
         # Dedicated chapter title section
         content_html = f'<div class="chapter-title-page">'
         content_html += f'<p class="chapter-label">{ch_label}</p>'
-        content_html += f'<h1 class="chapter-title">{md_to_html(chapter["title"])}</h1>'
+        content_html += f'<h1 class="chapter-title">{chapter_document(chapter)["title"]["html"]}</h1>'
         content_html += f'</div><hr/>'
         
         # Content with title stripped
-        stripped_content = strip_chapter_title_from_content(
-            chapter.get('content', ''), chapter.get('title', ''))
-        
         in_list = False
         list_type = None
         
-        for line in stripped_content.split('\n'):
-            line_type, line_content, level = parse_markdown_line(line)
+        for block in chapter_document(chapter)["blocks"]:
+            line_type, level = block["type"], block["level"]
             
             if line_type in ("list_item", "num_list_item"):
                 new_list_type = "ul" if line_type == "list_item" else "ol"
@@ -1499,7 +3809,7 @@ async def export_epub(book):
                     content_html += f"<{new_list_type}>"
                     in_list = True
                     list_type = new_list_type
-                content_html += f"<li>{md_to_html(line_content)}</li>"
+                content_html += f"<li>{block['html']}</li>"
                 continue
             
             if in_list:
@@ -1511,11 +3821,11 @@ async def export_epub(book):
                 continue
             elif line_type == "heading":
                 tag = f"h{min(level + 1, 4)}"
-                content_html += f"<{tag}>{md_to_html(line_content)}</{tag}>"
+                content_html += f"<{tag}>{block['html']}</{tag}>"
             elif line_type == "hr":
                 content_html += "<hr/>"
             elif line_type == "paragraph":
-                content_html += f"<p>{md_to_html(line_content)}</p>"
+                content_html += f"<p>{block['html']}</p>"
         
         if in_list:
             content_html += f"</{list_type}>"
@@ -1550,6 +3860,58 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def prepare_database():
+    await ensure_indexes()
+    await migrate_embedded_chapters()
+    await verify_query_plans()
+
+@app.on_event("startup")
+async def start_settings_sync():
+    global settings_watch_task
+    if SETTINGS_SYNC_MODE == "changestream":
+        settings_watch_task = asyncio.create_task(watch_settings())
+
+@app.on_event("startup")
+async def start_progress_events():
+    global progress_watch_task
+    if PROGRESS_EVENTS_SOURCE == "changestream":
+        progress_watch_task = asyncio.create_task(watch_progress_changes())
+
+@app.on_event("startup")
+async def start_job_worker():
+    global job_worker_task
+    if JOB_WORKER_SLOTS > 0:
+        job_worker_task = asyncio.create_task(run_job_worker(JOB_WORKER_SLOTS))
+
+@app.on_event("startup")
+async def start_storage_cache_trim():
+    global storage_cache_task
+    if STORAGE_CACHE_MAX_MB > 0 and isinstance(storage, S3Storage):
+        storage_cache_task = asyncio.create_task(trim_storage_cache())
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    if job_worker_task:
+        # In-flight chapters go back to the queue for the next worker
+        job_worker_task.cancel()
+        await asyncio.gather(job_worker_task, return_exceptions=True)
+    if settings_watch_task:
+        settings_watch_task.cancel()
+    if progress_watch_task:
+        progress_watch_task.cancel()
+    if storage_cache_task:
+        storage_cache_task.cancel()
+    for genai_client, close_task in list(retired_genai_clients.values()):
+        close_task.cancel()
+        await close_genai_client(genai_client)
+    for genai_client in list(genai_clients.values()):
+        await close_genai_client(genai_client)
+    genai_clients.clear()
+    if http_session:
+        await http_session.close()
+    if render_pool:
+        render_pool.shutdown(wait=False, cancel_futures=True)
+    # Let in-flight asset writes finish their rename, without blocking the loop
+    await asyncio.to_thread(asset_io_pool.shutdown, True)
     client.close()
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+"""Upload local images and exports to the configured storage bucket.
+
+Run once when switching an existing deployment to STORAGE_BACKEND=s3, before
+the other replicas start relying on the bucket (it is safe to re-run: assets
+already stored are skipped):
+
+    STORAGE_BACKEND=s3 S3_BUCKET=... python storage_backfill.py [--dry-run]
+"""
+
+import argparse
+import asyncio
+
+import server
+
+
+async def main(dry_run):
+    try:
+        stats = await server.backfill_storage(dry_run=dry_run)
+    finally:
+        await server.shutdown_db_client()
+    verb = "Would upload" if dry_run else "Uploaded"
+    print(f"{verb} {stats['uploaded']} asset(s), {stats['bytes'] / 1e6:.1f} MB; "
+          f"{stats['present']} already stored")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dry-run", action="store_true", help="only count what would be uploaded")
+    args = parser.parse_args()
+    if server.STORAGE_BACKEND == "local":
+        parser.error("STORAGE_BACKEND is local: there is no bucket to fill")
+    asyncio.run(main(args.dry_run))
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""Standalone job queue worker.
+
+Claims and processes the bulk chapter generation jobs queued by the API,
+alongside the API processes and any other worker, on this machine or another:
+
+    python worker.py [--slots 6]
+
+Run the API with JOB_WORKER_SLOTS=0 to leave all generation to these workers.
+Stopping a worker (SIGINT/SIGTERM) hands its in-flight chapters back to the queue.
+"""
+
+import argparse
+import asyncio
+import signal
+
+import server
+
+
+async def main(slots):
+    await server.ensure_indexes()
+    worker = asyncio.create_task(server.run_job_worker(slots))
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, worker.cancel)
+    try:
+        await worker
+    except asyncio.CancelledError:
+        pass
+    finally:
+        await server.shutdown_db_client()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--slots", type=int, default=server.CHAPTER_CONCURRENCY_GLOBAL,
+                        help="chapters processed at once by this worker")
+    args = parser.parse_args()
+    asyncio.run(main(args.slots))
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""Microbenchmark: inline markdown rendering of a large chapter.
+
+Compares the previous multi-pass regex helpers with the single-pass
+tokenizer in backend/server.py, for every exporter format.
+
+The headline gain comes from tokenizing each line once and rendering all four
+formats from the same spans (what the exporters do); a single format rendered
+on its own is only marginally faster than its old regex chain.
+
+    python bench_markdown.py [--lines 5000] [--repeat 5]
+"""
+
+import argparse
+import os
+import re
+import sys
+import timeit
+from pathlib import Path
+
+# Add the backend directory to the Python path
+backend_dir = Path(__file__).parent / "backend"
+sys.path.insert(0, str(backend_dir))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "bench")
+
+import server  # noqa: E402
+
+
+# ---- Previous implementation (one regex pass per construct) ----
+
+def legacy_md_to_xml(text):
+    text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    text = re.sub(r'\*{3}(.+?)\*{3}', r'<b><i>\1</i></b>', text)
+    text = re.sub(r'_{3}(.+?)_{3}', r'<b><i>\1</i></b>', text)
+    text = re.sub(r'\*{2}(.+?)\*{2}', r'<b>\1</b>', text)
+    text = re.sub(r'_{2}(.+?)_{2}', r'<b>\1</b>', text)
+    text = re.sub(r'(?<![*])\*(?!\*)(.+?)(?<!\*)\*(?!\*)', r'<i>\1</i>', text)
+    text = re.sub(r'`(.+?)`', r'<font face="Courier" size="9">\1</font>', text)
+    text = re.sub(r'\[(.+?)\]\(.+?\)', r'<u>\1</u>', text)
+    return text
+
+
+def legacy_md_to_html(text):
+    import html as html_mod
+    text = html_mod.escape(text)
+    text = re.sub(r'\*{3}(.+?)\*{3}', r'<strong><em>\1</em></strong>', text)
+    text = re.sub(r'_{3}(.+?)_{3}', r'<strong><em>\1</em></strong>', text)
+    text = re.sub(r'\*{2}(.+?)\*{2}', r'<strong>\1</strong>', text)
+    text = re.sub(r'_{2}(.+?)_{2}', r'<strong>\1</strong>', text)
+    text = re.sub(r'(?<![*])\*(?!\*)(.+?)(?<!\*)\*(?!\*)', r'<em>\1</em>', text)
+    text = re.sub(r'`(.+?)`', r'<code>\1</code>', text)
+    text = re.sub(r'\[(.+?)\]\((.+?)\)', r'<a href="\2">\1</a>', text)
+    return text
+
+
+def legacy_md_clean(text):
+    text = re.sub(r'\*{1,3}(.+?)\*{1,3}', r'\1', text)
+    text = re.sub(r'_{1,3}(.+?)_{1,3}', r'\1', text)
+    text = re.sub(r'`(.+?)`', r'\1', text)
+    text = re.sub(r'\[(.+?)\]\(.+?\)', r'\1', text)
+    return text
+
+
+def legacy_docx_runs(text):
+    runs = []
+    parts = re.split(r'(\*{2,3}.+?\*{2,3}|_{2,3}.+?_{2,3})', text)
+    for part in parts:
+        if re.match(r'^\*{3}(.+?)\*{3}$', part) or re.match(r'^_{3}(.+?)_{3}$', part):
+            runs.append([re.sub(r'^[*_]{3}|[*_]{3}$', '', part), True, True])
+        elif re.match(r'^\*{2}(.+?)\*{2}$', part) or re.match(r'^_{2}(.+?)_{2}$', part):
+            runs.append([re.sub(r'^[*_]{2}|[*_]{2}$', '', part), True, False])
+        else:
+            for sp in re.split(r'(\*[^*]+?\*)', part):
+                if re.match(r'^\*([^*]+?)\*$', sp):
+                    runs.append([sp.strip('*'), False, True])
+                else:
+                    cleaned = legacy_md_clean(sp)
+                    if cleaned:
+                        runs.append([cleaned, False, False])
+    return runs
+
+
+def legacy_all(lines):
+    for line in lines:
+        legacy_md_to_xml(line)
+        legacy_md_to_html(line)
+        legacy_md_clean(line)
+        legacy_docx_runs(line)
+
+
+def tokenizer_all(lines):
+    for line in lines:
+        server.render_inline(line)
+
+
+SAMPLE_LINES = [
+    "Le **premier point** est *essentiel* pour comprendre la suite du chapitre, "
+    "comme le montre l'exemple `calcul()` et la [documentation](https://example.com/doc).",
+    "Une phrase simple sans aucune mise en forme, mais assez longue pour ressembler "
+    "a un vrai paragraphe de livre ecrit par le modele de langage.",
+    "***Attention*** : les __regles__ changent & il faut <verifier> chaque *detail* **avant** de publier.",
+    "Liste de mots : alpha, beta, gamma, delta, *epsilon*, zeta, **eta**, theta.",
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=5000, help="lines in the synthetic chapter")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    lines = [SAMPLE_LINES[i % len(SAMPLE_LINES)] for i in range(args.lines)]
+    words = sum(len(line.split()) for line in lines)
+    print(f"Chapter: {args.lines} lines, {words} words; all four renderings per line")
+
+    legacy = min(timeit.repeat(lambda: legacy_all(lines), number=1, repeat=args.repeat))
+    tokenizer = min(timeit.repeat(lambda: tokenizer_all(lines), number=1, repeat=args.repeat))
+    print(f"  regex passes : {legacy * 1000:8.1f} ms")
+    print(f"  tokenizer    : {tokenizer * 1000:8.1f} ms  ({legacy / tokenizer:.1f}x faster, "
+          f"from sharing one tokenization across the four formats)")
+    print("Single format per line")
+
+    per_format = [
+        ("xml", legacy_md_to_xml, server.md_to_xml),
+        ("html", legacy_md_to_html, server.md_to_html),
+        ("plain", legacy_md_clean, server.md_clean),
+    ]
+    for name, old, new in per_format:
+        t_old = min(timeit.repeat(lambda: [old(line) for line in lines], number=1, repeat=args.repeat))
+        t_new = min(timeit.repeat(lambda: [new(line) for line in lines], number=1, repeat=args.repeat))
+        print(f"  {name:<6} alone: {t_old * 1000:7.1f} ms -> {t_new * 1000:7.1f} ms  ({t_old / t_new:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
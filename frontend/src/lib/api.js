@@ -17,19 +17,44 @@ export const generateIdeas = (data) => api.post("/ideas/generate", data).then(r
 
 // Books
 export const createBook = (data) => api.post("/books/create", data).then(r => r.data);
-export const getBooks = () => api.get("/books").then(r => r.data);
+export const getBooks = (params) => api.get("/books", { params }).then(r => r.data);
 export const getBook = (id) => api.get(`/books/${id}`).then(r => r.data);
 export const deleteBook = (id) => api.delete(`/books/${id}`).then(r => r.data);
 export const getBookProgress = (id) => api.get(`/books/${id}/progress`).then(r => r.data);
 
+// Push-based progress (Server-Sent Events). Calls onEvent(type, data) for each
+// event and returns a function that closes the stream. Falls back to polling
+// /progress every 5s (as "snapshot" events) when EventSource is unavailable.
+const BOOK_EVENT_TYPES = ["snapshot", "status", "chapter_completed", "image_completed", "image_removed", "image_job"];
+export const subscribeBookEvents = (id, onEvent) => {
+  if (typeof window.EventSource === "undefined") {
+    const interval = setInterval(async () => {
+      try {
+        onEvent("snapshot", await getBookProgress(id));
+      } catch (err) {}
+    }, 5000);
+    return () => clearInterval(interval);
+  }
+  const source = new EventSource(`${API}/books/${id}/events`);
+  BOOK_EVENT_TYPES.forEach((type) => {
+    source.addEventListener(type, (e) => onEvent(type, JSON.parse(e.data)));
+  });
+  return () => source.close();
+};
+
 // Book Generation
 export const generateOutline = (bookId) => api.post(`/books/${bookId}/generate-outline`).then(r => r.data);
 export const updateOutline = (bookId, outline) => api.put(`/books/${bookId}/outline`, { book_id: bookId, outline }).then(r => r.data);
 export const generateChapter = (bookId, chapterNum) => api.post(`/books/${bookId}/generate-chapter/${chapterNum}`).then(r => r.data);
 export const generateAllChapters = (bookId) => api.post(`/books/${bookId}/generate-all-chapters`).then(r => r.data);
 export const generateChapterImage = (bookId, chapterNum) => api.post(`/books/${bookId}/generate-image/${chapterNum}`).then(r => r.data);
+export const generateAllImages = (bookId) => api.post(`/books/${bookId}/generate-all-images`).then(r => r.data);
 export const deleteChapterImage = (bookId, chapterNum) => api.delete(`/books/${bookId}/image/${chapterNum}`).then(r => r.data);
 
+// Image URLs may already carry a ?v= content version
+export const withImageVariant = (imageUrl, variant) =>
+  variant ? `${imageUrl}${imageUrl.includes("?") ? "&" : "?"}variant=${variant}` : imageUrl;
+
 // Export
 export const exportBook = (bookId, format) => 
   api.post(`/books/${bookId}/export`, { book_id: bookId, format }, { responseType: 'blob' }).then(r => r);
@@ -14,7 +14,7 @@ import { Progress } from "@/components/ui/progress";
 import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from "@/components/ui/select";
 import {
   generateIdeas, createBook, generateOutline, updateOutline,
-  generateChapter, generateAllChapters, getBookProgress
+  generateChapter, generateAllChapters, subscribeBookEvents
 } from "@/lib/api";
 
 const steps = [
@@ -34,6 +34,8 @@ export default function BookCreator() {
   const [theme, setTheme] = useState(themeFromDashboard);
   const [language, setLanguage] = useState(langFromDashboard);
   const [ideas, setIdeas] = useState([]);
+  // Query the shown ideas came from: asking again for it means "give me new ones"
+  const [ideasQuery, setIdeasQuery] = useState(null);
   const [selectedIdea, setSelectedIdea] = useState(null);
   const [loading, setLoading] = useState(false);
   const [bookId, setBookId] = useState(null);
@@ -55,10 +57,12 @@ export default function BookCreator() {
       return;
     }
     setLoading(true);
+    const query = `${theme.trim()}|${language}`;
     try {
-      const data = await generateIdeas({ theme, language });
+      const data = await generateIdeas({ theme, language, fresh: query === ideasQuery });
       if (data.ideas?.length > 0) {
         setIdeas(data.ideas);
+        setIdeasQuery(query);
         toast.success(language === "fr" ? "Idees generees !" : "Ideas generated!");
       } else {
         toast.error(data.error || "No ideas generated");
@@ -124,23 +128,32 @@ export default function BookCreator() {
   };
 
   const pollProgress = () => {
-    const interval = setInterval(async () => {
-      try {
-        const progress = await getBookProgress(bookId);
-        setWritingProgress(progress);
-        
-        if (progress.status === "chapters_complete") {
-          clearInterval(interval);
-          toast.success(language === "fr" ? "Livre termine ! Rendez-vous dans la bibliotheque." : "Book complete! Check the library.");
-          navigate(`/book/${bookId}`);
-        } else if (progress.status === "error") {
-          clearInterval(interval);
-          toast.error(progress.error || "Error during generation");
-        }
-      } catch (err) {
-        // Keep polling
+    const stop = subscribeBookEvents(bookId, (type, event) => {
+      if (type === "snapshot") {
+        setWritingProgress(event);
+      } else if (type === "chapter_completed") {
+        setWritingProgress((prev) => {
+          if (!prev || prev.chapter_titles?.some((c) => c.number === event.chapter_number)) return prev;
+          const chapter_titles = [...(prev.chapter_titles || []), { number: event.chapter_number, title: event.title, has_image: false }]
+            .sort((a, b) => a.number - b.number);
+          return { ...prev, chapter_titles, generated_chapters: chapter_titles.length };
+        });
+        return;
+      } else if (type === "status") {
+        setWritingProgress((prev) => (prev ? { ...prev, status: event.status, error: event.error } : prev));
+      } else {
+        return;
+      }
+
+      if (event.status === "chapters_complete") {
+        stop();
+        toast.success(language === "fr" ? "Livre termine ! Rendez-vous dans la bibliotheque." : "Book complete! Check the library.");
+        navigate(`/book/${bookId}`);
+      } else if (event.status === "error") {
+        stop();
+        toast.error(event.error || "Error during generation");
       }
-    }, 5000);
+    });
   };
 
   return (
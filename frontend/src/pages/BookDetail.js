@@ -16,15 +16,15 @@ import {
   DropdownMenu, DropdownMenuContent, DropdownMenuItem, DropdownMenuTrigger
 } from "@/components/ui/dropdown-menu";
 import {
-  getBook, getBookProgress, generateChapter, generateChapterImage,
-  deleteChapterImage, exportBook, generateKdpMetadata, getKdpMetadata
+  getBook, subscribeBookEvents, generateChapter, generateAllChapters, generateChapterImage, generateAllImages,
+  deleteChapterImage, exportBook, generateKdpMetadata, getKdpMetadata, withImageVariant
 } from "@/lib/api";
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 
-function getImageSrc(imageUrl) {
+function getImageSrc(imageUrl, variant) {
   if (!imageUrl) return null;
-  if (imageUrl.startsWith("/api")) return `${BACKEND_URL}${imageUrl}`;
+  if (imageUrl.startsWith("/api")) return `${BACKEND_URL}${withImageVariant(imageUrl, variant)}`;
   return imageUrl;
 }
 
@@ -36,6 +36,8 @@ export default function BookDetail() {
   const [exporting, setExporting] = useState(false);
   const [generatingChapter, setGeneratingChapter] = useState(null);
   const [generatingImage, setGeneratingImage] = useState(null);
+  const [imageJob, setImageJob] = useState(null);
+  const [writingStalled, setWritingStalled] = useState(false);
   const [deletingImage, setDeletingImage] = useState(null);
   const [expandedChapter, setExpandedChapter] = useState(null);
   const [previewMode, setPreviewMode] = useState(false);
@@ -49,6 +51,7 @@ export default function BookDetail() {
     try {
       const data = await getBook(bookId);
       setBook(data);
+      setImageJob(data.image_job || null);
     } catch (err) {
       toast.error("Failed to load book");
       navigate("/library");
@@ -71,18 +74,64 @@ export default function BookDetail() {
 
   useEffect(() => {
     if (!book || book.status !== "writing") return;
-    const interval = setInterval(async () => {
-      try {
-        const progress = await getBookProgress(bookId);
-        if (progress.status !== "writing") {
-          clearInterval(interval);
-          fetchBook();
-        }
-      } catch (err) {}
-    }, 5000);
-    return () => clearInterval(interval);
+    const stop = subscribeBookEvents(bookId, (type, event) => {
+      // Writing with no job running (e.g. interrupted by a restart) can be resumed
+      if (type === "snapshot") setWritingStalled(Boolean(event.restartable));
+      if ((type === "snapshot" || type === "status") && event.status !== "writing") {
+        stop();
+        setWritingStalled(false);
+        fetchBook();
+      }
+    });
+    return stop;
   }, [book, bookId, fetchBook]);
 
+  const imageJobRunning = imageJob?.status === "running";
+  // The server reports a job whose worker stopped as interrupted; it can be restarted
+  const imageJobInterrupted = imageJob?.status === "interrupted";
+
+  useEffect(() => {
+    if (!imageJobRunning) return;
+    const stop = subscribeBookEvents(bookId, (type, event) => {
+      const job = type === "snapshot" ? event.image_job : type === "image_job" ? event : null;
+      if (type === "image_completed") fetchBook();
+      if (!job) return;
+      setImageJob(job);
+      if (job.status !== "running") {
+        stop();
+        fetchBook();
+        if (job.status === "interrupted") {
+          toast.error(is_fr ? "Generation des images interrompue" : "Image generation was interrupted");
+        } else if (job.failed > 0) {
+          toast.error(`${job.failed} image(s) could not be generated`);
+        } else {
+          toast.success(is_fr ? "Images generees !" : "Images generated!");
+        }
+      }
+    });
+    return stop;
+  }, [imageJobRunning, bookId, fetchBook]); // eslint-disable-line
+
+  const handleGenerateAllImages = async () => {
+    try {
+      const job = await generateAllImages(bookId);
+      setImageJob(job);
+      if (job.total === 0) toast.info(is_fr ? "Tous les chapitres ont deja une image" : "Every chapter already has an image");
+    } catch (err) {
+      toast.error(err.response?.data?.detail || "Failed to start image generation");
+    }
+  };
+
+  const handleResumeWriting = async () => {
+    try {
+      await generateAllChapters(bookId);
+      setWritingStalled(false);
+      toast.success(is_fr ? "Ecriture relancee" : "Writing resumed");
+    } catch (err) {
+      toast.error(err.response?.data?.detail || "Failed to resume writing");
+    }
+  };
+
   const handleGenerateChapter = async (chapterNum) => {
     setGeneratingChapter(chapterNum);
     try {
@@ -130,15 +179,19 @@ export default function BookDetail() {
     setExporting(true);
     try {
       const response = await exportBook(bookId, format);
-      const blob = new Blob([response.data]);
-      const url = window.URL.createObjectURL(blob);
       const a = document.createElement("a");
-      a.href = url;
-      a.download = `${book.title.replace(/\s+/g, "_")}.${format}`;
+      if ((response.headers["content-type"] || "").includes("application/json")) {
+        // Stored in object storage: download straight from the presigned link
+        const { download_url } = JSON.parse(await response.data.text());
+        a.href = download_url;
+      } else {
+        a.href = window.URL.createObjectURL(new Blob([response.data]));
+        a.download = `${book.title.replace(/\s+/g, "_")}.${format}`;
+      }
       document.body.appendChild(a);
       a.click();
       a.remove();
-      window.URL.revokeObjectURL(url);
+      if (a.download) window.URL.revokeObjectURL(a.href);
       toast.success(`Exported as ${format.toUpperCase()}!`);
     } catch (err) {
       toast.error(`Export failed: ${err.message}`);
@@ -257,7 +310,7 @@ export default function BookDetail() {
               {ch.image_url && (
                 <div className="mb-6 flex justify-center">
                   <img
-                    src={getImageSrc(ch.image_url)}
+                    src={getImageSrc(ch.image_url, "web")}
                     alt={ch.title}
                     className="max-w-full h-auto rounded-lg max-h-64 object-cover"
                   />
@@ -329,8 +382,42 @@ export default function BookDetail() {
         </div>
 
         <div className="flex gap-3 opacity-0 animate-fade-in-up animate-stagger-1" style={{ animationFillMode: "forwards" }}>
+          {writingStalled && (
+            <Button
+              variant="outline"
+              onClick={handleResumeWriting}
+              data-testid="resume-writing-btn"
+              className="border-white/10 text-white/60 hover:bg-white/5 h-10"
+            >
+              <RefreshCw className="w-4 h-4 mr-2" />
+              {is_fr ? "Reprendre l'ecriture" : "Resume writing"}
+            </Button>
+          )}
           {chapters.length > 0 && (
             <>
+              {(imageJobRunning || chapters.some((c) => !c.image_url)) && (
+                <Button
+                  variant="outline"
+                  onClick={handleGenerateAllImages}
+                  disabled={imageJobRunning}
+                  data-testid="generate-all-images-btn"
+                  className="border-white/10 text-white/60 hover:bg-white/5 h-10"
+                >
+                  {imageJobRunning ? (
+                    <>
+                      <Loader2 className="w-4 h-4 mr-2 animate-spin" />
+                      {imageJob.completed + imageJob.failed} / {imageJob.total}
+                    </>
+                  ) : (
+                    <>
+                      <ImageIcon className="w-4 h-4 mr-2" />
+                      {imageJobInterrupted
+                        ? (is_fr ? "Reprendre les images" : "Resume images")
+                        : (is_fr ? "Generer les images" : "Generate images")}
+                    </>
+                  )}
+                </Button>
+              )}
               <Button
                 variant="outline"
                 onClick={() => setPreviewMode(true)}
@@ -419,7 +506,7 @@ export default function BookDetail() {
                   {/* Show image thumbnail inline */}
                   {hasImage && (
                     <img
-                      src={getImageSrc(chapter.image_url)}
+                      src={getImageSrc(chapter.image_url, "web")}
                       alt=""
                       className="w-10 h-10 rounded object-cover border border-white/10"
                     />
@@ -445,7 +532,7 @@ export default function BookDetail() {
                         <div className="mb-6 p-4 rounded-lg bg-black/30 border border-white/5" data-testid={`chapter-image-${outlineCh.chapter_number}`}>
                           <div className="flex items-start gap-4">
                             <img
-                              src={getImageSrc(chapter.image_url)}
+                              src={getImageSrc(chapter.image_url, "web")}
                               alt={chapter.title}
                               className="w-48 h-32 rounded-lg object-cover border border-white/10"
                             />
@@ -29,16 +29,21 @@ export default function Dashboard() {
   const [loading, setLoading] = useState(false);
   const [language, setLanguage] = useState("fr");
   const [category, setCategory] = useState("all");
+  // Query the shown themes came from: asking again for it means "give me new ones"
+  const [shownQuery, setShownQuery] = useState(null);
 
   const handleDiscover = async () => {
     setLoading(true);
+    const query = `${category}|${language}`;
     try {
       const data = await discoverThemes({
         category: category === "all" ? null : category,
         language,
+        fresh: query === shownQuery,
       });
       if (data.themes && data.themes.length > 0) {
         setThemes(data.themes);
+        setShownQuery(query);
         toast.success(language === "fr" ? "Thématiques découvertes !" : "Themes discovered!");
       } else {
         toast.error(data.error || "No themes found");
@@ -5,7 +5,9 @@ import { BookOpen, Trash2, Eye, Loader2, Clock, CheckCircle, AlertCircle, FileTe
 import { Button } from "@/components/ui/button";
 import { Card } from "@/components/ui/card";
 import { Badge } from "@/components/ui/badge";
-import { getBooks, deleteBook } from "@/lib/api";
+import { getBooks, deleteBook, withImageVariant } from "@/lib/api";
+
+const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 
 const statusConfig = {
   outline_pending: { label: "Outline Pending", color: "text-amber-400 bg-amber-500/10 border-amber-500/20", icon: Clock },
@@ -20,6 +22,8 @@ export default function Library() {
   const navigate = useNavigate();
   const [books, setBooks] = useState([]);
   const [loading, setLoading] = useState(true);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [loadingMore, setLoadingMore] = useState(false);
 
   useEffect(() => {
     fetchBooks();
@@ -29,6 +33,7 @@ export default function Library() {
     try {
       const data = await getBooks();
       setBooks(data.books || []);
+      setNextCursor(data.next_cursor || null);
     } catch (err) {
       toast.error("Failed to load library");
     } finally {
@@ -36,6 +41,20 @@ export default function Library() {
     }
   };
 
+  const fetchMoreBooks = async () => {
+    if (!nextCursor) return;
+    setLoadingMore(true);
+    try {
+      const data = await getBooks({ cursor: nextCursor });
+      setBooks((prev) => [...prev, ...(data.books || [])]);
+      setNextCursor(data.next_cursor || null);
+    } catch (err) {
+      toast.error("Failed to load library");
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
   const handleDelete = async (e, bookId) => {
     e.stopPropagation();
     if (!window.confirm("Delete this book?")) return;
@@ -58,7 +77,7 @@ export default function Library() {
           <span className="gradient-text">Library</span>
         </h1>
         <p className="text-lg text-white/50">
-          {books.length} {books.length === 1 ? "book" : "books"} in your collection
+          {books.length}{nextCursor ? "+" : ""} {books.length === 1 && !nextCursor ? "book" : "books"} in your collection
         </p>
       </div>
 
@@ -96,9 +115,18 @@ export default function Library() {
                 className="group rounded-xl border border-white/5 bg-[#121212]/50 hover:border-indigo-500/30 transition-all duration-500 cursor-pointer overflow-hidden opacity-0 animate-fade-in-up"
                 style={{ animationFillMode: "forwards", animationDelay: `${i * 0.08}s` }}
               >
-                {/* Cover placeholder */}
-                <div className="h-32 bg-gradient-to-br from-indigo-900/20 to-purple-900/20 flex items-center justify-center border-b border-white/5">
-                  <BookOpen className="w-10 h-10 text-indigo-400/30" />
+                {/* Cover: first chapter image, or placeholder */}
+                <div className="h-32 bg-gradient-to-br from-indigo-900/20 to-purple-900/20 flex items-center justify-center border-b border-white/5 overflow-hidden">
+                  {book.first_image ? (
+                    <img
+                      src={`${BACKEND_URL}${withImageVariant(book.first_image, "web")}`}
+                      alt=""
+                      loading="lazy"
+                      className="w-full h-full object-cover opacity-80"
+                    />
+                  ) : (
+                    <BookOpen className="w-10 h-10 text-indigo-400/30" />
+                  )}
                 </div>
                 
                 <div className="p-5">
@@ -121,7 +149,7 @@ export default function Library() {
                   
                   <div className="flex items-center justify-between mt-4">
                     <span className="text-[10px] font-mono text-white/20">
-                      {book.chapters?.length || 0} / {book.outline?.length || 0} ch.
+                      {book.generated_chapters || 0} / {book.total_chapters || 0} ch.
                     </span>
                     <div className="flex gap-2">
                       <Button
@@ -150,6 +178,21 @@ export default function Library() {
           })}
         </div>
       )}
+
+      {nextCursor && !loading && (
+        <div className="flex justify-center mt-10">
+          <Button
+            variant="outline"
+            onClick={fetchMoreBooks}
+            disabled={loadingMore}
+            data-testid="load-more-books-btn"
+            className="border-white/10 text-white/60 hover:text-white"
+          >
+            {loadingMore && <Loader2 className="w-4 h-4 mr-2 animate-spin" />}
+            Load more
+          </Button>
+        </div>
+      )}
     </div>
   );
 }
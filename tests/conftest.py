@@ -0,0 +1,67 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_database")
+
+import server  # noqa: E402
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """In-memory Mongo database standing in for server.db."""
+    from mongomock_motor import AsyncMongoMockClient
+
+    database = AsyncMongoMockClient()["test_database"]
+    monkeypatch.setattr(server, "db", database)
+    return database
+
+
+@pytest.fixture
+def asset_dirs(tmp_path, monkeypatch):
+    """Point images, derived images and exports at a scratch directory."""
+    images = tmp_path / "images"
+    derived = images / "derived"
+    exports = tmp_path / "exports"
+    for directory in (images, derived, exports):
+        directory.mkdir(parents=True)
+    monkeypatch.setattr(server, "ROOT_DIR", tmp_path)
+    monkeypatch.setattr(server, "IMAGES_DIR", images)
+    monkeypatch.setattr(server, "DERIVED_IMAGES_DIR", derived)
+    monkeypatch.setattr(server, "EXPORTS_DIR", exports)
+    monkeypatch.setattr(server, "storage", server.LocalStorage())
+    return tmp_path
+
+
+@pytest.fixture
+def api():
+    """Factory for an HTTP client talking to the app in-process."""
+    import httpx
+
+    def make():
+        return httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://test")
+    return make
+
+
+@pytest.fixture
+def make_book(db):
+    """Async factory inserting a book with written chapters."""
+    async def make(book_id="book-1", chapters=2, status="chapters_complete", **fields):
+        await db.books.insert_one({
+            "id": book_id, "title": "Test Book", "subtitle": "A subtitle", "category": "general",
+            "language": "en", "status": status, "created_at": "2024-01-01T00:00:00+00:00",
+            "outline": [{"chapter_number": i, "title": f"Chapter {i}", "summary": "summary"}
+                        for i in range(1, chapters + 1)],
+            **fields,
+        })
+        for i in range(1, chapters + 1):
+            await db.chapters.insert_one({
+                "book_id": book_id, "chapter_number": i, "title": f"Chapter {i}",
+                "content": f"## Chapter {i}\n\nSome **bold** and _italic_ text.\n\n" + "word " * 200,
+            })
+        return book_id
+    return make
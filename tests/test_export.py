@@ -0,0 +1,41 @@
+import asyncio
+
+import server
+
+
+def test_color_and_bw_exports_are_cached_side_by_side(db, asset_dirs, api, make_book, monkeypatch):
+    monkeypatch.setattr(server, "EXPORT_WORKERS", 0)
+
+    async def scenario():
+        book_id = await make_book()
+        async with api() as client:
+            for interior in ("color", "bw", "color"):
+                r = await client.post(f"/api/books/{book_id}/export",
+                                      json={"book_id": book_id, "format": "docx", "interior": interior})
+                assert r.status_code == 200
+        return book_id
+
+    book_id = asyncio.run(scenario())
+    names = sorted(p.name for p in (asset_dirs / "exports").glob(f"{book_id}.*.docx"))
+    assert [name.split(".")[1] for name in names] == ["bw", "color"]
+
+
+def test_new_render_prunes_only_the_same_interior(db, asset_dirs, api, make_book, monkeypatch):
+    monkeypatch.setattr(server, "EXPORT_WORKERS", 0)
+
+    async def scenario():
+        book_id = await make_book()
+        async with api() as client:
+            for interior in ("color", "bw"):
+                await client.post(f"/api/books/{book_id}/export",
+                                  json={"book_id": book_id, "format": "docx", "interior": interior})
+            await db.chapters.update_one({"book_id": book_id, "chapter_number": 1},
+                                         {"$set": {"content": "Rewritten chapter."}})
+            r = await client.post(f"/api/books/{book_id}/export",
+                                  json={"book_id": book_id, "format": "docx", "interior": "color"})
+            assert r.status_code == 200
+        return book_id
+
+    book_id = asyncio.run(scenario())
+    names = [p.name for p in (asset_dirs / "exports").glob(f"{book_id}.*.docx")]
+    assert sorted(name.split(".")[1] for name in names) == ["bw", "color"]
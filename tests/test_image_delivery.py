@@ -0,0 +1,87 @@
+import asyncio
+import io
+
+import pytest
+from PIL import Image
+
+import server
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-99", (0, 99)),
+    ("bytes=10-", (10, 999)),
+    ("bytes=-100", (900, 999)),
+    ("bytes=-5000", (0, 999)),
+    ("bytes=990-5000", (990, 999)),
+    ("bytes = 5 - 9", (5, 9)),
+    # Ignored: serve the whole file
+    ("bytes=5-3", None),
+    ("bytes=0-1,5-9", None),
+    ("items=0-9", None),
+    ("bytes=-", None),
+    ("bytes=a-b", None),
+    ("bytes=--5", None),
+    ("bytes=1.5-3", None),
+])
+def test_parse_byte_range(header, expected):
+    assert server.parse_byte_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=1000-", "bytes=5000-6000", "bytes=-0"])
+def test_parse_byte_range_unsatisfiable(header):
+    with pytest.raises(ValueError):
+        server.parse_byte_range(header, 1000)
+
+
+@pytest.mark.parametrize("header, matches", [
+    ('"abc"', True),
+    ('W/"abc"', True),
+    ('"x", "abc"', True),
+    ("*", True),
+    ('"abcd"', False),
+    ("abc", False),
+])
+def test_etag_matches(header, matches):
+    assert server.etag_matches(header, '"abc"') is matches
+
+
+@pytest.fixture
+def image_file(asset_dirs):
+    buf = io.BytesIO()
+    Image.effect_noise((64, 64), 64).convert("RGB").save(buf, "PNG")
+    path = asset_dirs / "images" / "cover.png"
+    path.write_bytes(buf.getvalue())
+    return path
+
+
+def get(api, url, **headers):
+    async def request():
+        async with api() as client:
+            return await client.get(url, headers=headers)
+    return asyncio.run(request())
+
+
+def test_serve_image_ranges(api, image_file):
+    size = image_file.stat().st_size
+    r = get(api, "/api/images/cover.png", range="bytes=0-9")
+    assert r.status_code == 206
+    assert r.headers["content-range"] == f"bytes 0-9/{size}"
+    assert r.content == image_file.read_bytes()[:10]
+
+    r = get(api, "/api/images/cover.png", range="bytes=5-3")
+    assert r.status_code == 200
+    assert len(r.content) == size
+
+    r = get(api, "/api/images/cover.png", range=f"bytes={size}-")
+    assert r.status_code == 416
+
+
+def test_serve_image_not_modified(api, image_file):
+    etag = get(api, "/api/images/cover.png").headers["etag"]
+    assert get(api, "/api/images/cover.png", **{"if-none-match": etag}).status_code == 304
+
+
+@pytest.mark.parametrize("name", [".staging-1234", ".cover.png.abcd.part"])
+def test_serve_image_hides_temporary_files(api, image_file, name):
+    (image_file.parent / name).write_bytes(image_file.read_bytes())
+    assert get(api, f"/api/images/{name}").status_code == 404
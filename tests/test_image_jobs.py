@@ -0,0 +1,146 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import server
+
+
+def expire_lease(db, book_id):
+    past = datetime.now(timezone.utc) - timedelta(seconds=5)
+    return db.books.update_one({"id": book_id}, {"$set": {"image_job_lease.expires_at": past}})
+
+
+def job(status="running"):
+    return {"id": "job", "status": status, "total": 1, "completed": 0, "failed": 0,
+            "pending": [1], "failed_chapters": []}
+
+
+def test_claim_is_exclusive_until_the_lease_expires(db, make_book):
+    async def scenario():
+        book_id = await make_book()
+        assert await server.claim_image_job(book_id, "a", job())
+        assert not await server.claim_image_job(book_id, "b", job())
+        await expire_lease(db, book_id)
+        assert await server.claim_image_job(book_id, "b", job())
+        # The first owner lost the job: its progress is no longer stored
+        assert not await server.save_image_job(book_id, job(), "a")
+        assert await server.save_image_job(book_id, job("done"), "b", final=True)
+        assert await server.claim_image_job(book_id, "c", job())
+
+    asyncio.run(scenario())
+
+
+def test_legacy_running_job_without_lease_is_restartable(db, make_book):
+    async def scenario():
+        book_id = await make_book(image_job=job())
+        book = await db.books.find_one({"id": book_id})
+        assert server.image_job_view(book)["status"] == "interrupted"
+        assert await server.claim_image_job(book_id, "a", job())
+        book = await db.books.find_one({"id": book_id})
+        assert server.image_job_view(book)["status"] == "running"
+
+    asyncio.run(scenario())
+
+
+def test_endpoint_rejects_live_job_and_restarts_interrupted_one(db, api, make_book, monkeypatch):
+    async def fake_image(book, chapter, image_source):
+        url = f"/api/images/{book['id']}_{chapter['chapter_number']}.png"
+        await db.chapters.update_one({"book_id": book["id"], "chapter_number": chapter["chapter_number"]},
+                                     {"$set": {"image_url": url}})
+        return url
+
+    monkeypatch.setattr(server, "create_chapter_image", fake_image)
+
+    async def scenario():
+        book_id = await make_book(chapters=3)
+        assert await server.claim_image_job(book_id, "dead-worker", job())
+        async with api() as client:
+            r = await client.post(f"/api/books/{book_id}/generate-all-images")
+            assert r.status_code == 409
+
+            await expire_lease(db, book_id)
+            progress = (await client.get(f"/api/books/{book_id}/progress")).json()
+            assert progress["image_job"]["status"] == "interrupted"
+
+            r = await client.post(f"/api/books/{book_id}/generate-all-images")
+            assert r.status_code == 200
+            assert r.json()["total"] == 3
+
+            book = (await client.get(f"/api/books/{book_id}")).json()
+            assert book["image_job"]["status"] == "done"
+            assert book["image_job"]["completed"] == 3
+            assert "image_job_lease" not in book
+        stored = await db.books.find_one({"id": book_id})
+        assert stored["image_job_lease"] is None
+
+    asyncio.run(scenario())
+
+
+def run_image_job(db, api, make_book, monkeypatch, image_source, query_calls, failing_bulk_write=False):
+    async def settings():
+        return {"image_source": image_source}
+
+    async def ai_down(prompt):
+        raise RuntimeError("image model unavailable")
+
+    async def generate_queries(book_title, chapters):
+        query_calls.append([ch["chapter_number"] for ch in chapters])
+        return {ch["chapter_number"]: f"query {ch['chapter_number']}" for ch in chapters}
+
+    async def stock_image(query):
+        return f"/api/images/{query.replace(' ', '_')}.jpg"
+
+    monkeypatch.setattr(server, "get_settings", settings)
+    monkeypatch.setattr(server, "generate_image_ai", ai_down)
+    monkeypatch.setattr(server, "generate_stock_search_queries", generate_queries)
+    monkeypatch.setattr(server, "fetch_stock_image", stock_image)
+    if failing_bulk_write:
+        async def bulk_write(*args, **kwargs):
+            raise ConnectionError("mongo went away")
+        monkeypatch.setattr(type(db.chapters), "bulk_write", bulk_write)
+
+    async def scenario():
+        book_id = await make_book(chapters=3)
+        async with api() as client:
+            assert (await client.post(f"/api/books/{book_id}/generate-all-images")).status_code == 200
+            return (await client.get(f"/api/books/{book_id}/progress")).json()["image_job"]
+    return asyncio.run(scenario())
+
+
+def test_both_sources_prefetch_stock_queries_in_one_call(db, api, make_book, monkeypatch):
+    query_calls = []
+    job = run_image_job(db, api, make_book, monkeypatch, "both", query_calls)
+    assert job["status"] == "done" and job["completed"] == 3
+    assert query_calls == [[1, 2, 3]]
+
+
+def test_failed_query_prefetch_does_not_fail_the_job(db, api, make_book, monkeypatch):
+    query_calls = []
+    job = run_image_job(db, api, make_book, monkeypatch, "stock", query_calls, failing_bulk_write=True)
+    # The queries were generated before the write failed: the chapters still use them
+    assert job["status"] == "done" and job["completed"] == 3
+    assert query_calls == [[1, 2, 3]]
+
+
+def test_stock_slot_is_not_held_during_the_query_call(db, make_book, monkeypatch):
+    monkeypatch.setattr(server, "stock_image_slots", asyncio.Semaphore(1))
+    slots_free_during_query = []
+
+    async def generate_queries(book_title, chapters):
+        slots_free_during_query.append(not server.stock_image_slots.locked())
+        return {ch["chapter_number"]: "lake" for ch in chapters}
+
+    async def stock_image(query):
+        assert server.stock_image_slots.locked()
+        return None
+
+    monkeypatch.setattr(server, "generate_stock_search_queries", generate_queries)
+    monkeypatch.setattr(server, "fetch_stock_image", stock_image)
+
+    async def scenario():
+        book_id = await make_book(chapters=1)
+        book = await db.books.find_one({"id": book_id}, {"_id": 0})
+        chapter = await db.chapters.find_one({"book_id": book_id}, {"_id": 0})
+        assert await server.create_chapter_image(book, chapter, "stock") is None
+
+    asyncio.run(scenario())
+    assert slots_free_during_query == [True]
@@ -0,0 +1,111 @@
+import asyncio
+import io
+
+import pytest
+from PIL import Image
+
+import server
+
+
+def png_bytes(seed=64):
+    buf = io.BytesIO()
+    Image.effect_noise((32, 32), seed).convert("RGB").save(buf, "PNG")
+    return buf.getvalue()
+
+
+async def blob_for(db, url):
+    return await db.image_blobs.find_one({"digest": server.image_blob_digest(url)})
+
+
+def test_store_and_release_count_references(db, asset_dirs):
+    async def scenario():
+        data = png_bytes()
+        url = await server.store_image_bytes(data)
+        assert url == await server.store_image_bytes(data)
+        blob = await blob_for(db, url)
+        assert blob["refs"] == 2 and blob["media_type"] == "image/png"
+        assert server.local_image_path(url).read_bytes() == data
+
+        await server.release_image(url)
+        await server.release_image(url)
+        await server.release_image(url)  # never below zero
+        blob = await blob_for(db, url)
+        assert blob["refs"] == 0 and blob["released_at"]
+
+    asyncio.run(scenario())
+
+
+def test_failed_write_hands_the_reference_back(db, asset_dirs, monkeypatch):
+    async def failing_publish(path, media_type=None, immutable=False):
+        raise OSError("bucket unavailable")
+
+    monkeypatch.setattr(server.storage, "publish", failing_publish)
+
+    async def scenario():
+        with pytest.raises(OSError):
+            await server.store_image_bytes(png_bytes())
+        blob = await db.image_blobs.find_one({})
+        assert blob["refs"] == 0 and blob["released_at"]
+
+    asyncio.run(scenario())
+
+
+def test_image_for_deleted_chapter_is_released(db, asset_dirs, make_book, monkeypatch):
+    async def fake_ai_image(prompt):
+        return await server.store_image_bytes(png_bytes())
+
+    monkeypatch.setattr(server, "generate_image_ai", fake_ai_image)
+
+    async def scenario():
+        book_id = await make_book(chapters=1)
+        book = await db.books.find_one({"id": book_id}, {"_id": 0})
+        chapter = await db.chapters.find_one({"book_id": book_id}, {"_id": 0})
+        await db.chapters.delete_many({"book_id": book_id})
+        assert await server.create_chapter_image(book, chapter, "ai") is None
+        blob = await db.image_blobs.find_one({})
+        assert blob["refs"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_gc_deletes_released_blobs_and_repairs_used_ones(db, asset_dirs):
+    async def scenario():
+        unused = await server.store_image_bytes(png_bytes(10))
+        used = await server.store_image_bytes(png_bytes(90))
+        await server.release_image(unused)
+        await server.release_image(used)
+        await db.chapters.insert_one({"book_id": "b", "chapter_number": 1, "image_url": used})
+        await asyncio.sleep(0.01)
+
+        stats = await server.collect_image_blobs(grace_seconds=0, dry_run=True)
+        assert stats["deleted"] == 0 and stats["repaired"] == 1
+        assert server.local_image_path(unused).exists()
+        # A dry run only reports: the count of the used blob is left as it was
+        assert (await blob_for(db, used))["refs"] == 0
+
+        stats = await server.collect_image_blobs(grace_seconds=0)
+        assert stats["deleted"] == 1 and stats["repaired"] == 1
+        assert not server.local_image_path(unused).exists()
+        assert await blob_for(db, unused) is None
+        assert (await blob_for(db, used))["refs"] == 1
+        assert server.local_image_path(used).exists()
+
+    asyncio.run(scenario())
+
+
+def test_acquire_waits_for_the_gc_lock(db, asset_dirs):
+    async def scenario():
+        await db.image_blobs.insert_one({"digest": "d" * 64, "filename": "x.png",
+                                         "refs": server.IMAGE_BLOB_COLLECTING})
+
+        async def finish_collecting():
+            await asyncio.sleep(0.1)
+            await db.image_blobs.delete_one({"digest": "d" * 64})
+
+        collector = asyncio.create_task(finish_collecting())
+        # Registered again from scratch once the GC is done: the file must be rewritten
+        assert await server.acquire_image_blob("d" * 64, "x.png", 10, "image/png") is True
+        await collector
+        assert (await db.image_blobs.find_one({"digest": "d" * 64}))["refs"] == 1
+
+    asyncio.run(scenario())
@@ -0,0 +1,146 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def book_with_missing_chapters(db, make_book):
+    """A 4-chapter book with chapters 2-4 still to write."""
+    async def make():
+        book_id = await make_book(chapters=4, status="writing")
+        await db.chapters.delete_many({"book_id": book_id, "chapter_number": {"$gt": 1}})
+        return await db.books.find_one({"id": book_id}, {"_id": 0})
+    return make
+
+
+def expire_leases(db):
+    past = datetime.now(timezone.utc) - timedelta(seconds=1)
+    return db.job_items.update_many({"status": "running"}, {"$set": {"lease_expires_at": past}})
+
+
+def test_enqueue_queues_missing_chapters_once(db, book_with_missing_chapters):
+    async def scenario():
+        book = await book_with_missing_chapters()
+        job = await server.enqueue_chapter_job(book, concurrency=2)
+        assert job["total"] == 3 and job["status"] == "running"
+        assert (await server.enqueue_chapter_job(book, concurrency=2))["id"] == job["id"]
+        items = await db.job_items.find({"job_id": job["id"]}).sort("chapter_number", 1).to_list(None)
+        assert [(i["chapter_number"], i["status"], i["attempts"]) for i in items] == [
+            (2, "queued", 0), (3, "queued", 0), (4, "queued", 0)]
+
+    asyncio.run(scenario())
+
+
+def test_claim_lease_and_release(db, book_with_missing_chapters):
+    async def scenario():
+        job = await server.enqueue_chapter_job(await book_with_missing_chapters(), concurrency=1)
+        item, claimed_job = await server.claim_next_job_item("worker-a")
+        assert item["chapter_number"] == 2 and item["lease_owner"] == "worker-a"
+        assert claimed_job["id"] == job["id"]
+        # The job's concurrency is taken: other workers get nothing
+        assert await server.claim_next_job_item("worker-b") is None
+        assert await db.job_items.count_documents({"status": "running"}) == 1
+
+        # A worker that died stops renewing: its item is claimed again
+        await expire_leases(db)
+        item_b, _ = await server.claim_next_job_item("worker-b")
+        assert item_b["chapter_number"] == 2 and item_b["attempts"] == 2
+
+        # Handing an item back does not count as an attempt
+        await server.release_job_item(item_b, "worker-b", delay=60)
+        released = await db.job_items.find_one({"_id": item_b["_id"]})
+        assert released["status"] == "queued" and released["attempts"] == 1
+        assert "lease_owner" not in released
+        # ...and it waits for its delay while the next chapter goes first
+        item_c, _ = await server.claim_next_job_item("worker-c")
+        assert item_c["chapter_number"] == 3
+
+        # A stale owner cannot release an item it lost
+        await server.release_job_item(item_c, "worker-a")
+        assert (await db.job_items.find_one({"_id": item_c["_id"]}))["lease_owner"] == "worker-c"
+
+    asyncio.run(scenario())
+
+
+def test_item_abandoned_too_often_fails(db, book_with_missing_chapters, monkeypatch):
+    monkeypatch.setattr(server, "JOB_MAX_ATTEMPTS", 2)
+
+    async def scenario():
+        book = await book_with_missing_chapters()
+        job = await server.enqueue_chapter_job(book, concurrency=1)
+        await db.job_items.update_many({"job_id": job["id"], "chapter_number": {"$ne": 2}},
+                                       {"$set": {"status": "done"}})
+        for _ in range(2):
+            assert await server.claim_next_job_item("crashing-worker")
+            await expire_leases(db)
+        assert await server.claim_next_job_item("next-worker") is None
+
+        item = await db.job_items.find_one({"job_id": job["id"], "chapter_number": 2})
+        assert item["status"] == "failed" and "2 times" in item["error"]
+        stored = await db.jobs.find_one({"id": job["id"]})
+        assert stored["status"] == "done" and stored["failed_chapters"] == [2]
+        book = await db.books.find_one({"id": book["id"]})
+        assert book["status"] == "error" and "Chapter(s) 2 failed" in book["error"]
+
+    asyncio.run(scenario())
+
+
+def test_processed_items_complete_the_job(db, book_with_missing_chapters, monkeypatch):
+    async def fake_write(book, ch, deadline=None):
+        await db.chapters.insert_one({"book_id": book["id"], "chapter_number": ch["chapter_number"],
+                                      "title": ch["title"], "content": "text"})
+
+    monkeypatch.setattr(server, "write_bulk_chapter", fake_write)
+
+    async def scenario():
+        book = await book_with_missing_chapters()
+        job = await server.enqueue_chapter_job(book, concurrency=3)
+        while claimed := await server.claim_next_job_item("worker"):
+            await server.process_job_item(*claimed, "worker")
+        stored = await db.jobs.find_one({"id": job["id"]})
+        assert stored["status"] == "done" and stored["completed"] == 3
+        assert (await db.books.find_one({"id": book["id"]}))["status"] == "chapters_complete"
+
+    asyncio.run(scenario())
+
+
+def test_progress_flags_writing_without_a_job_as_restartable(db, api, book_with_missing_chapters):
+    async def scenario():
+        book = await book_with_missing_chapters()
+        async with api() as client:
+            progress = (await client.get(f"/api/books/{book['id']}/progress")).json()
+            assert progress["status"] == "writing" and progress["restartable"] is True
+
+            r = await client.post(f"/api/books/{book['id']}/generate-all-chapters")
+            assert r.status_code == 200
+            progress = (await client.get(f"/api/books/{book['id']}/progress")).json()
+            assert progress["chapter_job"]["status"] == "running"
+            assert progress["restartable"] is False
+
+    asyncio.run(scenario())
+
+
+def test_fast_worker_outcome_is_not_overwritten(db, api, book_with_missing_chapters, monkeypatch):
+    enqueue = server.enqueue_chapter_job
+
+    async def enqueue_and_fail_at_once(book, concurrency):
+        # A worker in another process claims and fails every item before the request returns
+        job = await enqueue(book, concurrency)
+        while claimed := await server.claim_next_job_item("fast-worker"):
+            await server.fail_job_item(claimed[0], claimed[1], "fast-worker", "no API key")
+        return job
+
+    monkeypatch.setattr(server, "enqueue_chapter_job", enqueue_and_fail_at_once)
+
+    async def scenario():
+        book = await book_with_missing_chapters()
+        async with api() as client:
+            r = await client.post(f"/api/books/{book['id']}/generate-all-chapters")
+            assert r.status_code == 200
+        stored = await db.books.find_one({"id": book["id"]})
+        assert stored["status"] == "error" and "Chapter(s) 2, 3, 4 failed" in stored["error"]
+
+    asyncio.run(scenario())
@@ -0,0 +1,27 @@
+import asyncio
+
+import server
+
+
+def test_unparsable_cached_themes_are_forgotten_even_if_mongo_fails(db, api, monkeypatch):
+    async def not_json(prompt, system_message="", **kwargs):
+        return "Sorry, here are some themes: ..."
+
+    deletes = []
+
+    async def failing_delete(*args, **kwargs):
+        deletes.append(args)
+        raise ConnectionError("mongo went away")
+
+    monkeypatch.setattr(server, "call_gemini", not_json)
+    # Collections are fresh wrappers on each attribute access: patch their class
+    monkeypatch.setattr(type(db.llm_cache), "delete_one", failing_delete)
+
+    async def scenario():
+        async with api() as client:
+            return await client.post("/api/themes/discover", json={"language": "en"})
+
+    r = asyncio.run(scenario())
+    assert deletes, "the unparsable response was not forgotten"
+    assert r.status_code == 200
+    assert r.json() == {"themes": [], "error": "Failed to parse AI response"}
@@ -0,0 +1,194 @@
+import asyncio
+import time
+
+import aiohttp
+import pytest
+from google.genai import errors
+
+import server
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(server, "llm_breakers", {})
+    monkeypatch.setattr(server, "LLM_RETRY_BASE_DELAY", 0.001)
+    monkeypatch.setattr(server, "LLM_RETRY_MAX_DELAY", 0.001)
+
+
+def open_breaker(name, threshold=2, cooldown=0.05):
+    breaker = server.CircuitBreaker(name, threshold=threshold, cooldown=cooldown)
+    for _ in range(threshold):
+        breaker.before_call()
+        breaker.record_failure()
+    return breaker
+
+
+def test_breaker_opens_at_threshold():
+    breaker = server.CircuitBreaker("m", threshold=3, cooldown=10)
+    for _ in range(2):
+        breaker.before_call()
+        breaker.record_failure()
+    breaker.before_call()  # still closed
+    breaker.record_success()
+    assert breaker.failures == 0
+
+    breaker = open_breaker("m", threshold=3, cooldown=10)
+    assert 9 < breaker.retry_after() <= 10
+    with pytest.raises(server.CircuitOpenError) as exc:
+        breaker.before_call()
+    assert 9 < exc.value.retry_after <= 10
+
+
+def test_breaker_lets_a_single_probe_through_after_cooldown():
+    breaker = open_breaker("m")
+    time.sleep(0.06)
+    assert breaker.retry_after() == 0
+    breaker.before_call()  # the probe
+    with pytest.raises(server.CircuitOpenError):
+        breaker.before_call()  # others still shed while it runs
+    breaker.record_success()
+    breaker.before_call()
+    assert breaker.opened_at is None
+
+
+def test_failed_probe_reopens_the_circuit():
+    breaker = open_breaker("m")
+    time.sleep(0.06)
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.retry_after() > 0
+    with pytest.raises(server.CircuitOpenError):
+        breaker.before_call()
+
+
+def test_released_probe_lets_another_call_probe():
+    breaker = open_breaker("m")
+    time.sleep(0.06)
+    breaker.before_call()
+    breaker.release_probe()
+    breaker.before_call()
+    assert breaker.probing
+
+
+@pytest.mark.parametrize("exc, retryable", [
+    (errors.APIError(429, {"error": {"message": "quota"}}), True),
+    (errors.APIError(503, {"error": {"message": "overloaded"}}), True),
+    (errors.ClientError(400, {"error": {"message": "bad request"}}), False),
+    (errors.ClientError(403, {"error": {"message": "forbidden"}}), False),
+    (asyncio.TimeoutError(), True),
+    (aiohttp.ClientConnectionError(), True),
+    (ConnectionResetError(), True),
+    (ValueError("bad json"), False),
+])
+def test_retry_classification(exc, retryable):
+    assert server.is_retryable_llm_error(exc) is retryable
+
+
+def flaky(failures, exc=None, result="ok"):
+    calls = []
+
+    async def call():
+        calls.append(time.monotonic())
+        if len(calls) <= failures:
+            raise exc or errors.APIError(503, {"error": {"message": "overloaded"}})
+        return result
+    return call, calls
+
+
+def test_retryable_errors_are_retried():
+    call, calls = flaky(2)
+    assert asyncio.run(server.resilient_llm_call(call, "m")) == "ok"
+    assert len(calls) == 3
+    assert server.llm_breaker("m").failures == 0
+
+
+def test_non_retryable_errors_are_raised_at_once():
+    call, calls = flaky(5, exc=errors.ClientError(400, {"error": {"message": "bad"}}))
+    with pytest.raises(errors.ClientError):
+        asyncio.run(server.resilient_llm_call(call, "m"))
+    assert len(calls) == 1
+    assert server.llm_breaker("m").failures == 0
+
+
+def test_retries_give_up_after_the_last_attempt(monkeypatch):
+    monkeypatch.setattr(server, "LLM_RETRY_ATTEMPTS", 3)
+    call, calls = flaky(10)
+    with pytest.raises(errors.APIError):
+        asyncio.run(server.resilient_llm_call(call, "m"))
+    assert len(calls) == 3
+
+
+def test_expired_deadline_skips_the_call():
+    call, calls = flaky(0)
+    with pytest.raises(TimeoutError):
+        asyncio.run(server.resilient_llm_call(call, "m", deadline=time.monotonic() - 1))
+    assert calls == []
+
+
+def test_deadline_bounds_every_attempt(monkeypatch):
+    monkeypatch.setattr(server, "LLM_RETRY_ATTEMPTS", 10)
+    calls = []
+
+    async def hang():
+        calls.append(time.monotonic())
+        await asyncio.sleep(10)
+
+    started = time.monotonic()
+    with pytest.raises((asyncio.TimeoutError, TimeoutError)):
+        asyncio.run(server.resilient_llm_call(hang, "m", deadline=time.monotonic() + 0.2))
+    assert time.monotonic() - started < 1
+    assert len(calls) >= 1
+
+
+def test_opening_failure_sheds_the_call_and_the_next_ones():
+    server.llm_breakers["m"] = server.CircuitBreaker("m", threshold=2, cooldown=30)
+    call, calls = flaky(10)
+    with pytest.raises(server.CircuitOpenError) as exc:
+        asyncio.run(server.resilient_llm_call(call, "m"))
+    assert isinstance(exc.value.__cause__, errors.APIError)
+    assert len(calls) == 2
+    with pytest.raises(server.CircuitOpenError):
+        asyncio.run(server.resilient_llm_call(call, "m"))
+    assert len(calls) == 2
+
+
+def test_cancelled_probe_is_released():
+    breaker = server.llm_breakers["m"] = open_breaker("m", cooldown=0.01)
+    time.sleep(0.02)
+
+    async def scenario():
+        task = asyncio.create_task(server.resilient_llm_call(lambda: asyncio.sleep(10), "m"))
+        await asyncio.sleep(0.01)
+        assert breaker.probing
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(scenario())
+    assert not breaker.probing
+
+
+@pytest.fixture
+def text_circuit_open(monkeypatch):
+    async def no_client():
+        return object()
+
+    monkeypatch.setattr(server, "get_genai_client", no_client)
+    server.llm_breakers[server.GEMINI_TEXT_MODEL] = open_breaker(server.GEMINI_TEXT_MODEL, cooldown=42)
+
+
+def test_open_circuit_is_a_503_with_retry_after(db, api, make_book, text_circuit_open):
+    async def scenario():
+        book_id = await make_book(chapters=1)
+        async with api() as client:
+            responses = [
+                await client.post("/api/themes/discover", json={"language": "en"}),
+                await client.post(f"/api/books/{book_id}/generate-chapter/1"),
+                await client.post(f"/api/books/{book_id}/generate-chapter/1/stream"),
+            ]
+        for r in responses:
+            assert r.status_code == 503, r.text
+            assert 41 <= int(r.headers["retry-after"]) <= 42
+            assert "temporarily unavailable" in r.json()["detail"]
+
+    asyncio.run(scenario())
@@ -0,0 +1,85 @@
+import re
+
+import pytest
+
+import server
+
+
+def legacy_md_clean(text):
+    """md_clean as it was before the single-pass tokenizer."""
+    text = re.sub(r'\*{1,3}(.+?)\*{1,3}', r'\1', text)
+    text = re.sub(r'_{1,3}(.+?)_{1,3}', r'\1', text)
+    text = re.sub(r'`(.+?)`', r'\1', text)
+    text = re.sub(r'\[(.+?)\]\(.+?\)', r'\1', text)
+    return text
+
+
+def test_plain_text_is_one_span():
+    assert server.tokenize_inline("no markup here") == [["no markup here", False, False, False, None]]
+    assert server.tokenize_inline("") == []
+
+
+def test_styles_and_nesting():
+    spans = server.tokenize_inline("a **b *c* d** `e` [f](http://x)")
+    assert spans == [
+        ["a ", False, False, False, None],
+        ["b ", True, False, False, None],
+        ["c", True, True, False, None],
+        [" d", True, False, False, None],
+        [" ", False, False, False, None],
+        ["e", False, False, True, None],
+        [" ", False, False, False, None],
+        ["f", False, False, False, "http://x"],
+    ]
+
+
+def test_code_wins_over_emphasis():
+    assert server.tokenize_inline("`*not italic*`") == [["*not italic*", False, False, True, None]]
+
+
+@pytest.mark.parametrize("text, italic", [
+    ("_Note_", "Note"),
+    ("un _mot_ ici", "mot"),
+    ("(_aside_)", "aside"),
+])
+def test_single_underscore_italic(text, italic):
+    spans = server.tokenize_inline(text)
+    assert [s[0] for s in spans if s[2]] == [italic]
+    assert server.md_to_html(text).count("<em>") == 1
+
+
+@pytest.mark.parametrize("text", [
+    "snake_case",
+    "my_var_name and other_var",
+    "file_a_b.py",
+    "_ spaced _",
+    "trailing_",
+])
+def test_identifiers_keep_their_underscores(text):
+    assert server.md_clean(text) == text
+    assert "<em>" not in server.md_to_html(text)
+
+
+@pytest.mark.parametrize("text", [
+    "_Note_",
+    "***Attention*** : les __regles__ changent",
+    "Le **premier point** est *essentiel*, voir `calcul()` et la [doc](https://example.com).",
+    "Une phrase simple sans aucune mise en forme.",
+    "mix of _italic_ and *italic* and ___both___",
+])
+def test_md_clean_matches_legacy_output(text):
+    assert server.md_clean(text) == legacy_md_clean(text)
+
+
+def test_md_clean_no_longer_mangles_identifiers():
+    # The old regexes treated any pair of underscores as emphasis.
+    assert legacy_md_clean("snake_case or my_var") == "snakecase or myvar"
+    assert server.md_clean("snake_case or my_var") == "snake_case or my_var"
+
+
+def test_render_inline_emits_every_format():
+    rendered = server.render_inline("_a_ **b**")
+    assert rendered["plain"] == "a b"
+    assert rendered["html"] == "<em>a</em> <strong>b</strong>"
+    assert rendered["xml"] == "<i>a</i> <b>b</b>"
+    assert rendered["runs"] == [["a", False, True], [" ", False, False], ["b", True, False]]
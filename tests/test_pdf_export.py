@@ -0,0 +1,34 @@
+import asyncio
+import io
+import re
+
+import pytest
+
+import server
+
+pypdf = pytest.importorskip("pypdf")
+
+
+def test_toc_page_numbers_point_at_the_chapters(db, asset_dirs, api, make_book, monkeypatch):
+    """The single layout pass fills the TOC with the pages the chapters land on."""
+    monkeypatch.setattr(server, "EXPORT_WORKERS", 0)
+
+    async def scenario():
+        book_id = await make_book(chapters=4)
+        for number, words in ((2, 900), (3, 2500)):
+            await db.chapters.update_one({"book_id": book_id, "chapter_number": number},
+                                         {"$set": {"content": "word " * words}})
+        async with api() as client:
+            r = await client.post(f"/api/books/{book_id}/export", json={"book_id": book_id, "format": "pdf"})
+            assert r.status_code == 200
+            return r.content
+
+    pdf = pypdf.PdfReader(io.BytesIO(asyncio.run(scenario())))
+    toc = pdf.pages[1].extract_text()
+    entries = [(int(chapter), int(page)) for chapter, page in
+               re.findall(r'Chapter (\d+) - Chapter \d+\s+(\d+)', toc)]
+    assert [chapter for chapter, _ in entries] == [1, 2, 3, 4]
+    pages = [page for _, page in entries]
+    assert pages == sorted(set(pages)), toc
+    for chapter, page in entries:
+        assert f"CHAPTER {chapter}" in pdf.pages[page - 1].extract_text()
@@ -0,0 +1,118 @@
+import asyncio
+import io
+import time
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from PIL import Image
+
+import server
+
+
+def jpeg_bytes(seed):
+    buf = io.BytesIO()
+    Image.effect_noise((64, 64), seed).convert("RGB").save(buf, "JPEG", quality=95)
+    return buf.getvalue()
+
+
+def image_handler(data, delay=0.0, stall=0.0, hits=None):
+    """Serve data as a JPEG after delay seconds; with stall, send the first
+    chunk and then hang for that long."""
+    async def handler(request):
+        if hits is not None:
+            hits.append(time.monotonic())
+        await asyncio.sleep(delay)
+        resp = web.StreamResponse(headers={"Content-Type": "image/jpeg"})
+        await resp.prepare(request)
+        await resp.write(data[:2048])
+        await asyncio.sleep(stall)
+        await resp.write(data[2048:])
+        await resp.write_eof()
+        return resp
+    return handler
+
+
+def failing_handler(hits=None):
+    async def handler(request):
+        if hits is not None:
+            hits.append(time.monotonic())
+        return web.Response(status=503, text="unavailable")
+    return handler
+
+
+@pytest.fixture
+def stock(db, asset_dirs, monkeypatch):
+    """Run fetch_stock_image against local primary and fallback servers."""
+    monkeypatch.setattr(server, "http_session", None)
+
+    def run(primary, fallback, hedge_delay):
+        async def scenario():
+            servers = []
+            for name, handler in (("PRIMARY", primary), ("FALLBACK", fallback)):
+                app = web.Application()
+                app.router.add_get("/photo", handler)
+                test_server = TestServer(app)
+                await test_server.start_server()
+                servers.append(test_server)
+                monkeypatch.setattr(server, f"STOCK_{name}_URL", str(test_server.make_url("/photo?q={query}")))
+            monkeypatch.setattr(server, "STOCK_HEDGE_DELAY", hedge_delay)
+            started = time.monotonic()
+            try:
+                url = await server.fetch_stock_image("mountain lake")
+                return url, time.monotonic() - started, started
+            finally:
+                await server.http_session.close()
+                server.http_session = None
+                for test_server in servers:
+                    await test_server.close()
+        return asyncio.run(scenario())
+    return run
+
+
+def leftovers(asset_dirs):
+    return sorted(p.name for p in (asset_dirs / "images").iterdir() if p.name.startswith("."))
+
+
+def test_slow_primary_loses_to_fallback(stock, asset_dirs):
+    fallback_image = jpeg_bytes(20)
+    serve_fallback = image_handler(fallback_image)
+    in_flight = []
+
+    async def fallback(request):
+        in_flight.extend(leftovers(asset_dirs))
+        return await serve_fallback(request)
+
+    url, elapsed, _ = stock(image_handler(jpeg_bytes(90), stall=10), fallback, hedge_delay=0.3)
+    assert elapsed < 5
+    assert server.local_image_path(url).read_bytes() == fallback_image
+    # The primary was mid-download when hedged; it was cancelled and its file removed
+    assert any(name.endswith(".part") for name in in_flight)
+    assert leftovers(asset_dirs) == []
+
+
+def test_fast_primary_wins_without_hedging(stock, asset_dirs):
+    primary_image = jpeg_bytes(90)
+    fallback_hits = []
+    url, _, _ = stock(image_handler(primary_image), image_handler(jpeg_bytes(20), hits=fallback_hits),
+                      hedge_delay=2)
+    assert server.local_image_path(url).read_bytes() == primary_image
+    assert fallback_hits == []
+
+
+def test_failed_primary_starts_fallback_immediately(stock, asset_dirs):
+    fallback_image = jpeg_bytes(20)
+    fallback_hits = []
+    url, elapsed, started = stock(failing_handler(), image_handler(fallback_image, hits=fallback_hits),
+                                  hedge_delay=5)
+    assert server.local_image_path(url).read_bytes() == fallback_image
+    assert fallback_hits[0] - started < 2 and elapsed < 2
+
+
+def test_both_providers_failing_returns_none(stock, db, asset_dirs):
+    primary_hits, fallback_hits = [], []
+    url, _, _ = stock(failing_handler(primary_hits), failing_handler(fallback_hits), hedge_delay=0.2)
+    assert url is None
+    assert len(primary_hits) == len(fallback_hits) == 1
+    assert leftovers(asset_dirs) == []
+    assert asyncio.run(db.image_blobs.count_documents({})) == 0
@@ -0,0 +1,142 @@
+import asyncio
+import io
+from urllib.parse import urlparse
+
+import pytest
+from PIL import Image
+
+import server
+
+moto = pytest.importorskip("moto")
+
+BUCKET = "books-assets"
+
+
+@pytest.fixture
+def s3(asset_dirs, monkeypatch):
+    for name, value in {"AWS_ACCESS_KEY_ID": "testing", "AWS_SECRET_ACCESS_KEY": "testing",
+                        "AWS_DEFAULT_REGION": "us-east-1"}.items():
+        monkeypatch.setenv(name, value)
+    with moto.mock_aws():
+        backend = server.S3Storage(BUCKET, prefix="app/", region="us-east-1")
+        backend.client.create_bucket(Bucket=BUCKET)
+        monkeypatch.setattr(server, "storage", backend)
+        yield backend
+
+
+def object_keys(backend):
+    return sorted(obj["Key"] for obj in backend.client.list_objects_v2(Bucket=BUCKET).get("Contents", []))
+
+
+def png_bytes():
+    buf = io.BytesIO()
+    Image.effect_noise((32, 32), 64).convert("RGB").save(buf, "PNG")
+    return buf.getvalue()
+
+
+def test_publish_fetch_exists_list_delete(s3, asset_dirs):
+    path = asset_dirs / "exports" / "book.color.abc.pdf"
+
+    async def scenario():
+        path.write_bytes(b"%PDF-1.4 test")
+        assert not await s3.exists(path)
+        await s3.publish(path, "application/pdf")
+        assert object_keys(s3) == ["app/exports/book.color.abc.pdf"]
+        head = s3.client.head_object(Bucket=BUCKET, Key="app/exports/book.color.abc.pdf")
+        assert head["ContentType"] == "application/pdf"
+
+        s3.known.clear()
+        assert await s3.exists(path)
+        path.unlink()
+        assert await s3.list(asset_dirs / "exports", "book.") == [path]
+        assert await s3.fetch(path)
+        assert path.read_bytes() == b"%PDF-1.4 test"
+
+        await s3.delete(path)
+        assert not path.exists()
+        assert not await s3.exists(path)
+        assert not await s3.fetch(path)
+        assert await s3.list(asset_dirs / "exports", "book.") == []
+
+    asyncio.run(scenario())
+
+
+def test_serve_image_redirects_to_presigned_url(s3, db, api):
+    async def scenario():
+        url = await server.store_image_bytes(png_bytes())
+        async with api() as client:
+            r = await client.get(url)
+            assert r.status_code == 307
+            location = urlparse(r.headers["location"])
+            assert location.path.endswith("/app/images/" + url.rsplit("/", 1)[1])
+            assert "Signature" in location.query or "X-Amz-Signature" in location.query
+
+            r = await client.get(url, params={"variant": "web"})
+            assert r.status_code == 307
+        assert any(key.startswith("app/images/derived/") for key in object_keys(s3))
+
+    asyncio.run(scenario())
+
+
+def test_export_returns_json_link_or_see_other(s3, api, make_book, monkeypatch):
+    monkeypatch.setattr(server, "EXPORT_WORKERS", 0)
+
+    async def scenario():
+        book_id = await make_book()
+        body = {"book_id": book_id, "format": "epub"}
+        async with api() as client:
+            r = await client.post(f"/api/books/{book_id}/export", json=body,
+                                  headers={"Accept": "application/json"})
+            assert r.status_code == 200
+            assert r.json()["filename"].endswith(".epub")
+            assert "response-content-disposition" in r.json()["download_url"]
+
+            r = await client.post(f"/api/books/{book_id}/export", json=body)
+            assert r.status_code == 303
+            assert "/app/exports/" in r.headers["location"]
+        return book_id
+
+    book_id = asyncio.run(scenario())
+    assert [key for key in object_keys(s3) if key.startswith("app/exports/")] != []
+    assert all(book_id in key for key in object_keys(s3) if key.startswith("app/exports/"))
+
+
+def test_backfill_uploads_local_assets_once(s3, asset_dirs):
+    (asset_dirs / "images" / "legacy_ch1.png").write_bytes(png_bytes())
+    (asset_dirs / "images" / ".staging-123").write_bytes(b"partial")
+    (asset_dirs / "images" / "derived" / "legacy_ch1.web.0123456789abcdef.jpg").write_bytes(b"jpeg")
+    (asset_dirs / "exports" / "book.color.abc.docx").write_bytes(b"docx")
+    (asset_dirs / "exports" / "book.color.abc.docx.123.part").write_bytes(b"partial")
+
+    assert asyncio.run(server.backfill_storage(dry_run=True))["uploaded"] == 3
+    assert object_keys(s3) == []
+
+    stats = asyncio.run(server.backfill_storage())
+    assert stats["uploaded"] == 3 and stats["present"] == 0
+    assert object_keys(s3) == [
+        "app/exports/book.color.abc.docx",
+        "app/images/derived/legacy_ch1.web.0123456789abcdef.jpg",
+        "app/images/legacy_ch1.png",
+    ]
+    head = s3.client.head_object(Bucket=BUCKET, Key="app/images/legacy_ch1.png")
+    assert head["ContentType"] == "image/png"
+
+    stats = asyncio.run(server.backfill_storage())
+    assert stats["uploaded"] == 0 and stats["present"] == 3
+
+
+def test_trim_cache_evicts_only_stored_copies(s3, asset_dirs):
+    stored = asset_dirs / "exports" / "stored.pdf"
+    local_only = asset_dirs / "exports" / "local.pdf"
+    directories = [asset_dirs / "images", asset_dirs / "exports"]
+
+    async def scenario():
+        stored.write_bytes(b"x" * 100)
+        local_only.write_bytes(b"y" * 100)
+        await s3.publish(stored, "application/pdf")
+        assert await s3.trim_cache(directories, max_bytes=0) == 0  # too recent
+        assert await s3.trim_cache(directories, max_bytes=0, min_age=-1) == 1
+        assert not stored.exists() and local_only.exists()
+        assert await s3.fetch(stored)
+
+    asyncio.run(scenario())